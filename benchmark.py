@@ -0,0 +1,420 @@
+import gc
+import json
+import os
+import platform
+import sys
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from networkx.readwrite import json_graph
+import network_format
+import processing
+
+# Measures how the stages of processing.py scale on synthetic data. The
+# generator writes tables with the same columns and types as load_csv_files,
+# with the popularity of artists following a Zipf distribution and every
+# region preferring its own artists, so that clubs form communities.
+#
+# Every stage is timed on the output of the stage before it, the best of a
+# number of runs is kept, and its peak memory is measured with tracemalloc in
+# a separate run so that tracing does not slow down the timed runs.
+#
+#   python benchmark.py run [size ...]       write results to RESULTS_PATH
+#   python benchmark.py baseline [size ...]  write results to BASELINE_PATH
+#   python benchmark.py compare [size ...]   compare results to the baseline,
+#                                            exits with 1 on regressions
+
+# Parameters of synthetic_tables for every size, small is about the size of
+# the 2019 data
+SIZES = {
+    'small': {'clubs': 140, 'events': 60, 'years': 1},
+    'medium': {'clubs': 500, 'events': 100, 'years': 2},
+    'large': {'clubs': 1500, 'events': 100, 'years': 2},
+}
+DEFAULT_SIZES = ['small', 'medium']
+REPEAT = 3
+
+RESULTS_PATH = './data/benchmarks/results.json'
+BASELINE_PATH = './data/benchmarks/baseline.json'
+
+# Stages are regressions when they are slower or use more memory than the
+# baseline by more than the tolerance, and by more than the minimum so that
+# noise in fast stages is ignored
+TIME_TOLERANCE = 0.25
+MIN_SECONDS = 0.05
+MEMORY_TOLERANCE = 0.25
+MIN_BYTES = 1 << 20
+
+
+def zipf_probabilities(n, exponent):
+    """
+    Probability of every rank of a Zipf distribution over n items
+    """
+    weights = np.arange(1, n + 1, dtype=np.float64) ** -exponent
+    return weights / weights.sum()
+
+
+def synthetic_tables(clubs=140, events=60, years=1, regions=None,
+                     artists=None, artists_per_event=3.6, exponent=1.1,
+                     local_share=0.5, detail_share=1.0, seed=0):
+    """
+    Generate regions, clubs, dates and date details like load_csv_files
+
+    :param clubs:               Number of clubs
+    :param events:              Number of events of every club every year
+    :param years:               Number of years, up to 2019
+    :param regions:             Number of regions, one for every 7 clubs by
+                                default
+    :param artists:             Number of artists, by default about the ratio
+                                of artists to bookings in the 2019 data
+    :param artists_per_event:   Mean number of artists of an event, the number
+                                is geometrically distributed
+    :param exponent:            Exponent of the Zipf popularity of artists
+    :param local_share:         Share of the bookings of a club drawn from the
+                                popularity ranking of its region, the rest are
+                                drawn from the global ranking
+    :param detail_share:        Share of the events with date details
+    :param seed:                Seed for the random number generator
+
+    :return: A tuple of the regions, clubs, dates and date details
+    """
+    rng = np.random.default_rng(seed)
+    regions = regions or max(1, clubs // 7)
+    n_events = clubs * events * years
+    if artists is None:
+        artists = max(100, int(n_events * artists_per_event * 0.3))
+
+    region_table = pd.DataFrame({
+        'name': ['Region {}'.format(i) for i in range(regions)],
+        'country': ['Country {}'.format(i // 3) for i in range(regions)],
+        'region': ['/guide/r{}/region-{}'.format(i // 3, i)
+                   for i in range(regions)],
+        'rank': np.arange(regions)
+    })
+
+    club_regions = rng.integers(0, regions, clubs)
+    club_ids = np.arange(1000, 1000 + clubs)
+    club_table = pd.DataFrame({
+        'id': club_ids,
+        'img': np.where(
+            rng.random(clubs) < 0.35, '',
+            ['/images/clubs/club-{}.jpg'.format(i) for i in club_ids]
+        ),
+        'name': ['Club {}'.format(i) for i in range(clubs)],
+        'address': ['{} Street; Region {}'.format(i, r)
+                    for i, r in enumerate(club_regions)],
+        'rank': pd.Series(club_regions).groupby(club_regions).cumcount(),
+        'region': region_table.region.values[club_regions],
+        'followers': np.ceil(rng.lognormal(5.4, 2, clubs)).astype(np.int64),
+        'capacity': np.where(
+            rng.random(clubs) < 0.5, 0, rng.integers(100, 3000, clubs)
+        ),
+    }).set_index('id')
+
+    event_clubs = np.repeat(np.arange(clubs), events * years)
+    event_years = np.tile(np.repeat(np.arange(2019 - years + 1, 2020),
+                                    events), clubs)
+    event_ids = 1e6 + rng.permutation(n_events)
+    dates = pd.to_datetime(event_years.astype(str), format='%Y') + \
+        pd.to_timedelta(rng.integers(0, 365, n_events), unit='D')
+    attending = np.floor(rng.lognormal(3, 1.8, n_events)).astype(np.int64)
+    date_table = pd.DataFrame({
+        'id': event_ids,
+        'date': dates,
+        'attending': attending,
+        'name': ['Club {} event {}'.format(c, i)
+                 for i, c in enumerate(event_clubs)],
+        'img': ['{}-list.jpg'.format(int(i)) for i in event_ids],
+        'club_id': club_ids[event_clubs].astype(np.float64)
+    }).set_index('id')
+
+    detailed = np.flatnonzero(rng.random(n_events) < detail_share)
+    lengths = rng.geometric(1 / (artists_per_event + 1), len(detailed)) - 1
+    slots = lengths.sum()
+    # popular artists of a region are its own rotation of the global ranking
+    ranks = rng.choice(artists, slots, p=zipf_probabilities(
+        artists, exponent
+    ))
+    offsets = rng.integers(0, artists, regions)
+    slot_regions = np.repeat(club_regions[event_clubs[detailed]], lengths)
+    local = rng.random(slots) < local_share
+    ranks[local] = (ranks[local] + offsets[slot_regions[local]]) % artists
+    # most ids are the slugified name, some are not
+    names = ['Artist {}'.format(i) for i in range(artists)]
+    ids = ['artist{}'.format(i) if i % 50 else 'artist-{}'.format(i)
+           for i in range(artists)]
+    bookings = [[ids[i], names[i]] for i in ranks.tolist()]
+    bounds = np.append(0, np.cumsum(lengths)).tolist()
+    detail_table = pd.DataFrame({
+        'id': event_ids[detailed],
+        'start_time': '23:00',
+        'end_time': '06:00',
+        'cost': np.full(len(detailed), np.nan, dtype=object),
+        'age': '19+',
+        'promoters': [[[str(club_ids[c]), 'Club {}'.format(c)]]
+                      for c in event_clubs[detailed]],
+        'flyers': [['{}-front.jpg'.format(int(i))]
+                   for i in event_ids[detailed]],
+        'artists': [bookings[bounds[i]:bounds[i + 1]]
+                    for i in range(len(detailed))],
+        'pick': False,
+        'attending': attending[detailed]
+    }).set_index('id')
+
+    return region_table, club_table, date_table, detail_table
+
+
+def by_year(function):
+    """
+    Apply a function that takes the club data of a single year to every year
+
+    :return: A function of club data that returns a dict of the results by
+    year
+    """
+    def apply(club_data, *args):
+        return {
+            year: function(df, *[arg[year] for arg in args])
+            for year, df in club_data.groupby(level=0)
+        }
+    return apply
+
+
+def each(function):
+    """
+    Apply a function to every value of a dict of results by year
+    """
+    def apply(results):
+        return {year: function(value) for year, value in results.items()}
+    return apply
+
+
+def measure(function, arguments, repeat=REPEAT, memory=True):
+    """
+    Time a function and measure its peak memory
+
+    :param arguments:   Function that returns the arguments of every run, so
+                        that stages that change their input get a fresh copy
+    :param memory:      Measure the peak memory in a separate run
+
+    :return: A tuple of the smallest number of seconds of the runs, the peak
+    number of bytes allocated during a run, None if memory is not measured,
+    and the result of the last run
+    """
+    seconds = []
+    for _ in range(repeat):
+        args = arguments()
+        gc.collect()
+        start = perf_counter()
+        result = function(*args)
+        seconds.append(perf_counter() - start)
+
+    peak = None
+    if memory:
+        args = arguments()
+        gc.collect()
+        tracemalloc.start()
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(seconds), peak, result
+
+
+def stage_pipeline(tables):
+    """
+    Get the stages of processing.py in the order they run, every stage is a
+    tuple of its name, its function, a function that returns its arguments
+    from the results of the stages before it and a function that counts the
+    rows of its result
+    """
+    regions, clubs, dates, date_details = tables
+    details = date_details.drop(processing.LIST_COLUMNS, axis=1)
+
+    def likeness(df):
+        return processing.calculate_club_likeness(
+            df, top_k=processing.TOP_K_NEIGHBOURS,
+            min_score=processing.MIN_SIMILARITY
+        )
+
+    def graph(df, edges):
+        return processing.create_graph(
+            df, edges, processing.RANDOM_STATE, processing.COMMUNITY_METHOD,
+            processing.COMMUNITY_SEEDS, processing.RESOLUTION
+        )
+
+    def dump(d):
+        return json.dumps(processing.optimise_json(d))
+
+    def encode(d):
+        return network_format.encode_network(d, {})
+
+    def node_link_data(results):
+        return [{
+            year: json_graph.node_link_data(G)
+            for year, G in results['create_graph'].items()
+        }]
+
+    def total(values):
+        return sum(len(value) for value in values.values())
+
+    return [
+        ('normalize_artist_data', processing.normalize_artist_data,
+         lambda r: [date_details], len),
+        ('join_data_frames', processing.join_data_frames,
+         lambda r: [regions, clubs, dates, details,
+                    r['normalize_artist_data']], len),
+        ('group_by_year_and_club', processing.group_by_year_and_club,
+         lambda r: [r['join_data_frames'].reset_index()], len),
+        ('aggregate_club_data', processing.aggregate_club_data,
+         lambda r: [regions, clubs, dates, details,
+                    r['normalize_artist_data']], len),
+        ('calculate_club_likeness', by_year(likeness),
+         lambda r: [r['aggregate_club_data']], total),
+        ('create_graph', by_year(graph),
+         lambda r: [r['aggregate_club_data'],
+                    r['calculate_club_likeness']],
+         lambda graphs: sum(G.number_of_edges() for G in graphs.values())),
+        ('optimise_json', each(dump), node_link_data, total),
+        ('encode_network', each(encode), node_link_data, total),
+    ]
+
+
+def benchmark(size, parameters, repeat=REPEAT, memory=True, stages=None):
+    """
+    Generate synthetic tables and measure every stage on them
+
+    :param size:        Name of the size
+    :param parameters:  Parameters of synthetic_tables
+    :param stages:      Names of the stages to record, all stages run because
+                        every stage needs the results of the stages before it
+
+    :return: A list of dicts with the size, stage, seconds, peak bytes and
+    number of rows of the result of every stage. The rows of the json and
+    binary stages are the number of bytes of the networks.
+    """
+    tables = synthetic_tables(**parameters)
+    results, report = {}, []
+    for name, function, arguments, rows in stage_pipeline(tables):
+        seconds, peak, result = measure(
+            function, lambda: arguments(results), repeat,
+            memory and (stages is None or name in stages)
+        )
+        results[name] = result
+        if stages is None or name in stages:
+            report.append({
+                'size': size,
+                'stage': name,
+                'seconds': seconds,
+                'peak_bytes': peak,
+                'rows': int(rows(result))
+            })
+    return report
+
+
+def run(sizes=None, repeat=REPEAT, memory=True):
+    """
+    Measure every stage for every size
+
+    :param sizes:   Names of the sizes to run, DEFAULT_SIZES by default
+
+    :return: A JSON serializable dict of the results with the parameters of
+    the sizes and the versions they were measured with
+    """
+    sizes = sizes or DEFAULT_SIZES
+    report = []
+    for size in sizes:
+        report.extend(benchmark(size, SIZES[size], repeat, memory))
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'versions': {'numpy': np.__version__, 'pandas': pd.__version__},
+        'repeat': repeat,
+        'sizes': {size: SIZES[size] for size in sizes},
+        'results': report
+    }
+
+
+def save_results(path, results):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=2)
+
+
+def load_results(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def compare_results(baseline, results, time_tolerance=TIME_TOLERANCE,
+                    min_seconds=MIN_SECONDS,
+                    memory_tolerance=MEMORY_TOLERANCE, min_bytes=MIN_BYTES):
+    """
+    Compare results to a baseline, only sizes that were generated with the
+    same parameters in both are compared
+
+    :return: A DataFrame with the seconds and peak bytes of every stage in
+    the baseline and the results, their ratios and whether they regressed
+    """
+    comparable = [
+        size for size, parameters in results['sizes'].items()
+        if baseline['sizes'].get(size) == parameters
+    ]
+    columns = ['size', 'stage', 'seconds', 'peak_bytes']
+    before = pd.DataFrame(baseline['results'], columns=columns)
+    after = pd.DataFrame(results['results'], columns=columns)
+    comparison = before[before['size'].isin(comparable)].merge(
+        after, on=['size', 'stage'], suffixes=('_baseline', '')
+    )
+    comparison['time_ratio'] = \
+        comparison.seconds / comparison.seconds_baseline
+    comparison['time_regression'] = (
+        (comparison.time_ratio > 1 + time_tolerance) &
+        (comparison.seconds - comparison.seconds_baseline > min_seconds)
+    )
+    peak = comparison.peak_bytes.astype(float)
+    peak_baseline = comparison.peak_bytes_baseline.astype(float)
+    comparison['memory_ratio'] = peak / peak_baseline
+    comparison['memory_regression'] = (
+        (comparison.memory_ratio > 1 + memory_tolerance) &
+        (peak - peak_baseline > min_bytes)
+    )
+    comparison['regression'] = \
+        comparison.time_regression | comparison.memory_regression
+    return comparison
+
+
+def print_results(results):
+    print('{:<8}{:<26}{:>10}{:>12}{:>12}'.format(
+        'size', 'stage', 'seconds', 'megabytes', 'rows'
+    ))
+    for row in results['results']:
+        megabytes = row['peak_bytes'] / (1 << 20) \
+            if row['peak_bytes'] is not None else float('nan')
+        print('{:<8}{:<26}{:>10.3f}{:>12.1f}{:>12}'.format(
+            row['size'], row['stage'], row['seconds'], megabytes, row['rows']
+        ))
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else 'run'
+    sizes = sys.argv[2:] or None
+    if command not in ('run', 'baseline', 'compare') or \
+            not set(sizes or []) <= set(SIZES):
+        print('Usage: python benchmark.py [run|baseline|compare] '
+              '[{}]'.format('|'.join(SIZES)))
+        sys.exit(2)
+
+    results = run(sizes)
+    print_results(results)
+    save_results(BASELINE_PATH if command == 'baseline' else RESULTS_PATH,
+                 results)
+    if command == 'compare':
+        comparison = compare_results(load_results(BASELINE_PATH), results)
+        print(comparison[[
+            'size', 'stage', 'seconds_baseline', 'seconds', 'time_ratio',
+            'memory_ratio', 'regression'
+        ]].to_string(index=False))
+        if comparison.regression.any():
+            sys.exit(1)
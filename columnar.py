@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# A columnar on disk store for the parsed scraper data. Every column of a data
+# frame is saved as NumPy arrays in a directory so that it can be loaded
+# without parsing text:
+#   * numeric and boolean columns as a single array, memory mapped on load
+#   * string columns as a utf-8 blob with character offsets and a null mask
+#   * list columns as row offsets into flattened string fields, one field per
+#     position in the list items, e.g. 2 fields for [id, name] pairs
+
+META_FILE = 'meta.json'
+
+
+def file_hash(path):
+    """
+    Get a hash of the contents of a file, used to invalidate stores that were
+    written from an older version of that file
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def write_frame(df, directory, source_hash, list_columns=()):
+    """
+    Write a data frame to a columnar store
+
+    :param df:              The data frame to store
+    :param directory:       Directory of the store, created if it is missing
+    :param source_hash:     Hash of the source the data frame was parsed from
+    :param list_columns:    Columns containing lists of strings or lists of
+                            lists of strings
+    """
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    columns = []
+    for name, values in [(df.index.name, df.index)] + list(df.items()):
+        path = os.path.join(directory, '{}-{}'.format(len(columns), name))
+        if name in list_columns:
+            kind, arity = 'list', write_list_column(values, path)
+        elif values.dtype == object:
+            kind, arity = 'string', None
+            write_string_column(values, path)
+        else:
+            kind, arity = 'numeric', None
+            np.save(path + '.npy', np.asarray(values))
+        columns.append({'name': name, 'kind': kind, 'arity': arity})
+
+    # the metadata is written last so that partially written stores are stale
+    with open(meta_path, 'w') as fp:
+        json.dump({'source_hash': source_hash, 'columns': columns}, fp)
+
+
+def read_frame(directory, source_hash=None):
+    """
+    Read a data frame from a columnar store
+
+    :param directory:   Directory of the store
+    :param source_hash: If given the store is only read if it was written from
+                        a source with the same hash
+
+    :return: The data frame, with the first column as its index, or None if the
+    store does not exist or is stale
+    """
+    meta = read_meta(directory, source_hash)
+    if meta is None:
+        return None
+
+    data = {}
+    for position, column in enumerate(meta['columns']):
+        path = os.path.join(
+            directory, '{}-{}'.format(position, column['name'])
+        )
+        if column['kind'] == 'list':
+            data[column['name']] = read_list_column(path, column['arity'])
+        elif column['kind'] == 'string':
+            data[column['name']] = read_string_column(path)
+        else:
+            data[column['name']] = np.load(path + '.npy', mmap_mode='r')
+
+    index = meta['columns'][0]['name']
+    df = pd.DataFrame(data, columns=[c['name'] for c in meta['columns']])
+    return df.set_index(index)
+
+
+def read_list_fields(directory, name, source_hash=None):
+    """
+    Read a single list column from a columnar store without building the
+    lists, e.g. to normalize it into its own table
+
+    :param directory:   Directory of the store
+    :param name:        Name of the list column
+    :param source_hash: If given the store is only read if it was written from
+                        a source with the same hash
+
+    :return: A tuple of the index, the row offsets into the fields and a list
+    of the flattened fields, or None if the store does not exist or is stale
+    """
+    meta = read_meta(directory, source_hash)
+    if meta is None:
+        return None
+
+    path = os.path.join(directory, '0-{}'.format(meta['columns'][0]['name']))
+    index = np.load(path + '.npy', mmap_mode='r')
+    for position, column in enumerate(meta['columns']):
+        if column['name'] == name and column['kind'] == 'list':
+            path = os.path.join(directory, '{}-{}'.format(position, name))
+            row_offsets = np.load(path + '.rows.npy')
+            if column['arity'] == 0:
+                fields = [read_string_column(path)]
+            else:
+                fields = [
+                    read_string_column('{}.{}'.format(path, field))
+                    for field in range(column['arity'])
+                ]
+            return index, row_offsets, fields
+    raise KeyError(name)
+
+
+def read_meta(directory, source_hash=None):
+    """
+    Read the metadata of a columnar store
+
+    :return: The metadata or None if the store does not exist or is stale
+    """
+    try:
+        with open(os.path.join(directory, META_FILE)) as fp:
+            meta = json.load(fp)
+    except (IOError, ValueError):
+        return None
+    if source_hash is not None and meta['source_hash'] != source_hash:
+        return None
+    return meta
+
+
+def write_string_column(values, path):
+    """
+    Save strings as a utf-8 blob with offsets, missing values are kept in a
+    separate mask
+    """
+    nulls = np.asarray(pd.isna(values), dtype=bool)
+    strings = ['' if null else value for value, null in zip(values, nulls)]
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in strings], out=offsets[1:])
+    blob = np.frombuffer(''.join(strings).encode('utf-8'), dtype=np.uint8)
+
+    np.save(path + '.npy', blob)
+    np.save(path + '.offsets.npy', offsets)
+    np.save(path + '.nulls.npy', nulls)
+
+
+def read_string_column(path):
+    """
+    Load a string column saved by write_string_column into an object array
+    """
+    text = np.load(path + '.npy', mmap_mode='r').tobytes().decode('utf-8')
+    offsets = np.load(path + '.offsets.npy').tolist()
+    nulls = np.load(path + '.nulls.npy')
+    strings = np.array(
+        [text[start:end] for start, end in zip(offsets[:-1], offsets[1:])],
+        dtype=object
+    )
+    strings[nulls] = np.nan
+    return strings
+
+
+def write_list_column(values, path):
+    """
+    Save a column of lists as row offsets into flattened string fields
+
+    :return: The number of fields in every item, 0 if items are plain strings
+    """
+    items = [item for row in values for item in row]
+    arity = len(items[0]) if items and isinstance(items[0], list) else 0
+    row_offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in values], out=row_offsets[1:])
+
+    np.save(path + '.rows.npy', row_offsets)
+    if arity == 0:
+        write_string_column(items, path)
+    for field in range(arity):
+        write_string_column(
+            [item[field] for item in items], '{}.{}'.format(path, field)
+        )
+    return arity
+
+
+def read_list_column(path, arity):
+    """
+    Load a list column saved by write_list_column into an object array of
+    lists
+    """
+    row_offsets = np.load(path + '.rows.npy').tolist()
+    if arity == 0:
+        items = read_string_column(path).tolist()
+    else:
+        items = [list(item) for item in zip(*[
+            read_string_column('{}.{}'.format(path, field)).tolist()
+            for field in range(arity)
+        ])]
+
+    rows = np.empty(len(row_offsets) - 1, dtype=object)
+    rows[:] = [
+        items[start:end]
+        for start, end in zip(row_offsets[:-1], row_offsets[1:])
+    ]
+    return rows
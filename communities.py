@@ -0,0 +1,217 @@
+from itertools import repeat
+import numpy as np
+from scipy import sparse
+
+# Community detection on a CSR adjacency matrix with the Louvain method.
+# Nodes are moved between communities in a seeded random order, keeping the
+# move with the largest modularity gain, and the communities are then merged
+# into single nodes of a smaller graph until no move improves modularity.
+# Detection can be warm started from an earlier partition, e.g. of the same
+# graph before a few nodes changed, instead of from singleton communities.
+#
+# https://en.wikipedia.org/wiki/Louvain_method
+
+
+def csr_adjacency(sources, targets, weights, n):
+    """
+    Build a symmetric adjacency matrix from undirected weighted edges
+
+    :param sources: Node positions of the sources of the edges
+    :param targets: Node positions of the targets of the edges
+    :param weights: Weights of the edges
+    :param n:       Number of nodes
+
+    :return: An n x n CSR matrix with the weight of every edge in both
+    directions
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float64)
+    adjacency = sparse.coo_matrix(
+        (
+            np.concatenate([weights, weights]),
+            (
+                np.concatenate([sources, targets]),
+                np.concatenate([targets, sources])
+            )
+        ),
+        shape=(n, n)
+    ).tocsr()
+    adjacency.sum_duplicates()
+    return adjacency
+
+
+def modularity(adjacency, labels, resolution=1.0):
+    """
+    Modularity of a partition of a graph, the same value as
+    community_louvain.modularity for a graph without self loops
+    """
+    degrees = np.asarray(adjacency.sum(axis=1)).ravel()
+    total = degrees.sum()
+    if total == 0:
+        return 0.0
+    coo = adjacency.tocoo()
+    same = labels[coo.row] == labels[coo.col]
+    internal = np.bincount(
+        labels[coo.row[same]], coo.data[same], minlength=labels.max() + 1
+    )
+    community_degrees = np.bincount(labels, degrees)
+    return float(np.sum(
+        internal / total - resolution * (community_degrees / total) ** 2
+    ))
+
+
+def louvain(adjacency, resolution=1.0, seed=0, initial=None):
+    """
+    Find communities in a graph with the Louvain method
+
+    :param adjacency:   Symmetric CSR adjacency matrix
+    :param resolution:  Higher resolutions give more and smaller communities
+    :param seed:        Seed for the order in which nodes are moved
+    :param initial:     Community of every node to start from, None to start
+                        with every node in its own community
+
+    :return: An array with the community of every node, numbered in order of
+    the first node of every community
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.arange(adjacency.shape[0])
+    graph = sparse.csr_matrix(adjacency, dtype=np.float64)
+    while graph.shape[0]:
+        communities = move_nodes(graph, resolution, rng, initial)
+        initial = None
+        _, communities = np.unique(communities, return_inverse=True)
+        if communities.max() + 1 == graph.shape[0]:
+            break
+        labels = communities[labels]
+        membership = sparse.csr_matrix(
+            (np.ones(len(communities)), (np.arange(len(communities)),
+                                         communities))
+        )
+        graph = (membership.T @ graph @ membership).tocsr()
+    return renumber(labels)
+
+
+def move_nodes(graph, resolution, rng, initial=None):
+    """
+    Move nodes to the community of a neighbour while that increases modularity
+
+    :param initial: Community of every node to start from, if any
+
+    :return: An array with the community of every node
+    """
+    n = graph.shape[0]
+    degrees = np.asarray(graph.sum(axis=1)).ravel()
+    total = degrees.sum()
+    communities = np.arange(n) if initial is None else \
+        np.unique(initial, return_inverse=True)[1].ravel()
+    community_degrees = np.bincount(communities, degrees, minlength=n)
+    if total == 0:
+        return communities
+    sizes = np.bincount(communities, minlength=n)
+    # labels of empty communities that a node can move to on its own
+    empty = np.flatnonzero(sizes == 0).tolist()
+
+    indptr, indices, data = graph.indptr, graph.indices, graph.data
+    moved = True
+    while moved:
+        moved = False
+        for node in rng.permutation(n):
+            neighbours = indices[indptr[node]:indptr[node + 1]]
+            weights = data[indptr[node]:indptr[node + 1]]
+            others = neighbours != node
+            neighbours, weights = neighbours[others], weights[others]
+
+            current = communities[node]
+            community_degrees[current] -= degrees[node]
+            sizes[current] -= 1
+            candidates, positions = np.unique(
+                communities[neighbours], return_inverse=True
+            )
+            links = np.bincount(positions, weights)
+            gains = links - resolution * community_degrees[candidates] * \
+                degrees[node] / total
+
+            # the current community can hold none of the neighbours of a node
+            # when starting from an earlier partition
+            in_current = np.flatnonzero(candidates == current)
+            best_gain = gains[in_current[0]] if len(in_current) else \
+                -resolution * community_degrees[current] * degrees[node] / \
+                total
+            best = current
+            if len(gains) and gains.max() > best_gain + 1e-12:
+                best, best_gain = candidates[np.argmax(gains)], gains.max()
+            # a community of its own has no links and no other degrees
+            if sizes[current] and best_gain < -1e-12:
+                best = empty.pop()
+            if best != current:
+                moved = True
+                if not sizes[current]:
+                    empty.append(current)
+            communities[node] = best
+            community_degrees[best] += degrees[node]
+            sizes[best] += 1
+    return communities
+
+
+def renumber(labels):
+    """
+    Number communities in order of their first node
+    """
+    _, first, inverse = np.unique(
+        labels, return_index=True, return_inverse=True
+    )
+    order = np.argsort(np.argsort(first))
+    return order[inverse]
+
+
+def leiden(adjacency, resolution=1.0, seed=0, initial=None):
+    """
+    Find communities in a graph with the Leiden method, requires the optional
+    leidenalg and python-igraph packages
+    """
+    import igraph
+    import leidenalg
+
+    coo = sparse.triu(adjacency).tocoo()
+    graph = igraph.Graph(
+        n=adjacency.shape[0], edges=list(zip(coo.row.tolist(),
+                                             coo.col.tolist()))
+    )
+    partition = leidenalg.find_partition(
+        graph,
+        leidenalg.RBConfigurationVertexPartition,
+        weights=coo.data.tolist(),
+        resolution_parameter=resolution,
+        initial_membership=None if initial is None else
+        np.unique(initial, return_inverse=True)[1].ravel().tolist(),
+        seed=seed
+    )
+    return renumber(np.asarray(partition.membership))
+
+
+def best_partition(adjacency, seeds=(0,), resolution=1.0, method='louvain',
+                   executor=None, initial=None):
+    """
+    Find communities with several seeds and keep the partition with the
+    highest modularity, ties go to the earliest seed
+
+    :param adjacency:   Symmetric CSR adjacency matrix
+    :param seeds:       Seeds to run the community detection with
+    :param resolution:  Higher resolutions give more and smaller communities
+    :param method:      'louvain' or 'leiden'
+    :param executor:    Executor to run the seeds in parallel with, if any
+    :param initial:     Community of every node to warm start from, if any
+
+    :return: A tuple of the communities of every node and their modularity
+    """
+    detect = {'louvain': louvain, 'leiden': leiden}[method]
+    map_ = map if executor is None else executor.map
+    partitions = list(
+        map_(detect, repeat(adjacency), repeat(resolution), seeds,
+             repeat(initial))
+    )
+
+    scores = [modularity(adjacency, p, resolution) for p in partitions]
+    best = int(np.argmax(scores))
+    return partitions[best], scores[best]
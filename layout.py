@@ -0,0 +1,183 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Settled positions of the clubs in the cluster chart, precomputed so that the
+# browser does not have to run the force simulation from scratch. This is a
+# vectorised version of the simulation in src/charts/ClusterChart.js: nodes
+# start on a circle by community, are pulled to the centre and to the largest
+# club of their community, and a collision force that is ramped up pushes
+# overlapping clubs apart.
+#
+# Positions are in units of the radius scale of the chart, the chart
+# multiplies them by the scale of its viewport, min(width, height) / factor.
+
+# The factor of every viewport class, see ClusterChart.calculateRadius
+VIEWPORT_FACTORS = {'desktop': 800, 'mobile': 500}
+
+# d3-force defaults, 300 ticks until alpha reaches its minimum of 0.001
+TICKS = 300
+ALPHA_DECAY = 1 - 0.001 ** (1 / TICKS)
+VELOCITY_DECAY = 0.6
+# ticks over which the collision force is ramped up, ClusterChart.decay does
+# this over three seconds, about 180 frames
+RAMP_TICKS = 180
+
+
+def node_radius(followers):
+    """
+    Radius of clubs in units of the radius scale, see
+    ClusterChart.calculateRadius
+    """
+    followers = np.asarray(followers, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        radius = 12 * np.log(np.sqrt(followers))
+    return np.nan_to_num(np.clip(radius, 0, None))
+
+
+def cluster_leaders(groups, radius):
+    """
+    Get the largest node of every community, the first one on ties
+
+    :return: An array with the position of the leader of every node
+    """
+    order = np.lexsort((np.arange(len(groups)), -radius, groups))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = groups[order][1:] != groups[order][:-1]
+    leaders = np.empty(len(groups), dtype=np.int64)
+    starts = np.flatnonzero(first)
+    sizes = np.diff(np.append(starts, len(order)))
+    leaders[order] = np.repeat(order[starts], sizes)
+    return leaders
+
+
+def force_layout(radius, groups, circle_radius, padding=1, ticks=TICKS,
+                 ramp_ticks=RAMP_TICKS, seed=0):
+    """
+    Run the cluster chart simulation until it settles
+
+    :param radius:          Radius of every node
+    :param groups:          Community of every node
+    :param circle_radius:   Radius of the circle that nodes start on
+    :param padding:         Minimum distance between nodes
+    :param ticks:           Number of ticks to simulate
+    :param ramp_ticks:      Number of ticks over which the collision force is
+                            ramped up, after which the centre forces are
+                            removed and the cluster force is weakened
+    :param seed:            Seed for the jitter of the starting positions
+
+    :return: An n x 2 array with the position of every node relative to the
+    centre of the layout
+    """
+    rng = np.random.default_rng(seed)
+    radius = np.asarray(radius, dtype=np.float64)
+    groups = np.asarray(groups, dtype=np.int64)
+    n = len(radius)
+    if n == 0:
+        return np.zeros((0, 2))
+
+    # ClusterChart divides by the largest community, which puts the first and
+    # last communities in the same place, so this divides by their number
+    angle = groups / (groups.max() + 1) * 2 * np.pi
+    position = np.column_stack([np.cos(angle), np.sin(angle)]) * \
+        circle_radius + rng.random((n, 2))
+    velocity = np.zeros((n, 2))
+    leaders = cluster_leaders(groups, radius)
+    followers = leaders != np.arange(n)
+    collide_radius = radius + padding
+    alpha = 1.0
+
+    for tick in range(ticks):
+        alpha += -alpha * ALPHA_DECAY
+        settled = tick >= ramp_ticks
+
+        if not settled:
+            # centre, x and y forces
+            position -= position.mean(axis=0)
+            velocity -= position * 0.01 * alpha
+
+        # pull nodes to the edge of the leader of their community
+        strength = (0.1 if settled else 0.5) * alpha * alpha
+        delta = position - position[leaders]
+        distance = np.hypot(delta[:, 0], delta[:, 1])
+        moving = followers & (distance > 0)
+        move = delta[moving] * (
+            (distance[moving] - radius[moving] - radius[leaders[moving]]) /
+            distance[moving] * strength
+        )[:, None]
+        position[moving] -= move
+        # d3 moves the leader after every follower, which is sequential, so
+        # leaders are moved by the mean pull of their followers instead
+        pull = np.zeros((n, 2))
+        np.add.at(pull, leaders[moving], move)
+        counts = np.bincount(leaders[moving], minlength=n)[:, None]
+        position += pull / np.maximum(counts, 1)
+
+        # push overlapping nodes apart, weighted by their areas
+        strength = min(tick / ramp_ticks, 1.0) ** 2
+        predicted = position + velocity
+        pairs = cKDTree(predicted).query_pairs(
+            2 * collide_radius.max(), output_type='ndarray'
+        )
+        if strength and len(pairs):
+            i, j = pairs[:, 0], pairs[:, 1]
+            delta = predicted[i] - predicted[j]
+            distance = np.hypot(delta[:, 0], delta[:, 1])
+            overlap = collide_radius[i] + collide_radius[j]
+            close = distance < overlap
+            i, j, delta = i[close], j[close], delta[close]
+            distance, overlap = distance[close], overlap[close]
+            # nodes on top of each other are pushed apart in a random direction
+            same = distance == 0
+            delta[same] = rng.random((same.sum(), 2)) - 0.5
+            distance[same] = np.hypot(delta[same, 0], delta[same, 1])
+
+            push = delta * (
+                (overlap - distance) / distance * strength
+            )[:, None]
+            area_i, area_j = collide_radius[i] ** 2, collide_radius[j] ** 2
+            weight = (area_j / (area_i + area_j))[:, None]
+            np.add.at(velocity, i, push * weight)
+            np.add.at(velocity, j, -push * (1 - weight))
+
+        velocity *= VELOCITY_DECAY
+        position += velocity
+
+    return position - position.mean(axis=0)
+
+
+def cluster_layouts(nodes, viewports=None, seed=0):
+    """
+    Compute the settled cluster chart layout for every viewport class
+
+    :param nodes:       Nodes with followers and group attributes
+    :param viewports:   Dict of the radius scale factor of every viewport
+                        class, defaults to VIEWPORT_FACTORS
+
+    :return: A dict of n x 2 float32 arrays of positions by viewport class
+    """
+    viewports = viewports or VIEWPORT_FACTORS
+    radius = node_radius([node['followers'] for node in nodes])
+    groups = np.asarray([node['group'] for node in nodes], dtype=np.int64)
+    return {
+        name: force_layout(radius, groups, factor / 2, seed=seed).astype(
+            np.float32
+        )
+        for name, factor in viewports.items()
+    }
+
+
+def overlap(position, radius, padding=1):
+    """
+    Largest overlap between any two nodes of a layout, 0 if no nodes overlap
+    """
+    collide_radius = np.asarray(radius) + padding
+    pairs = cKDTree(position).query_pairs(
+        2 * collide_radius.max(), output_type='ndarray'
+    )
+    if not len(pairs):
+        return 0.0
+    i, j = pairs[:, 0], pairs[:, 1]
+    distance = np.hypot(*(position[i] - position[j]).T)
+    return float(np.clip(
+        collide_radius[i] + collide_radius[j] - distance, 0, None
+    ).max())
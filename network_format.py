@@ -0,0 +1,291 @@
+import gzip
+import hashlib
+import json
+import os
+import numpy as np
+
+# A compact binary format for the networks that the frontend loads, decoded
+# by src/networkFormat.js. Artist names are kept once in a string table that
+# the artists of the nodes point into, as utf-8 names separated by newlines,
+# links and artists are stored as typed arrays:
+#
+#   'CLUB' | uint32 version | uint32 header length | JSON header | arrays
+#
+# The header holds the scalar node attributes as columns, the ids of artists
+# whose id is not their slugified name, and the offset, length and type of
+# every array. Offsets are relative to the first 8 byte aligned position after
+# the header, arrays are little endian and aligned to 8 bytes so that they can
+# be viewed as typed arrays without copying. Precomputed layouts of the nodes
+# are kept as float32 arrays of x, y pairs named layout_<viewport class>.
+#
+# Networks can also be split into a core file with the node attributes and
+# links and detail shards with the artists of the nodes of every community, so
+# that the artists are only loaded when a club is opened. Shards are named by
+# the hash of their contents and can be cached indefinitely.
+
+MAGIC = b'CLUB'
+VERSION = 1
+ALIGNMENT = 8
+
+
+def encode_network(d, artist_name_to_ids, metadata=None, layouts=None):
+    """
+    Encode a network in the binary format
+
+    :param d:                   Node link data of the network, see
+                                json_graph.node_link_data
+    :param artist_name_to_ids:  Ids of artists whose id is not their name
+    :param metadata:            JSON serializable dict to keep in the header,
+                                e.g. the shards of a core file
+    :param layouts:             Dict of n x 2 arrays of node positions by
+                                viewport class, see layout.cluster_layouts
+
+    :return: The encoded network as bytes
+    """
+    nodes, links = d['nodes'], d['links']
+    node_keys = [key for key in nodes[0].keys() if key != 'artists'] \
+        if nodes else []
+    positions = {node['id']: position for position, node in enumerate(nodes)}
+
+    strings, string_positions = [], {}
+    offsets, artists, counts = [0], [], []
+    for node in nodes:
+        for name, count in node.get('artists', {}).items():
+            if name not in string_positions:
+                string_positions[name] = len(strings)
+                strings.append(name)
+            artists.append(string_positions[name])
+            counts.append(count)
+        offsets.append(len(artists))
+
+    arrays = {
+        'link_sources': smallest_uint(
+            [positions[link['source']] for link in links]
+        ),
+        'link_targets': smallest_uint(
+            [positions[link['target']] for link in links]
+        ),
+        'link_weights': np.asarray(
+            [link['weight'] for link in links], dtype='<f4'
+        ),
+        'artist_offsets': smallest_uint(offsets),
+        'artist_strings': smallest_uint(artists),
+        'artist_counts': smallest_uint(counts),
+        'strings': np.frombuffer(
+            '\n'.join(strings).encode('utf-8'), dtype=np.uint8
+        ),
+    }
+    for name, positions in (layouts or {}).items():
+        arrays['layout_' + name] = np.asarray(positions, dtype='<f4').ravel()
+
+    header = {
+        'directed': d.get('directed', False),
+        'multigraph': d.get('multigraph', False),
+        'graph': d.get('graph', {}),
+        'node_keys': node_keys,
+        'nodes': {
+            key: [json_value(node[key]) for node in nodes] for key in node_keys
+        },
+        'artist_ids': {
+            str(string_positions[name]): artist_id
+            for name, artist_id in artist_name_to_ids.items()
+            if name in string_positions
+        },
+        'metadata': metadata or {},
+        'arrays': {}
+    }
+    if layouts:
+        header['layouts'] = list(layouts)
+
+    blobs = []
+    offset = 0
+    for name, values in arrays.items():
+        header['arrays'][name] = [offset, len(values), values.dtype.name]
+        blobs.append(values.tobytes().ljust(align(values.nbytes), b'\0'))
+        offset += len(blobs[-1])
+    encoded = json.dumps(header, separators=(',', ':')).encode('utf-8')
+
+    return b''.join([
+        MAGIC,
+        np.array([VERSION, len(encoded)], dtype='<u4').tobytes(),
+        encoded.ljust(align(12 + len(encoded)) - 12, b' ')
+    ] + blobs)
+
+
+def decode_network(data):
+    """
+    Decode a network from the binary format, the Python counterpart of
+    decodeNetwork in src/networkFormat.js
+
+    :return: A dict with the directed, multigraph and graph attributes, nodes
+    and links as lists of dicts, artist_names_to_ids and metadata. Nodes of
+    networks with layouts have a dict of their [x, y] by viewport class.
+    """
+    if data[:4] != MAGIC:
+        raise ValueError('Not a network file')
+    version, header_length = np.frombuffer(data, dtype='<u4', count=2,
+                                           offset=4)
+    if version != VERSION:
+        raise ValueError('Unsupported network file version {}'.format(version))
+    header = json.loads(data[12:12 + header_length].decode('utf-8'))
+    start = align(12 + int(header_length))
+    arrays = {
+        name: np.frombuffer(data, dtype=np.dtype(dtype).newbyteorder('<'),
+                            count=length, offset=start + offset)
+        for name, (offset, length, dtype) in header['arrays'].items()
+    }
+
+    strings = arrays['strings'].tobytes().decode('utf-8').split('\n')
+    offsets = arrays['artist_offsets'].tolist()
+    artists = arrays['artist_strings'].tolist()
+    counts = arrays['artist_counts'].tolist()
+    columns = header['nodes']
+    layouts = {
+        name: arrays['layout_' + name].reshape(-1, 2).tolist()
+        for name in header.get('layouts', [])
+    }
+    nodes = []
+    for position in range(len(offsets) - 1):
+        node = {key: columns[key][position] for key in header['node_keys']}
+        node['artists'] = {
+            strings[artists[i]]: counts[i]
+            for i in range(offsets[position], offsets[position + 1])
+        }
+        if layouts:
+            node['layouts'] = {
+                name: positions[position]
+                for name, positions in layouts.items()
+            }
+        nodes.append(node)
+
+    names = columns.get('id', [])
+    links = [
+        {'weight': weight, 'source': names[source], 'target': names[target]}
+        for weight, source, target in zip(
+            arrays['link_weights'].tolist(),
+            arrays['link_sources'].tolist(),
+            arrays['link_targets'].tolist()
+        )
+    ]
+    return {
+        'directed': header['directed'],
+        'multigraph': header['multigraph'],
+        'graph': header['graph'],
+        'nodes': nodes,
+        'links': links,
+        'artist_names_to_ids': {
+            strings[int(position)]: artist_id
+            for position, artist_id in header['artist_ids'].items()
+        },
+        'metadata': header.get('metadata', {})
+    }
+
+
+def write_network(path, d, artist_name_to_ids, layouts=None):
+    """
+    Write a network in the binary format with gzip and, if the brotli package
+    is installed, brotli compressed copies next to it
+
+    :return: The encoded network
+    """
+    data = encode_network(d, artist_name_to_ids, layouts=layouts)
+    write_file(path, data)
+    return data
+
+
+def write_sharded_network(path, shard_directory, d, artist_name_to_ids,
+                          key='group', layouts=None):
+    """
+    Write a network as a core file without the artists of the nodes and a
+    shard with the artists of every community. The shards are named by the
+    sha1 of their contents and shards of earlier builds are removed.
+
+    :param path:                Path of the core file
+    :param shard_directory:     Directory to write the shards to
+    :param d:                   Node link data of the network
+    :param artist_name_to_ids:  Ids of artists whose id is not their name
+    :param key:                 Node attribute to shard the nodes by
+    :param layouts:             Node positions to keep in the core file
+
+    :return: A dict of the path of every shard, relative to the directory of
+    the core file, by the value of the key
+    """
+    communities = {}
+    for node in d['nodes']:
+        communities.setdefault(str(node[key]), []).append(
+            {'id': node['id'], 'artists': node.get('artists', {})}
+        )
+
+    os.makedirs(shard_directory, exist_ok=True)
+    shards, names = {}, set()
+    for community, nodes in sorted(communities.items()):
+        data = encode_network(
+            {'nodes': nodes, 'links': []}, artist_name_to_ids
+        )
+        name = '{}.bin'.format(hashlib.sha1(data).hexdigest()[:16])
+        write_file(os.path.join(shard_directory, name), data)
+        names.add(name)
+        shards[community] = os.path.relpath(
+            os.path.join(shard_directory, name), os.path.dirname(path)
+        ).replace(os.sep, '/')
+
+    for entry in os.scandir(shard_directory):
+        if entry.name.split('.')[0] + '.bin' not in names:
+            os.remove(entry.path)
+
+    core = dict(d, nodes=[
+        {k: v for k, v in node.items() if k != 'artists'}
+        for node in d['nodes']
+    ])
+    write_file(path, encode_network(core, {}, {'shards': shards}, layouts))
+    return shards
+
+
+def write_file(path, data):
+    """
+    Write data with every available compression next to it
+    """
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    for extension, compressed in compressed_variants(data).items():
+        with open(path + extension, 'wb') as fp:
+            fp.write(compressed)
+
+
+def compressed_variants(data):
+    """
+    Compress data with every available compression
+
+    :return: A dict of the compressed data by file extension
+    """
+    variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+        variants['.br'] = brotli.compress(data)
+    except ImportError:
+        pass
+    return variants
+
+
+def smallest_uint(values):
+    """
+    Get values as an array of the smallest unsigned integer type that holds
+    them
+    """
+    values = np.asarray(values, dtype=np.int64)
+    maximum = values.max() if len(values) else 0
+    for dtype in ['<u1', '<u2', '<u4']:
+        if maximum <= np.iinfo(dtype).max:
+            return values.astype(dtype)
+    raise ValueError('Values do not fit in 32 bits')
+
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def json_value(value):
+    """
+    Convert NumPy scalars to Python values for the JSON header
+    """
+    return value.item() if isinstance(value, np.generic) else value
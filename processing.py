@@ -1,16 +1,119 @@
 import pandas as pd
 from ast import literal_eval
 from collections import Counter
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import networkx as nx
 from networkx.readwrite import json_graph
+import hashlib
+import inspect
 import json
+import os
 import numpy as np
 import community as community_louvain
-from scipy import stats
+from scipy import sparse, special, stats
+import columnar
+import communities
+import layout
+import network_format
+import runreport
+from communities import best_partition, csr_adjacency
+from stagecache import Stage, StageCache
+from datetime import datetime
+from time import perf_counter
 
 # Processes and parses the raw data from scraper into the networks and data
 # that we want to graph
 
+# Only keep the edges to the most similar clubs of every club, None keeps all
+TOP_K_NEIGHBOURS = None
+# Only keep edges with a Jaccard index above this score
+MIN_SIMILARITY = 0.0
+# Seed for the community detection so that rebuilds give the same groups
+RANDOM_STATE = 0
+# Community detection method, 'louvain' or 'leiden' on a sparse adjacency
+# matrix or 'python-louvain' for community_louvain. Leiden requires the
+# leidenalg and python-igraph packages. The sparse methods are run with
+# COMMUNITY_SEEDS seeds from RANDOM_STATE on, keeping the partition with the
+# highest modularity, higher resolutions give more and smaller groups.
+COMMUNITY_METHOD = 'louvain'
+COMMUNITY_SEEDS = 4
+RESOLUTION = 1.0
+
+# If enabled, the pair scores and communities of every build are kept in
+# NETWORK_STATE_PATH and the next build only scores the pairs of clubs whose
+# artists changed, with the same results as a full build. Warm starting the
+# community detection from the previous communities is faster on large graphs
+# but can find different communities than a full build.
+INCREMENTAL = True
+NETWORK_STATE_PATH = './data/cache/network-{}.npz'
+# Version of the format of the network state, states of another version or
+# scored by other code are ignored
+NETWORK_STATE_VERSION = 1
+# Share of the clubs that can be new or changed for a build to be incremental,
+# above it all pairs are scored again
+INCREMENTAL_MAX_CHANGED = 0.5
+WARM_START_COMMUNITIES = False
+
+# Number of processes to build the networks with, years are processed in
+# parallel and pairs of clubs are split into shards within a year
+WORKERS = 1
+PAIR_SHARDS = 1
+
+NETWORK_PATH = './public/network-{}.json'
+# The compact binary network that the frontend loads, see network_format.py
+NETWORK_BINARY_PATH = './public/network-{}.bin'
+# If enabled the binary network is a core file without the artists of the
+# clubs, which are loaded per community from shards in NETWORK_SHARD_DIRECTORY
+SHARD_NETWORK = True
+NETWORK_SHARD_DIRECTORY = './public/network-{}'
+# If enabled the settled cluster chart layout for every viewport class is
+# precomputed and kept in the binary network, see layout.py
+PRECOMPUTE_LAYOUT = True
+
+# Metrics of clubs whose distribution is compared between every group of the
+# aggregations and all other clubs, with permutation tests if PERMUTATIONS is
+# more than 0, see compare_underlying_distribution
+DISTRIBUTION_METRICS = [
+    'residency_factor', 'artists_per_date', 'attendance_per_date'
+]
+DISTRIBUTION_AGGREGATIONS = ['region', 'country', 'group']
+PERMUTATIONS = 0
+SIGNIFICANCE = 0.01
+
+# If enabled, keep a columnar copy of the parsed date details in ./data/cache
+# that is used until the csv file changes
+USE_DATA_CACHE = True
+DATA_CACHE_PATH = './data/cache/{}'
+
+# If enabled, the outputs of the stages of the pipeline are kept in
+# STAGE_CACHE_PATH and stages whose inputs and parameters did not change are
+# skipped, see stagecache.py. Run python stagecache.py for its hits and misses.
+USE_STAGE_CACHE = True
+STAGE_CACHE_PATH = './data/cache/stages'
+STAGE_CACHE_BYTES = 2 << 30
+
+# If enabled, the wall and cpu time, peak memory and rows of every stage are
+# written to RUN_REPORT_PATH, see runreport.py. Stages named in PROFILE_STAGES,
+# e.g. 'build_graph', are run under cProfile and their profiles are written to
+# PROFILE_PATH.
+RUN_REPORT = True
+RUN_REPORT_PATH = './data/reports/processing-{}.json'
+PROFILE_STAGES = []
+PROFILE_PATH = './data/reports/{}.prof'
+
+# The csv files written by the scraper
+DATA_FILES = {
+    'regions': './data/top-regions.csv',
+    'clubs': './data/top-clubs.csv',
+    'dates': './data/top-clubs-dates.csv',
+    'date_details': './data/date-details-2019.csv',
+}
+
+# Columns of date details that are saved as list representations of lists
+LIST_COLUMNS = ['artists', 'promoters', 'flyers']
+
 
 class NaNCounter(Counter):
     """
@@ -22,53 +125,167 @@ class NaNCounter(Counter):
         super(NaNCounter, self).update(*args, **kwds)
 
 
+class SparseCounter(Mapping):
+    """
+    A read only counter backed by slices of arrays of codes and counts, with
+    the names of the codes shared between all counters built from the same
+    arrays. The counts of many counters can then be used without building a
+    dictionary for each of them.
+    """
+    def __init__(self, codes, counts, names):
+        self.codes = codes
+        self.counts = counts
+        self.names = names
+        self._dict = None
+
+    def to_dict(self):
+        if self._dict is None:
+            self._dict = dict(zip(
+                self.names[self.codes].tolist(), self.counts.tolist()
+            ))
+        return self._dict
+
+    def __getitem__(self, key):
+        return self.to_dict()[key]
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.to_dict())
+
+
 def load_csv_files():
     """
     Loads csv files of all the raw data from the scraper
     """
-    regions = pd.read_csv('./data/top-regions.csv')
-    clubs = pd.read_csv('./data/top-clubs.csv', index_col='id').fillna('')
+    regions = pd.read_csv(DATA_FILES['regions'])
+    clubs = pd.read_csv(DATA_FILES['clubs'], index_col='id').fillna('')
     dates = pd.read_csv(
-        './data/top-clubs-dates.csv',
+        DATA_FILES['dates'],
         index_col='id',
         parse_dates=['date']
     )
 
-    date_details = pd.read_csv(
-        r'./data/date-details-2019.csv',
-        index_col='id',
-        header=0
-    )
-
-    # artists are saved as list representations of lists
-    date_details.artists = date_details.artists.apply(lambda x: literal_eval(x))
+    date_details = load_date_details(DATA_FILES['date_details'])
 
     return regions, clubs, dates, date_details
 
 
+def load_date_details(path):
+    """
+    Loads a date details csv file with its list columns parsed. The parsed
+    data is read from the columnar cache if it was written from the same file.
+    """
+    cache_path = date_details_cache_path(path)
+    if USE_DATA_CACHE:
+        source_hash = columnar.file_hash(path)
+        date_details = columnar.read_frame(cache_path, source_hash)
+        if date_details is not None:
+            return date_details
+
+    date_details = pd.read_csv(path, index_col='id', header=0)
+
+    # lists are saved as list representations of lists
+    for column in LIST_COLUMNS:
+        date_details[column] = date_details[column].apply(literal_eval)
+
+    if USE_DATA_CACHE:
+        columnar.write_frame(
+            date_details, cache_path, source_hash, LIST_COLUMNS
+        )
+    return date_details
+
+
+def date_details_cache_path(path):
+    """
+    Get the path of the columnar cache of a date details csv file
+    """
+    return DATA_CACHE_PATH.format(os.path.splitext(os.path.basename(path))[0])
+
+
 def normalize_artist_data(date_details):
     """
     Normalizes artist data into their own data frame, to be joined on
     event_id
     """
-    artists_to_dates_list = []
-    for date_id, row in date_details.iterrows():
-        for artist_id, artist_name in row['artists']:
-            artists_to_dates_list.append([date_id, artist_id, artist_name])
-
-    artists_to_dates = pd.DataFrame.from_records(
-        artists_to_dates_list,
-        columns=['event_id', 'artist_id','artist_name']
+    artists = date_details['artists'].explode().dropna()
+    artists_to_dates = pd.DataFrame(
+        artists.tolist(),
+        index=artists.index.rename('event_id'),
+        columns=['artist_id', 'artist_name']
     )
-    artists_to_dates = artists_to_dates.set_index('event_id')
 
     return artists_to_dates
 
 
+def normalize_artist_files(paths, chunksize=10000):
+    """
+    Normalizes the artist data of one or more date details csv files into a
+    single data frame, to be joined on event_id
+    """
+    return pd.concat(
+        stream_artist_data(paths, chunksize),
+        sort=False
+    )
+
+
+def stream_artist_data(paths, chunksize=10000):
+    """
+    Normalize the artist data of date details csv files chunk by chunk, so
+    only a chunk of the parsed lists is held in memory at any time. Files
+    with an up to date columnar cache are read from the flattened artist
+    fields in the cache without parsing.
+
+    :param paths:       Paths to date details csv files
+    :param chunksize:   Number of events to parse per chunk
+
+    :return: A generator of artist data frames indexed by event_id
+    """
+    for path in paths:
+        fields = None
+        if USE_DATA_CACHE:
+            fields = columnar.read_list_fields(
+                date_details_cache_path(path),
+                'artists',
+                columnar.file_hash(path)
+            )
+        if fields is not None:
+            index, row_offsets, (artist_ids, artist_names) = fields
+            yield pd.DataFrame(
+                {'artist_id': artist_ids, 'artist_name': artist_names},
+                index=pd.Index(
+                    np.repeat(index, np.diff(row_offsets)), name='event_id'
+                )
+            )
+            continue
+
+        chunks = pd.read_csv(
+            path,
+            index_col='id',
+            usecols=['id', 'artists'],
+            chunksize=chunksize
+        )
+        for chunk in chunks:
+            chunk['artists'] = chunk['artists'].apply(literal_eval)
+            yield normalize_artist_data(chunk)
+
+
 def join_data_frames(regions, clubs, dates, date_details, artists_to_dates):
     """
     Join all the data frames into one big "table"
+
+    String columns are joined as categoricals so that the table only holds
+    integer codes into a single copy of every string.
     """
+    regions = encode_categories(regions, exclude=['region'])
+    clubs = encode_categories(clubs, exclude=['region'])
+    dates = encode_categories(dates)
+    date_details = encode_categories(date_details)
+    artists_to_dates = encode_categories(artists_to_dates)
 
     # join regions and clubs
     regions_top_clubs = regions.join(
@@ -110,21 +327,59 @@ def join_data_frames(regions, clubs, dates, date_details, artists_to_dates):
     return all_data
 
 
+def encode_categories(df, exclude=()):
+    """
+    Convert the string columns of a data frame to categoricals
+
+    :param exclude: Columns to keep as they are, e.g. keys to join on
+    """
+    columns = [
+        column for column in df.columns
+        if df[column].dtype == object and column not in exclude
+        and column not in LIST_COLUMNS
+    ]
+    return df.astype({column: 'category' for column in columns})
+
+
+def decode_categories(df):
+    """
+    Convert the categorical columns and index levels of a data frame back to
+    plain values
+    """
+    columns = [
+        column for column in df.columns
+        if isinstance(df[column].dtype, pd.CategoricalDtype)
+    ]
+    df = df.astype({column: object for column in columns})
+    if isinstance(df.index, pd.MultiIndex):
+        df.index = df.index.set_levels([
+            level.astype(level.categories.dtype)
+            if isinstance(level, pd.CategoricalIndex) else level
+            for level in df.index.levels
+        ])
+    return df
+
+
 def group_by_year_and_club(all_data):
     """
     Group all data by years and clubs
+
+    Categorical columns are grouped on their codes and only decoded for the
+    resulting per club table.
     """
-    all_data['year'] = all_data['date'].map(lambda x: x.year)
+    all_data['year'] = all_data['date'].dt.year
 
     attending = all_data.drop_duplicates(
         'id_date'
     ).groupby(
-        ['year', 'name_club']
+        ['year', 'name_club'], observed=True
     ).agg(
         attending=('attending', 'sum')
     )
 
-    by_year_and_club = all_data.groupby(['year', 'name_club']).agg(
+    by_year_and_club = all_data.groupby(
+        ['year', 'name_club'], observed=True
+    ).agg(
         club_id=('id_club', 'first'),
         region=('name_region', 'first'),
         country=('country', 'first'),
@@ -138,25 +393,718 @@ def group_by_year_and_club(all_data):
         capacity=('capacity', 'first'),
     )
 
-    return by_year_and_club.join(attending)
+    # rows of clubs without dates make attending a float in the joined table
+    attending = attending.fillna(0).astype(np.int64)
+    return decode_categories(by_year_and_club.join(attending)).sort_index()
+
+
+def aggregate_club_data(regions, clubs, dates, date_details,
+                        artists_to_dates):
+    """
+    Compute the same table as group_by_year_and_club on the result of
+    join_data_frames, straight from the normalized data frames. Only the
+    events are joined with the clubs and regions, and only the artists are
+    joined with the events, instead of joining every column onto every artist
+    of every event.
+    """
+    # one row for every region a club is in
+    memberships = regions.join(
+        clubs.reset_index().set_index('region'),
+        on='region',
+        lsuffix='_region',
+        rsuffix='_club',
+        how='inner'
+    ).rename(columns={'id': 'id_club'}).drop_duplicates()
+    memberships['membership'] = np.arange(len(memberships))
+
+    # date details only contain a subset of events (fridays and saturdays)
+    events = dates[dates.index.isin(date_details.index)]
+    events = events[~events.index.duplicated()]
+    events = events.rename_axis('id_date').reset_index()
+    events['year'] = events['date'].dt.year
+    events = events[['id_date', 'year', 'attending', 'club_id']].merge(
+        memberships, left_on='club_id', right_on='id_club'
+    ).sort_values(['id_date', 'membership'], kind='mergesort')
+
+    by_year_and_club = events.groupby(['year', 'name_club']).agg(
+        club_id=('id_club', 'first'),
+        region=('name_region', 'first'),
+        country=('country', 'first'),
+        logo=('img', 'first'),
+        number_of_dates=('id_date', pd.Series.nunique),
+        rank=('rank_club', 'first'),
+        followers=('followers', 'first'),
+        capacity=('capacity', 'first'),
+    )
+    attending = events.drop_duplicates('id_date').groupby(
+        ['year', 'name_club']
+    ).agg(
+        attending=('attending', 'sum')
+    )
+    attending = attending.fillna(0).astype(np.int64)
+
+    # count every distinct artist of an event once for every club row it is
+    # listed under, in the order they appear in the events
+    artists = artists_to_dates.rename_axis('id_date').reset_index()
+    artists = artists.drop_duplicates().dropna(subset=['artist_name'])
+    artists['position'] = np.arange(len(artists))
+    artists = artists.merge(
+        events[['id_date', 'year', 'name_club', 'membership']], on='id_date'
+    ).sort_values(['id_date', 'membership', 'position'], kind='mergesort')
+    artist_counts = count_artists(
+        artists[['year', 'name_club']], artists['artist_name']
+    )
+    by_year_and_club = by_year_and_club.join(artist_counts)
+    by_year_and_club = by_year_and_club.fillna({
+        'number_of_unique_artists': 0,
+        'total_number_of_artists': 0,
+    })
+    if by_year_and_club['artists'].isna().any():
+        empty = SparseCounter(
+            np.array([], dtype=np.int64), np.array([], dtype=np.int64),
+            np.array([], dtype=object)
+        )
+        by_year_and_club['artists'] = [
+            artists if isinstance(artists, SparseCounter) else empty
+            for artists in by_year_and_club['artists']
+        ]
+
+    columns = [
+        'club_id', 'region', 'country', 'logo', 'number_of_dates', 'rank',
+        'number_of_unique_artists', 'total_number_of_artists', 'artists',
+        'followers', 'capacity'
+    ]
+    by_year_and_club = by_year_and_club[columns].astype({
+        'number_of_unique_artists': np.int64,
+        'total_number_of_artists': np.int64
+    })
+    return by_year_and_club.join(attending).sort_index()
+
+
+def count_artists(keys, artist_names):
+    """
+    Count how many times every artist appears for every key with a single
+    grouped count over integer codes
+
+    :param keys:            A data frame of the keys to count for, e.g. year
+                            and club name
+    :param artist_names:    The artist names, one for each row of keys
+
+    :return: A data frame indexed by the unique keys with the number of unique
+    artists, the total number of artists and a SparseCounter of the artists
+    in the order they first appear. All the counters share the same arrays.
+    """
+    key_codes = np.zeros(len(keys), dtype=np.int64)
+    for column in keys.columns:
+        codes, uniques = pd.factorize(keys[column])
+        key_codes = key_codes * len(uniques) + codes
+    key_codes, _ = pd.factorize(key_codes)
+    _, first_rows = np.unique(key_codes, return_index=True)
+    unique_keys = pd.MultiIndex.from_frame(keys.iloc[first_rows])
+    artist_codes, names = pd.factorize(artist_names)
+    names = np.asarray(names, dtype=object)
+
+    pairs, first, counts = np.unique(
+        key_codes.astype(np.int64) * len(names) + artist_codes,
+        return_index=True,
+        return_counts=True
+    )
+    pair_keys = pairs // max(len(names), 1)
+    order = np.lexsort((first, pair_keys))
+    pair_keys, counts = pair_keys[order], counts[order]
+    codes = (pairs % max(len(names), 1))[order]
+
+    indptr = np.zeros(len(unique_keys) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pair_keys, minlength=len(unique_keys)),
+              out=indptr[1:])
+    return pd.DataFrame({
+        'number_of_unique_artists': np.diff(indptr),
+        'total_number_of_artists': np.bincount(
+            pair_keys, weights=counts, minlength=len(unique_keys)
+        ).astype(np.int64),
+        'artists': [
+            SparseCounter(codes[start:end], counts[start:end], names)
+            for start, end in zip(indptr[:-1], indptr[1:])
+        ]
+    }, index=unique_keys)
 
 
-def calculate_club_likeness(club_data):
+def top_club_artists(regions, clubs, dates, artists_to_dates):
+    """
+    Get the artists of all the events at clubs in the top regions, ordered by
+    event like the table from join_data_frames
+    """
+    top_clubs = clubs[clubs.region.isin(regions.region)].index
+    events = dates[dates.club_id.isin(top_clubs)].index
+    return artists_to_dates[
+        artists_to_dates.index.isin(events)
+    ].sort_index(kind='mergesort')
+
+
+def calculate_club_likeness(club_data, approximate=False, bands=64, rows=1,
+                            seed=0, top_k=None, min_score=0.0, shards=1,
+                            executor=None, previous=None, max_changed=0.5):
     """
     Calculate the Jaccard index for each pair of clubs in club data
     return as a list of lists with each list containing:
         [source, target, jaccard_score]
+
+    All pairs are scored in bulk from a sparse club x artist count matrix, see
+    jaccard_index for the reference implementation of the score.
+
+    :param approximate: Only score the candidate pairs found by weighted
+                        MinHash LSH instead of all pairs
+    :param bands:       Number of LSH bands, more bands find more pairs
+    :param rows:        Number of hashes per band, more rows find fewer pairs
+                        with low similarity
+    :param seed:        Seed for the MinHash permutations
+    :param top_k:       Only keep pairs within the top_k most similar clubs of
+                        either club, None keeps all pairs
+    :param min_score:   Only keep pairs with a Jaccard index above min_score
+    :param shards:      Number of shards to split the exact pairs into
+    :param executor:    Executor to score the shards with, if any
+    :param previous:    State of an earlier build, see load_network_state, to
+                        only rescore the pairs of clubs whose artists changed
+    :param max_changed: Share of the clubs that can have changed since the
+                        earlier build for it to be used
+    """
+    pairs = club_pair_scores(
+        club_data, approximate, bands, rows, seed, shards, executor, previous,
+        max_changed
+    )
+    return named_edges(club_data, *sparsify_edges(*pairs, top_k, min_score))
+
+
+def club_pair_scores(club_data, approximate=False, bands=64, rows=1, seed=0,
+                     shards=1, executor=None, previous=None, max_changed=0.5):
+    """
+    Score the pairs of clubs in club data before they are sparsified, see
+    calculate_club_likeness for the parameters
+
+    :return: Arrays of source rows, target rows and scores in the same format
+    as all_pairs_jaccard
+    """
+    counts, artist_names = artist_count_matrix(club_data.artists)
+    if approximate:
+        return lsh_pairs_jaccard(counts, bands, rows, seed)
+    if previous is not None:
+        return incremental_pairs_jaccard(
+            counts,
+            club_data.index.get_level_values(1),
+            club_fingerprints(counts, artist_names),
+            previous, shards, executor, max_changed
+        )
+    return all_pairs_jaccard(counts, shards, executor)
+
+
+def pair_scoring_code():
+    """
+    Get the functions that club_pair_scores calls, whose changes change the
+    scores
+    """
+    return [
+        artist_count_matrix, expand_multisets, all_pairs_jaccard,
+        shard_bounds, shard_intersections, club_fingerprints,
+        incremental_pairs_jaccard, changed_intersections, lsh_pairs_jaccard,
+        lsh_candidate_pairs, pairs_within_groups
+    ]
+
+
+def named_edges(club_data, sources, targets, scores):
+    """
+    Get edges between the rows of club data as (source, target, score) tuples
+    of club names
+    """
+    club_names = club_data.index.get_level_values(1)
+    return list(zip(
+        club_names[sources].tolist(),
+        club_names[targets].tolist(),
+        scores.tolist()
+    ))
+
+
+def artist_count_matrix(artists):
+    """
+    Encode a sequence of artist counters (one per club) into a sparse
+    club x artist matrix of booking counts. SparseCounters built from the
+    same arrays are stacked directly, other counters are encoded one by one.
+
+    :return: A tuple of the csr matrix and the artist names of its columns
+    """
+    artists = list(artists)
+    shared = [
+        counter.names for counter in artists
+        if isinstance(counter, SparseCounter) and len(counter)
+    ]
+    if shared and all(
+        isinstance(counter, SparseCounter)
+        and (counter.names is shared[0] or not len(counter))
+        for counter in artists
+    ):
+        indptr = np.zeros(len(artists) + 1, dtype=np.int64)
+        np.cumsum([len(counter) for counter in artists], out=indptr[1:])
+        counts = sparse.csr_matrix(
+            (
+                np.concatenate([c.counts for c in artists]).astype(np.int64),
+                np.concatenate([c.codes for c in artists]).astype(np.int64),
+                indptr
+            ),
+            shape=(len(artists), len(shared[0]))
+        )
+        return counts, list(shared[0])
+
+    artist_codes = {}
+    rows, cols, values = [], [], []
+    for row, counter in enumerate(artists):
+        for artist, count in counter.items():
+            rows.append(row)
+            cols.append(artist_codes.setdefault(artist, len(artist_codes)))
+            values.append(count)
+
+    counts = sparse.csr_matrix(
+        (
+            np.array(values, dtype=np.int64),
+            (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64))
+        ),
+        shape=(len(artists), len(artist_codes))
+    )
+    return counts, list(artist_codes)
+
+
+def expand_multisets(counts):
+    """
+    Expand a count matrix into a binary matrix with one column per
+    (artist, n) for every n up to the count of that artist, so that the dot
+    product of two rows is the size of the intersection of their multisets
+    """
+    counts = counts.tocoo()
+    values = counts.data.astype(np.int64)
+    column_sizes = np.zeros(counts.shape[1], dtype=np.int64)
+    np.maximum.at(column_sizes, counts.col, values)
+    column_offsets = np.cumsum(column_sizes) - column_sizes
+
+    rows = np.repeat(counts.row, values)
+    starts = np.repeat(np.cumsum(values) - values, values)
+    levels = np.arange(values.sum()) - starts
+    cols = np.repeat(column_offsets[counts.col], values) + levels
+
+    return sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int64), (rows, cols)),
+        shape=(counts.shape[0], column_sizes.sum())
+    )
+
+
+def all_pairs_jaccard(counts, shards=1, executor=None):
+    """
+    Calculate the Jaccard index between all pairs of rows in a count matrix
+    that have at least one entry in common
+
+    :param shards:      Number of row ranges to split the pairs into, each
+                        shard has roughly the same number of pairs
+    :param executor:    Executor to map the shards over, if any
+
+    :return: Arrays of source rows, target rows and scores, ordered by source
+    then target with source < target
+    """
+    expanded = expand_multisets(counts)
+    size = expanded.shape[0]
+    if size < 2:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype=np.float64)
+    bounds = shard_bounds(size, shards)
+    map_shards = executor.map if executor is not None else map
+    shard_pairs = list(map_shards(
+        shard_intersections, repeat(expanded), bounds[:-1], bounds[1:]
+    ))
+    sources = np.concatenate([pairs[0] for pairs in shard_pairs])
+    targets = np.concatenate([pairs[1] for pairs in shard_pairs])
+    intersection = np.concatenate([pairs[2] for pairs in shard_pairs])
+
+    totals = np.asarray(counts.sum(axis=1), dtype=np.int64).ravel()
+    union = totals[sources] + totals[targets] - intersection
+    return sources, targets, intersection / union
+
+
+def club_fingerprints(counts, artist_names):
+    """
+    Fingerprint the artist multiset of every row of a count matrix, rows with
+    the same artists and counts have the same fingerprint
+
+    :return: An array of hex digests
+    """
+    artist_names = np.asarray(artist_names, dtype=object)
+    fingerprints = []
+    for start, end in zip(counts.indptr[:-1], counts.indptr[1:]):
+        items = sorted(zip(
+            artist_names[counts.indices[start:end]].tolist(),
+            counts.data[start:end].tolist()
+        ))
+        fingerprints.append(hashlib.sha1(
+            json.dumps(items, ensure_ascii=False).encode('utf-8')
+        ).hexdigest())
+    return np.array(fingerprints)
+
+
+def incremental_pairs_jaccard(counts, names, fingerprints, previous,
+                              shards=1, executor=None, max_changed=0.5):
+    """
+    Calculate the same pairs as all_pairs_jaccard, reusing the scores of an
+    earlier build for pairs of clubs whose artists did not change. Only the
+    rows of new and changed clubs are multiplied with the other rows. When
+    more than max_changed of the clubs changed, all pairs are scored again.
+
+    :param counts:          Count matrix of the clubs
+    :param names:           Names of the clubs
+    :param fingerprints:    Fingerprints of the clubs, see club_fingerprints
+    :param previous:        State of the earlier build, see load_network_state
+    :param shards:          Number of shards to split the changed rows into
+    :param executor:        Executor to map the shards over, if any
+    :param max_changed:     Share of the clubs that can have changed
+
+    :return: Arrays of source rows, target rows and scores in the same format
+    as all_pairs_jaccard
+    """
+    names = pd.Index(names)
+    positions = names.get_indexer(previous['names'])
+    unchanged = np.zeros(len(names), dtype=bool)
+    kept = positions != -1
+    unchanged[positions[kept]] = \
+        fingerprints[positions[kept]] == previous['fingerprints'][kept]
+    if len(names) and (~unchanged).mean() > max_changed:
+        return all_pairs_jaccard(counts, shards, executor)
+
+    # pairs of unchanged clubs keep their score, in their new positions
+    n = len(names)
+    sources = positions[previous['sources']]
+    targets = positions[previous['targets']]
+    keep = unchanged[sources] & unchanged[targets] & \
+        (sources != -1) & (targets != -1)
+    sources, targets = sources[keep], targets[keep]
+    old_keys = np.minimum(sources, targets) * n + np.maximum(sources, targets)
+    old_scores = previous['scores'][keep]
+    # the pairs are still in order unless clubs were reordered
+    if not np.all(np.diff(positions[kept]) > 0):
+        order = np.argsort(old_keys, kind='stable')
+        old_keys, old_scores = old_keys[order], old_scores[order]
+
+    # every pair with a changed club is scored again
+    changed = np.flatnonzero(~unchanged)
+    expanded = expand_multisets(counts)
+    bounds = shard_bounds(len(changed), shards)
+    map_shards = executor.map if executor is not None else map
+    shard_pairs = list(map_shards(
+        changed_intersections, repeat(expanded), repeat(unchanged),
+        [changed[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+    ))
+    # there are no shards when no club changed
+    rows, cols, intersection = (
+        np.concatenate([np.array([], dtype=np.int64)] + [
+            pairs[i] for pairs in shard_pairs
+        ])
+        for i in range(3)
+    )
+    totals = np.asarray(counts.sum(axis=1), dtype=np.int64).ravel()
+    new_sources, new_targets = np.minimum(rows, cols), np.maximum(rows, cols)
+    new_scores = intersection / (
+        totals[new_sources] + totals[new_targets] - intersection
+    )
+    new_keys = new_sources * n + new_targets
+    order = np.argsort(new_keys)
+    new_keys, new_scores = new_keys[order], new_scores[order]
+
+    # merge the few new pairs into the sorted pairs that were kept
+    insert = np.searchsorted(old_keys, new_keys)
+    keys = np.insert(old_keys, insert, new_keys)
+    scores = np.insert(old_scores, insert, new_scores)
+    return keys // n, keys % n, scores
+
+
+def load_network_state(path):
+    """
+    Load the state of an earlier build that was saved by save_network_state
+    and built by network_state
+
+    :return: A dict with the names and fingerprints of the clubs, the sources,
+    targets and scores of all their pairs and the partition of the clubs, or
+    None if there is no state or it is of another version
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as state:
+        if 'version' not in state.files or \
+                str(state['version']) != network_state_version():
+            return None
+        return {key: state[key] for key in state.files}
+
+
+def network_state_version():
+    """
+    Version of the network state, from NETWORK_STATE_VERSION and the code
+    that fingerprints the clubs and scores their pairs
+    """
+    sources = [
+        inspect.getsource(function) for function in pair_scoring_code()
+    ]
+    return hashlib.sha1(
+        json.dumps([NETWORK_STATE_VERSION] + sources).encode('utf-8')
+    ).hexdigest()
+
+
+def network_state(club_data, pairs, partition):
+    """
+    Get the state of a build that the next incremental build starts from
+
+    :param pairs:       Source rows, target rows and scores of all pairs, see
+                        club_pair_scores
+    :param partition:   Dict of the community of every club
+
+    :return: A dict of arrays, see load_network_state
+    """
+    counts, artist_names = artist_count_matrix(club_data.artists)
+    names = club_data.index.get_level_values(1)
+    sources, targets, scores = pairs
+    return {
+        'version': np.array(network_state_version()),
+        'names': np.array(names, dtype=str),
+        'fingerprints': club_fingerprints(counts, artist_names),
+        'sources': np.asarray(sources, dtype=np.int64),
+        'targets': np.asarray(targets, dtype=np.int64),
+        'scores': np.asarray(scores, dtype=np.float64),
+        'groups': np.array(
+            [partition.get(name, -1) for name in names], dtype=np.int64
+        )
+    }
+
+
+def save_network_state(path, state):
+    """
+    Save the state of a build for the next incremental build
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fp:
+        np.savez(fp, **state)
+
+
+def incremental_report(before, after, repeat=3):
+    """
+    Compare scoring all pairs of clubs with scoring them incrementally from
+    the state of an earlier build
+
+    :param before:  The club data of the earlier build
+    :param after:   The club data to score
+
+    :return: A DataFrame with the seconds taken by each method, the number of
+    pairs and clubs that changed and whether the scores are the same
+    """
+    previous = network_state(before, club_pair_scores(before), {})
+    names = after.index.get_level_values(1)
+    counts, artist_names = artist_count_matrix(after.artists)
+    fingerprints = dict(zip(names, club_fingerprints(counts, artist_names)))
+    changed = len(names) - sum(
+        fingerprints.get(name) == fingerprint for name, fingerprint
+        in zip(previous['names'].tolist(), previous['fingerprints'])
+    )
+
+    report, results = [], {}
+    for method, state in [('full', None), ('incremental', previous)]:
+        start = perf_counter()
+        for _ in range(repeat):
+            results[method] = club_pair_scores(after, previous=state)
+        report.append({
+            'method': method,
+            'seconds': (perf_counter() - start) / repeat,
+            'pairs': len(results[method][0]),
+            'changed_clubs': changed,
+        })
+    report = pd.DataFrame(report)
+    report['identical'] = all(
+        np.array_equal(a, b)
+        for a, b in zip(results['full'], results['incremental'])
+    )
+    return report
+
+
+def shard_bounds(size, shards):
+    """
+    Split rows 0 to size into shards that have roughly the same number of
+    pairs with the rows after them
+
+    :return: An array of the bounds of the shards
+    """
+    return np.unique(np.round(
+        size * (1 - np.sqrt(1 - np.linspace(0, 1, shards + 1)))
+    ).astype(np.int64))
+
+
+def changed_intersections(expanded, unchanged, changed):
     """
-    similarities = []
-    size = len(club_data)
-    for i in range(0, size):
-        club1 = club_data.iloc[i]
-        for j in range(i+1, size):
-            club2 = club_data.iloc[j]
-            similarity = jaccard_index(club1.artists, club2.artists)
-            if similarity > 0:
-                similarities.append((club1.name[1], club2.name[1], similarity))
-    return similarities
+    Calculate the multiset intersections between the changed rows of an
+    expanded multiset matrix and the unchanged rows and changed rows after
+    them, so that every pair is only multiplied once
+
+    :param expanded:    Expanded multiset matrix of all rows
+    :param unchanged:   Boolean array of the rows that did not change
+    :param changed:     Sorted positions of the changed rows of the shard
+
+    :return: Arrays of changed rows, other rows and intersection sizes of the
+    pairs with a non empty intersection
+    """
+    if not len(changed):
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+    others = np.flatnonzero(
+        unchanged | (np.arange(len(unchanged)) > changed[0])
+    )
+    intersections = (expanded[changed] @ expanded[others].T).tocoo()
+    rows = changed[intersections.row]
+    cols = others[intersections.col]
+    # changed rows of the shard also meet each other from both sides
+    new = unchanged[cols] | (rows < cols)
+    return rows[new], cols[new], intersections.data[new].astype(np.int64)
+
+
+def shard_intersections(expanded, start, stop):
+    """
+    Calculate the multiset intersections between rows start to stop of an
+    expanded multiset matrix and all the rows after them
+
+    :return: Arrays of source rows, target rows and intersection sizes of the
+    pairs with a non empty intersection, ordered by source then target
+    """
+    intersections = sparse.triu(
+        expanded[start:stop] @ expanded[start:].T, k=1
+    ).tocoo()
+    order = np.lexsort((intersections.col, intersections.row))
+    return (
+        intersections.row[order].astype(np.int64) + start,
+        intersections.col[order].astype(np.int64) + start,
+        intersections.data[order]
+    )
+
+
+def lsh_pairs_jaccard(counts, bands, rows, seed=0):
+    """
+    Calculate the Jaccard index between the pairs of rows in a count matrix
+    that share a bucket in at least one band of their weighted MinHash
+    signatures. Pairs with similarity s are found with probability
+    1 - (1 - s^rows)^bands.
+
+    :return: Arrays of source rows, target rows and scores in the same format
+    as all_pairs_jaccard
+    """
+    if bands < 1 or rows < 1:
+        raise ValueError(
+            'LSH needs at least one band and one row, got {} bands and {} '
+            'rows'.format(bands, rows)
+        )
+    expanded = expand_multisets(counts)
+    candidates = np.unique(np.concatenate([
+        pairs[0] * expanded.shape[0] + pairs[1]
+        for pairs in lsh_candidate_pairs(expanded, bands, rows, seed)
+    ]))
+    sources = candidates // expanded.shape[0]
+    targets = candidates % expanded.shape[0]
+
+    intersection = np.asarray(
+        expanded[sources].multiply(expanded[targets]).sum(axis=1),
+        dtype=np.int64
+    ).ravel()
+    found = intersection > 0
+    sources, targets = sources[found], targets[found]
+    intersection = intersection[found]
+
+    totals = np.asarray(counts.sum(axis=1), dtype=np.int64).ravel()
+    union = totals[sources] + totals[targets] - intersection
+    return sources, targets, intersection / union
+
+
+def lsh_candidate_pairs(expanded, bands, rows, seed=0):
+    """
+    Generate the candidate pairs of every LSH band of the MinHash signatures
+    of the rows of an expanded multiset matrix. Expanding the multisets makes
+    the MinHash collision probability equal to the weighted Jaccard index.
+
+    :return: A generator of (sources, targets) arrays with source < target
+    """
+    rng = np.random.RandomState(seed)
+    non_empty = np.flatnonzero(np.diff(expanded.indptr))
+    starts = expanded.indptr[non_empty]
+    for _ in range(bands):
+        permutations = np.array([
+            rng.permutation(expanded.shape[1]) for _ in range(rows)
+        ])
+        if len(non_empty) == 0:
+            yield np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+            continue
+        signatures = np.minimum.reduceat(
+            permutations[:, expanded.indices], starts, axis=1
+        ).T
+        _, buckets = np.unique(signatures, axis=0, return_inverse=True)
+        yield pairs_within_groups(non_empty, buckets.ravel())
+
+
+def pairs_within_groups(members, groups):
+    """
+    Get all pairs of members that share a group
+
+    :return: Arrays of sources and targets with source < target
+    """
+    order = np.argsort(groups, kind='stable')
+    members, groups = members[order], groups[order]
+    group_ends = np.searchsorted(groups, groups, side='right')
+    after = group_ends - np.arange(len(groups)) - 1
+
+    positions = np.repeat(np.arange(len(groups)), after)
+    starts = np.repeat(np.cumsum(after) - after, after)
+    offsets = np.arange(after.sum()) - starts
+    sources = members[positions]
+    targets = members[positions + offsets + 1]
+    return np.minimum(sources, targets), np.maximum(sources, targets)
+
+
+def lsh_recall(club_data, threshold=0.0, **kwargs):
+    """
+    Measure the share of pairs with a Jaccard index above threshold that the
+    approximate mode of calculate_club_likeness finds
+
+    :param kwargs: Parameters passed on to calculate_club_likeness
+    """
+    exact = {
+        (source, target) for source, target, score
+        in calculate_club_likeness(club_data)
+        if score > threshold
+    }
+    if not exact:
+        return 1.0
+    approximate = {
+        (source, target) for source, target, score
+        in calculate_club_likeness(club_data, approximate=True, **kwargs)
+    }
+    return len(exact & approximate) / len(exact)
+
+
+def sparsify_edges(sources, targets, scores, top_k=None, min_score=0.0):
+    """
+    Filter weighted edges down to those above min_score that are within the
+    top_k highest scoring edges of either of their nodes. Ties are broken by
+    the order of the edges.
+
+    :return: The filtered sources, targets and scores in their original order
+    """
+    keep = scores > min_score
+    if top_k is not None:
+        edges = np.flatnonzero(keep)
+        nodes = np.concatenate([sources[edges], targets[edges]])
+        edges = np.concatenate([edges, edges])
+        order = np.lexsort((edges, -scores[edges], nodes))
+        nodes, edges = nodes[order], edges[order]
+
+        group_starts = np.searchsorted(nodes, nodes, side='left')
+        ranks = np.arange(len(nodes)) - group_starts
+        keep = np.zeros(len(scores), dtype=bool)
+        keep[edges[ranks < top_k]] = True
+
+    return sources[keep], targets[keep], scores[keep]
 
 
 def jaccard_index(a, b):
@@ -175,20 +1123,197 @@ def jaccard_index(a, b):
         return intersection / union
 
 
-def create_graph(nodes, edges):
-    G = nx.Graph()
-
-    for (year, club_name), data in nodes.iterrows():
-        G.add_node(club_name, **data.to_dict())
+def create_graph(nodes, edges, random_state=None, method='louvain', seeds=1,
+                 resolution=1.0, executor=None, initial=None):
+    """
+    Create the graph of clubs with their similarity as edge weights and their
+    community as the group attribute of the nodes
 
+    :param random_state:    Seed for the community detection, None for random
+    :param method:          'louvain', 'leiden' or 'python-louvain', see
+                            COMMUNITY_METHOD
+    :param seeds:           Number of seeds to try from random_state on
+    :param resolution:      Resolution of the community detection
+    :param executor:        Executor to try the seeds in parallel with, if any
+    :param initial:         Dict of the community of clubs to warm start the
+                            community detection from, if any
+    """
+    G = nx.Graph()
+    G.add_nodes_from(zip(
+        nodes.index.get_level_values(1), nodes.to_dict('records')
+    ))
     G.add_weighted_edges_from(edges)
-    partition = community_louvain.best_partition(G)
+
+    if method == 'python-louvain':
+        partition = community_louvain.best_partition(
+            G, random_state=random_state, resolution=resolution
+        )
+    else:
+        partition = detect_communities(
+            G, edges, random_state, method, seeds, resolution, executor,
+            initial
+        )
     for key, value in partition.items():
         G.nodes[key]["group"] = value
 
     return G
 
 
+def detect_communities(G, edges, random_state=None, method='louvain',
+                       seeds=1, resolution=1.0, executor=None, initial=None):
+    """
+    Find the communities of the nodes of G on a sparse adjacency matrix built
+    from the edges, see create_graph. Nodes that are not in the initial
+    partition start in a community of their own.
+
+    :return: A dict of the community of every node
+    """
+    names = pd.Index(list(G.nodes))
+    sources, targets, weights = zip(*edges) if edges else ((), (), ())
+    adjacency = csr_adjacency(
+        names.get_indexer(list(sources)),
+        names.get_indexer(list(targets)),
+        weights,
+        len(names)
+    )
+    if random_state is None:
+        seeds = [None] * seeds
+    else:
+        seeds = range(random_state, random_state + seeds)
+    if initial is not None:
+        start = max(initial.values(), default=-1) + 1
+        initial = np.array([
+            initial[name] if name in initial else start + position
+            for position, name in enumerate(names)
+        ])
+    labels, _ = best_partition(
+        adjacency, seeds, resolution, method, executor, initial
+    )
+    return dict(zip(names, labels.tolist()))
+
+
+def community_report(club_data, methods, random_state=0):
+    """
+    Compare the time taken and the modularity of community detection methods
+
+    :param club_data:   Club data for a single year
+    :param methods:     A list of (method, seeds, resolution) tuples, see
+                        create_graph
+
+    :return: A DataFrame with the number of seconds taken, modularity and
+    number of groups for each method
+    """
+    edges = calculate_club_likeness(club_data)
+    report = []
+    for method, seeds, resolution in methods:
+        start = perf_counter()
+        G = create_graph(
+            club_data, edges, random_state, method, seeds, resolution
+        )
+        seconds = perf_counter() - start
+        partition = nx.get_node_attributes(G, 'group')
+        report.append({
+            'method': method,
+            'seeds': seeds,
+            'resolution': resolution,
+            'seconds': seconds,
+            'modularity': community_louvain.modularity(partition, G),
+            'groups': len(set(partition.values()))
+        })
+    return pd.DataFrame(report)
+
+
+def sparsification_report(club_data, settings, random_state=0):
+    """
+    Compare the graphs built with different edge sparsification settings to
+    the graph with all edges
+
+    :param club_data:   Club data for a single year
+    :param settings:    A list of (top_k, min_score) tuples
+    :param random_state: Seed for Louvain so partitions are comparable
+
+    :return: A DataFrame with the number of edges, size of the network json,
+    modularity, number of groups and adjusted rand index of the partition
+    compared to the full graph for each setting
+    """
+    full_partition = None
+    report = []
+    for top_k, min_score in [(None, 0.0)] + list(settings):
+        edges = calculate_club_likeness(
+            club_data, top_k=top_k, min_score=min_score
+        )
+        G = create_graph(club_data, edges, random_state=random_state)
+        partition = nx.get_node_attributes(G, 'group')
+        if full_partition is None:
+            full_partition = partition
+        d = optimise_json(json_graph.node_link_data(G))
+        report.append({
+            'top_k': top_k,
+            'min_score': min_score,
+            'edges': len(edges),
+            'json_bytes': len(json.dumps(d)),
+            'modularity': community_louvain.modularity(partition, G),
+            'groups': len(set(partition.values())),
+            'adjusted_rand_index': adjusted_rand_index(
+                [full_partition[n] for n in G.nodes],
+                [partition[n] for n in G.nodes]
+            )
+        })
+    return pd.DataFrame(report)
+
+
+def network_format_report(G, artist_name_to_ids, repeat=10):
+    """
+    Compare the size and decoding time of a network in the optimised json
+    format and in the binary format of network_format.py
+
+    :return: A DataFrame with the number of bytes, uncompressed and with every
+    available compression, and the milliseconds taken to decode each format
+    """
+    d = json_graph.node_link_data(G)
+    binary = network_format.encode_network(d, artist_name_to_ids)
+    d['artist_names_to_ids'] = artist_name_to_ids
+    text = json.dumps(optimise_json(d)).encode('utf-8')
+
+    report = []
+    for name, data, decode in [
+        ('json', text, json.loads),
+        ('binary', binary, network_format.decode_network)
+    ]:
+        start = perf_counter()
+        for _ in range(repeat):
+            decode(data)
+        row = {
+            'format': name,
+            'bytes': len(data),
+            'decode_ms': (perf_counter() - start) / repeat * 1000
+        }
+        for extension, compressed in network_format.compressed_variants(
+            data
+        ).items():
+            row['bytes' + extension] = len(compressed)
+        report.append(row)
+    return pd.DataFrame(report)
+
+
+def adjusted_rand_index(a, b):
+    """
+    Calculates the adjusted rand index between two clusterings of the same
+    items, 1 for identical clusterings and around 0 for random ones
+
+    https://en.wikipedia.org/wiki/Rand_index#Adjusted_Rand_index
+    """
+    contingency = pd.crosstab(np.asarray(a), np.asarray(b)).values
+    index = special.comb(contingency, 2).sum()
+    a_pairs = special.comb(contingency.sum(axis=1), 2).sum()
+    b_pairs = special.comb(contingency.sum(axis=0), 2).sum()
+    expected = a_pairs * b_pairs / special.comb(contingency.sum(), 2)
+    maximum = (a_pairs + b_pairs) / 2
+    if maximum == expected:
+        return 1.0
+    return (index - expected) / (maximum - expected)
+
+
 def artist_id_to_name_dict(all_data):
     """
     For most artists their id is a slugified version of their name
@@ -213,7 +1338,10 @@ def optimise_json(d):
     """
     d['node_keys'] = list(d['nodes'][0].keys())
     for i, node in enumerate(d['nodes']):
-        d['nodes'][i] = list(node.values())
+        d['nodes'][i] = [
+            value.to_dict() if isinstance(value, SparseCounter) else value
+            for value in node.values()
+        ]
 
     d['link_keys'] = list(d['links'][0].keys())
     for i, link in enumerate(d['links']):
@@ -221,54 +1349,508 @@ def optimise_json(d):
     return d
 
 
-def residency_factor(club):
-    if club['number_of_unique_artists'] == 0:
-        return 0
-    return club['total_number_of_artists'] / club['number_of_unique_artists']
+def residency_factor(clubs):
+    """
+    Average number of bookings per artist, 0 for clubs without artists
+    """
+    return ratio(
+        clubs['total_number_of_artists'], clubs['number_of_unique_artists']
+    )
 
 
-def compare_underlying_distribution(clubs, calculation, aggregation):
-    t = []
-    aggregate_values = set()
-    for club in clubs:
-        t.append([
-            club[aggregation],
-            calculation(club)
-        ])
-        aggregate_values.add(club[aggregation])
-
-    for key in aggregate_values:
-        n1 = [a[1] for a in t if a[0] == key]
-        n2 = [a[1] for a in t if a[0] != key]
-        a = stats.ks_2samp(n1, n2)
-        if a[1] <= 0.01:
-            print(f'{key} is likely not from the same distribution')
-        else:
-            print(f'{key}')
+def artists_per_date(clubs):
+    return ratio(clubs['total_number_of_artists'], clubs['number_of_dates'])
 
 
-if __name__ == "__main__":
+def attendance_per_date(clubs):
+    """
+    Average attendance of the dates of clubs, NaN for clubs without it
+    """
+    attending = np.asarray(clubs['attending'], dtype=np.float64)
+    return np.where(
+        np.isnan(attending), np.nan,
+        ratio(np.nan_to_num(attending), clubs['number_of_dates'])
+    )
 
-    regions, clubs, dates, date_details = load_csv_files()
-    artists_to_dates = normalize_artist_data(date_details)
-    date_details = date_details.drop('artists', axis=1)
-    all_data = join_data_frames(
-        regions, clubs, dates, date_details, artists_to_dates
+
+def ratio(a, b):
+    """
+    Divide a by b as arrays of floats, 0 where b is 0
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    return np.divide(a, b, out=np.zeros(np.broadcast(a, b).shape),
+                     where=b != 0)
+
+
+# Metrics that are computed from the columns of a DataFrame of clubs
+CLUB_METRICS = {
+    'residency_factor': residency_factor,
+    'artists_per_date': artists_per_date,
+    'attendance_per_date': attendance_per_date,
+}
+
+
+def club_metrics(clubs, metrics):
+    """
+    Compute metrics of clubs as columns
+
+    :param clubs:   DataFrame of clubs, e.g. the club_data of a year
+    :param metrics: Names of metrics in CLUB_METRICS
+
+    :return: A DataFrame with a column for every metric
+    """
+    return pd.DataFrame(
+        {metric: CLUB_METRICS[metric](clubs) for metric in metrics},
+        index=clubs.index
     )
 
-    all_data = all_data.reset_index()
-    club_data = group_by_year_and_club(all_data)
-    club_data.logo = club_data.logo.fillna('')
-    artist_name_to_ids = artist_id_to_name_dict(all_data)
 
-    for year, df in club_data.groupby(level=0):
-        similarities = calculate_club_likeness(df)
-        G = create_graph(df, similarities)
-        d = json_graph.node_link_data(G)
-        d['artist_names_to_ids'] = artist_name_to_ids
+def ks_statistics(values, codes, k):
+    """
+    Two sample Kolmogorov-Smirnov statistics of the values of every group
+    against the values of all other groups, computed at once for all groups.
+
+    The difference between the cumulative distributions of a group and the
+    rest only rises at the values of the group and falls in between, so it is
+    only evaluated after and before the runs of equal values that hold the
+    members of every group. This is O(n log n) for all groups together,
+    instead of keeping cumulative counts of every group at every value.
+
+    :param values:  Sorted values
+    :param codes:   Group of every value, from 0 to k - 1
+    :param k:       Number of groups
+
+    :return: An array with the statistic of every group, NaN for groups that
+    have all or none of the values
+    """
+    n = len(values)
+    statistics = np.full(k, np.nan)
+    if n == 0:
+        return statistics
+    positions = np.arange(n)
+    # first and last position of the run of equal values of every value
+    run_starts = np.maximum.accumulate(np.where(
+        np.append(True, values[1:] != values[:-1]), positions, 0
+    ))
+    run_ends = np.minimum.accumulate(np.where(
+        np.append(values[1:] != values[:-1], True), positions, n
+    )[::-1])[::-1]
+
+    sizes = np.bincount(codes, minlength=k)
+    offsets = np.cumsum(sizes) - sizes
+    # positions of the members of every group, grouped and in order
+    order = np.argsort(codes, kind='stable')
+    members = codes[order]
+    keys = members * n + order
+    # members of the group up to the end and before the start of every run
+    after = np.searchsorted(
+        keys, members * n + run_ends[order], side='right'
+    ) - offsets[members]
+    before = np.searchsorted(
+        keys, members * n + run_starts[order], side='left'
+    ) - offsets[members]
+    group_sizes, rest = sizes[members], n - sizes[members]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        highs = after / group_sizes - (run_ends[order] + 1 - after) / rest
+        lows = before / group_sizes - (run_starts[order] - before) / rest
+    differences = np.maximum(np.abs(highs), np.abs(lows))
+
+    found = np.flatnonzero(sizes)
+    statistics[found] = np.maximum.reduceat(differences, offsets[found])
+    statistics[(sizes == 0) | (sizes == n)] = np.nan
+    return statistics
+
+
+def ks_permutation_counts(values, codes, k, observed, resamples, seed):
+    """
+    Count how often the statistics of random relabelings of the values are at
+    least as large as the observed statistics
+
+    :param seed:    Seed or SeedSequence of the relabelings
+
+    :return: An array with the count of every group
+    """
+    rng = np.random.default_rng(seed)
+    counts = np.zeros(k, dtype=np.int64)
+    for _ in range(resamples):
+        statistics = ks_statistics(values, rng.permutation(codes), k)
+        counts += statistics >= observed - 1e-12
+    return counts
+
+
+def compare_underlying_distribution(clubs, metrics=('residency_factor',),
+                                    aggregations=('region',), permutations=0,
+                                    alpha=0.01, executor=None, seed=0,
+                                    chunk_size=100):
+    """
+    Test whether the distribution of metrics of the clubs of every region,
+    country or community differs from that of all other clubs, with two sample
+    Kolmogorov-Smirnov tests
 
-        compare_underlying_distribution(
-            d['nodes'], residency_factor, 'region'
+    :param clubs:           DataFrame of clubs with the aggregation columns
+    :param metrics:         Names of metrics in CLUB_METRICS
+    :param aggregations:    Columns of clubs to group the clubs by
+    :param permutations:    Number of random relabelings for permutation test
+                            p-values, 0 to only use the asymptotic p-values
+    :param alpha:           Significance level
+    :param executor:        Executor to run the relabelings in parallel with,
+                            if any
+    :param seed:            Seed of the relabelings
+    :param chunk_size:      Number of relabelings per task for the executor
+
+    :return: A DataFrame with a row for every metric, aggregation and group,
+    with the number of clubs in the group, the statistic, the asymptotic
+    p-value, the permutation p-value if permutations is given and whether the
+    distribution differs at the significance level
+    """
+    values = club_metrics(clubs, metrics)
+    map_ = map if executor is None else executor.map
+    seeds = np.random.SeedSequence(seed)
+    report = []
+    for metric in values.columns:
+        for aggregation in aggregations:
+            column = values[metric].to_numpy()
+            known = ~np.isnan(column)
+            order = np.argsort(column[known], kind='stable')
+            codes, groups = pd.factorize(
+                clubs[aggregation].to_numpy()[known][order], sort=True
+            )
+            column = column[known][order]
+            k, n = len(groups), len(column)
+            if n == 0:
+                # no club has a known value of the metric, e.g. attendance
+                continue
+
+            statistics = ks_statistics(column, codes, k)
+            sizes = np.bincount(codes, minlength=k)
+            # the asymptotic distribution that ks_2samp uses for large samples
+            pvalues = stats.kstwo.sf(
+                statistics, np.round(sizes * (n - sizes) / max(n, 1))
+            )
+            table = pd.DataFrame({
+                'metric': metric,
+                'aggregation': aggregation,
+                'group': groups,
+                'clubs': sizes,
+                'statistic': statistics,
+                'pvalue': np.clip(pvalues, 0, 1),
+            })
+
+            if permutations:
+                chunks = [
+                    min(chunk_size, permutations - start)
+                    for start in range(0, permutations, chunk_size)
+                ]
+                counts = sum(map_(
+                    ks_permutation_counts,
+                    repeat(column), repeat(codes), repeat(k),
+                    repeat(statistics), chunks, seeds.spawn(len(chunks))
+                ))
+                table['permutation_pvalue'] = np.where(
+                    np.isnan(statistics), np.nan,
+                    (counts + 1) / (permutations + 1)
+                )
+            significance = table['permutation_pvalue'] if permutations else \
+                table['pvalue']
+            table['different'] = significance <= alpha
+            report.append(table)
+    if not report:
+        columns = ['metric', 'aggregation', 'group', 'clubs', 'statistic',
+                   'pvalue'] + (['permutation_pvalue'] if permutations else [])
+        return pd.DataFrame(columns=columns + ['different'])
+    return pd.concat(report, ignore_index=True)
+
+
+def process_year(year, club_data, artist_name_to_ids, shards=1,
+                 executor=None, data_key=None):
+    """
+    Build and save the network of clubs for a single year
+
+    :param data_key:    Key of the club data in the stage cache, the scores
+                        and graph are only cached if it is given
+
+    :return: The records of the stages of the year for the run report
+    """
+    report = runreport.RunReport(
+        {'year': int(year)}, PROFILE_STAGES, PROFILE_PATH
+    )
+    cache = stage_cache() if data_key is not None else None
+    state_path = NETWORK_STATE_PATH.format(year)
+    previous = load_network_state(state_path) if INCREMENTAL else None
+    initial = None
+    if previous is not None and WARM_START_COMMUNITIES:
+        initial = dict(zip(
+            previous['names'].tolist(), previous['groups'].tolist()
+        ))
+    pairs, graph = year_stages(
+        club_data, year, cache, data_key, previous, initial, shards, executor,
+        report
+    )
+    G = graph.result()
+    if INCREMENTAL:
+        with report.stage('save_network_state', len(club_data)):
+            save_network_state(state_path, network_state(
+                club_data, pairs.result(), nx.get_node_attributes(G, 'group')
+            ))
+    d = json_graph.node_link_data(G)
+    layouts = None
+    if PRECOMPUTE_LAYOUT:
+        with report.stage('cluster_layouts', len(d['nodes'])):
+            layouts = layout.cluster_layouts(d['nodes'], seed=RANDOM_STATE)
+    with report.stage('write_network', len(d['nodes'])):
+        if SHARD_NETWORK:
+            network_format.write_sharded_network(
+                NETWORK_BINARY_PATH.format(year),
+                NETWORK_SHARD_DIRECTORY.format(year),
+                d,
+                artist_name_to_ids,
+                layouts=layouts
+            )
+        else:
+            network_format.write_network(
+                NETWORK_BINARY_PATH.format(year), d, artist_name_to_ids,
+                layouts
+            )
+    d['artist_names_to_ids'] = artist_name_to_ids
+
+    groups = nx.get_node_attributes(G, 'group')
+    with report.stage('compare_underlying_distribution') as record:
+        distributions = compare_underlying_distribution(
+            club_data.assign(group=[
+                groups[name] for name in club_data.index.get_level_values(1)
+            ]),
+            DISTRIBUTION_METRICS,
+            DISTRIBUTION_AGGREGATIONS,
+            permutations=PERMUTATIONS,
+            alpha=SIGNIFICANCE,
+            executor=executor,
+            seed=RANDOM_STATE
         )
+        record['rows'] = len(distributions)
+    print('Distributions that differ from the other clubs in {}'.format(year))
+    print(distributions[distributions.different].to_string(index=False))
+    with report.stage('write_json', len(d['nodes'])):
         d = optimise_json(d)
-        json.dump(d, open('./public/network-{}.json'.format(year), 'w'))
\ No newline at end of file
+        with open(NETWORK_PATH.format(year), 'w') as fp:
+            json.dump(d, fp)
+    return report.stages
+
+
+def year_stages(club_data, year, cache=None, data_key=None, previous=None,
+                initial=None, shards=1, executor=None, report=None):
+    """
+    Get the stages that score the pairs of clubs of a year and build its graph
+
+    :param data_key:    Key of the club data in the stage cache
+    :param previous:    State of the earlier build to score the pairs
+                        incrementally from, if any
+    :param initial:     Dict of the community of clubs to warm start the
+                        community detection from, if any
+
+    :return: A tuple of the pair scores stage and the graph stage
+    """
+    pairs = Stage(
+        cache, 'club_pair_scores', club_pair_scores,
+        args=[club_data],
+        inputs=[data_key, year],
+        # incremental scores are the same as a full build
+        kwargs={
+            'shards': shards, 'executor': executor, 'previous': previous,
+            'max_changed': INCREMENTAL_MAX_CHANGED
+        },
+        report=report,
+        rows=lambda pairs: len(pairs[2]),
+        code=pair_scoring_code()
+    )
+    graph = Stage(
+        # warm started communities depend on the previous build
+        cache if initial is None else None, 'build_graph', build_graph,
+        args=[club_data, pairs],
+        inputs=[data_key, year],
+        params={
+            'top_k': TOP_K_NEIGHBOURS,
+            'min_score': MIN_SIMILARITY,
+            'random_state': RANDOM_STATE,
+            'method': COMMUNITY_METHOD,
+            'seeds': COMMUNITY_SEEDS,
+            'resolution': RESOLUTION,
+        },
+        kwargs={'executor': executor, 'initial': initial},
+        report=report,
+        rows=lambda G: G.number_of_edges(),
+        code=[
+            sparsify_edges, named_edges, create_graph, detect_communities,
+            communities
+        ]
+    )
+    return pairs, graph
+
+
+def build_graph(club_data, pairs, top_k=None, min_score=0.0,
+                random_state=None, method='louvain', seeds=1, resolution=1.0,
+                executor=None, initial=None):
+    """
+    Sparsify the scored pairs of clubs and create the graph of clubs with
+    their communities, see create_graph for the parameters
+
+    :param pairs:   Source rows, target rows and scores of all pairs, see
+                    club_pair_scores
+    """
+    similarities = named_edges(
+        club_data, *sparsify_edges(*pairs, top_k, min_score)
+    )
+    return create_graph(
+        club_data, similarities, random_state, method, seeds, resolution,
+        executor, initial
+    )
+
+
+def build_networks(club_data, artist_name_to_ids, workers=1, shards=1,
+                   data_key=None):
+    """
+    Build and save the networks for every year in club_data. With more than
+    one worker the years are processed in parallel, or if there is only a
+    single year its pairs of clubs are scored in parallel shards. The output
+    is the same regardless of the number of workers.
+
+    :param data_key:    Key of the club data in the stage cache, if any
+
+    :return: The records of the stages of every year for the run report
+    """
+    years = [(year, df) for year, df in club_data.groupby(level=0)]
+    if workers <= 1:
+        stages = [
+            process_year(
+                year, df, artist_name_to_ids, shards, data_key=data_key
+            )
+            for year, df in years
+        ]
+    elif len(years) > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            stages = list(executor.map(
+                process_year,
+                *zip(*years),
+                repeat(artist_name_to_ids),
+                repeat(shards),
+                repeat(None),
+                repeat(data_key)
+            ))
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            stages = [
+                process_year(
+                    year, df, artist_name_to_ids, max(shards, workers),
+                    executor, data_key
+                )
+                for year, df in years
+            ]
+    return [stage for year_stages in stages for stage in year_stages]
+
+
+def normalize_loaded_artists(raw):
+    """
+    Normalize the artists of the date details of the loaded csv files
+    """
+    return normalize_artist_data(raw[3])
+
+
+def prepare_club_data(raw, artists_to_dates):
+    """
+    Aggregate the loaded csv files and normalized artists into club data
+    """
+    regions, clubs, dates, date_details = raw
+    club_data = aggregate_club_data(
+        regions, clubs, dates, date_details.drop(LIST_COLUMNS, axis=1),
+        artists_to_dates
+    )
+    club_data.logo = club_data.logo.fillna('')
+    return club_data
+
+
+def club_artist_ids(raw, artists_to_dates):
+    """
+    Get the ids of the artists of the clubs whose id is not their name
+    """
+    regions, clubs, dates, _ = raw
+    return artist_id_to_name_dict(
+        top_club_artists(regions, clubs, dates, artists_to_dates)
+    )
+
+
+def club_data_stages(cache=None, report=None):
+    """
+    Get the stages that load the csv files and turn them into club data, the
+    csv files are only loaded if an output is not in the cache
+
+    :param report:  RunReport to time the stages with, if any
+
+    :return: A tuple of the club data stage and the artist ids stage
+    """
+    raw = Stage(
+        cache, 'load_csv_files', load_csv_files,
+        inputs=[columnar.file_hash(path) for path in DATA_FILES.values()] +
+        [LIST_COLUMNS],
+        report=report,
+        # the rows of the date details, the other files are small
+        rows=lambda raw: len(raw[3]),
+        code=[load_date_details, columnar]
+    )
+    artists_to_dates = Stage(
+        cache, 'normalize_artist_data', normalize_loaded_artists, args=[raw],
+        report=report, rows=len, code=[normalize_artist_data]
+    )
+    club_data = Stage(
+        cache, 'aggregate_club_data', prepare_club_data,
+        args=[raw, artists_to_dates], inputs=[LIST_COLUMNS], report=report,
+        rows=len, code=[aggregate_club_data, count_artists, SparseCounter]
+    )
+    artist_ids = Stage(
+        cache, 'club_artist_ids', club_artist_ids,
+        args=[raw, artists_to_dates], report=report, rows=len,
+        code=[top_club_artists, artist_id_to_name_dict]
+    )
+    return club_data, artist_ids
+
+
+_stage_cache = None
+
+
+def stage_cache():
+    """
+    Get the stage cache of this process, None if it is disabled
+    """
+    global _stage_cache
+    if USE_STAGE_CACHE and _stage_cache is None:
+        _stage_cache = StageCache(STAGE_CACHE_PATH, STAGE_CACHE_BYTES)
+    return _stage_cache
+
+
+def main():
+    report = runreport.RunReport(profile=PROFILE_STAGES,
+                                 profile_path=PROFILE_PATH)
+    club_data, artist_ids = club_data_stages(stage_cache(), report)
+    report.extend(build_networks(
+        club_data.result(),
+        artist_ids.result(),
+        WORKERS,
+        PAIR_SHARDS,
+        club_data.key
+    ))
+    if RUN_REPORT:
+        cache = stage_cache()
+        runreport.print_report(report.write(
+            RUN_REPORT_PATH.format(
+                datetime.now().strftime('%Y%m%d-%H%M%S')
+            ),
+            workers=WORKERS,
+            stage_cache=cache.stats() if cache is not None else None
+        ))
+
+
+if __name__ == "__main__":
+    # run from the processing module rather than __main__, so that cached
+    # outputs refer to its classes, e.g. SparseCounter, and can be loaded
+    # wherever the module is imported
+    import processing
+    processing.main()
@@ -0,0 +1,221 @@
+import cProfile
+import json
+import os
+import sys
+from contextlib import contextmanager
+from time import perf_counter, process_time, time
+
+# Timings of the stages of a run, written as a JSON report. Every stage
+# records its wall and CPU time, the resident memory before and after it, its
+# peak resident memory and how much it raised the peak of the process, the
+# number of rows it produced and its throughput. The CPU time and memory are of
+# the process the stage ran in, work done in worker processes is not included.
+#
+# On Linux the peak of a stage is measured by resetting the high water mark of
+# the process when the stage starts. Elsewhere it is the peak of the process if
+# the stage raised it, and the larger of the memory before and after the stage
+# otherwise.
+#
+# Named stages can be run under cProfile, their profiles are written next to
+# the report and can be read with pstats or snakeviz. Stages also record the
+# unix time they started and finished at and the report has the pid of the
+# process, so that samples of a sampling profiler attached with
+# `py-spy record --pid <pid>` can be matched to stages.
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process in bytes, None if it is not known
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def proc_status(field):
+    """
+    Get a memory field of /proc/self/status in bytes, None if it is not known
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def rss():
+    """
+    Resident memory of this process in bytes, None if it is not known
+    """
+    return proc_status('VmRSS')
+
+
+def reset_high_water_mark():
+    """
+    Reset the peak resident memory of this process that VmHWM reports
+
+    :return: Whether it could be reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except OSError:
+        return False
+    return proc_status('VmHWM') is not None
+
+
+class RunReport:
+    """
+    Collects the timings of the stages of a run
+
+    :param labels:          Dict of fields added to every stage, e.g. the year
+                            a stage processed
+    :param profile:         Names of the stages to run under cProfile
+    :param profile_path:    Path of the profiles with a {} placeholder for the
+                            name of the stage and its labels
+    """
+    def __init__(self, labels=None, profile=(), profile_path='./{}.prof'):
+        self.labels = labels or {}
+        self.profile = set(profile)
+        self.profile_path = profile_path
+        self.stages = []
+        # the peaks of the stages that are running, the high water mark is
+        # reset by every stage that starts within them
+        self.peaks = []
+        self.started = time()
+        self.start_cpu = process_time()
+
+    @contextmanager
+    def stage(self, name, rows=None, profile=True):
+        """
+        Time the stage of a run in a with block, the number of rows can be
+        set on the record it yields once it is known. Records whose discard
+        field is set are dropped, e.g. of a cache lookup that missed.
+
+        :param name:    Name of the stage
+        :param rows:    Number of rows the stage produces, if known up front
+        :param profile: Whether to profile the stage if it is named in the
+                        stages to profile, e.g. not to profile a cache lookup
+        """
+        record = dict(self.labels, stage=name, rows=rows)
+        profiler = None
+        if profile and name in self.profile:
+            profiler = cProfile.Profile()
+        high_water_mark = proc_status('VmHWM')
+        for peaks in self.peaks:
+            peaks[0] = max(peaks[0], high_water_mark or 0)
+        peaks = [0]
+        self.peaks.append(peaks)
+        reset = reset_high_water_mark()
+        rss_before, process_peak = rss(), peak_rss()
+        started, wall, cpu = time(), perf_counter(), process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record.update({
+                'started': started,
+                'finished': time(),
+                'wall_seconds': perf_counter() - wall,
+                'cpu_seconds': process_time() - cpu,
+            })
+            self.peaks = [other for other in self.peaks if other is not peaks]
+            rss_after, process_peak_after = rss(), peak_rss()
+            grown = None if process_peak is None else \
+                process_peak_after - process_peak
+            if reset:
+                peak = max(peaks[0], proc_status('VmHWM') or 0)
+            elif grown:
+                peak = process_peak_after
+            else:
+                peak = max(rss_before or 0, rss_after or 0) or None
+            record.update({
+                'rss_before_bytes': rss_before,
+                'rss_after_bytes': rss_after,
+                'peak_rss_bytes': peak,
+                'peak_rss_delta_bytes': grown,
+            })
+            if profiler is not None:
+                record['profile'] = self.profile_path.format('-'.join(
+                    [name] + [str(value) for value in self.labels.values()]
+                ))
+                os.makedirs(os.path.dirname(record['profile']) or '.',
+                            exist_ok=True)
+                profiler.dump_stats(record['profile'])
+            if not record.pop('discard', False):
+                self.add(record)
+
+    def add(self, record):
+        """
+        Add a stage record, e.g. of a stage that ran in another process
+        """
+        wall, rows = record.get('wall_seconds'), record.get('rows')
+        if rows is not None and wall:
+            record['rows_per_second'] = rows / wall
+        self.stages.append(record)
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+
+    def to_dict(self, **fields):
+        """
+        Get the report as a JSON serializable dict
+
+        :param fields:  Other fields to add to the report
+        """
+        return dict({
+            'pid': os.getpid(),
+            'started': self.started,
+            'finished': time(),
+            'wall_seconds': time() - self.started,
+            'cpu_seconds': process_time() - self.start_cpu,
+            'peak_rss_bytes': peak_rss(),
+            'stages': self.stages,
+        }, **fields)
+
+    def write(self, path, **fields):
+        """
+        Write the report as JSON
+
+        :return: The report
+        """
+        report = self.to_dict(**fields)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as fp:
+            json.dump(report, fp, indent=2, default=str)
+        return report
+
+
+def print_report(report):
+    print('{:<32}{:>6}{:>10}{:>10}{:>12}{:>10}{:>14}'.format(
+        'stage', 'year', 'seconds', 'cpu', 'megabytes', 'rows', 'rows/second'
+    ))
+    for stage in report['stages']:
+        print('{:<32}{:>6}{:>10.3f}{:>10.3f}{:>12.1f}{:>10}{:>14}'.format(
+            stage['stage'] + (' (cached)' if stage.get('cached') else ''),
+            stage.get('year', ''),
+            stage['wall_seconds'],
+            stage['cpu_seconds'],
+            (stage['peak_rss_bytes'] or 0) / (1 << 20),
+            '' if stage['rows'] is None else stage['rows'],
+            '{:.0f}'.format(stage['rows_per_second'])
+            if 'rows_per_second' in stage else ''
+        ))
+    print('Total {:.3f} seconds, {:.3f} cpu seconds'.format(
+        report['wall_seconds'], report['cpu_seconds']
+    ))
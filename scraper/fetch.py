@@ -0,0 +1,262 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from scrapemetrics import ScrapeMetrics
+
+# An asyncio based engine for fetching many pages. Pages that are in the
+# page store are read without waiting, other pages are requested in
+# threads and throttled per host with a token bucket, so that cache reads,
+# parsing and writes carry on while requests wait for their turn.
+# Requests share a pooled session, and pages that are older than their maximum
+# age are revalidated with a conditional request using their stored ETag and
+# Last-Modified values, a 304 response keeps the stored page.
+# Urls are fed to the requests through a bounded queue, so that only the pages
+# of a window of urls are held in memory at any time.
+
+# Number of urls per request in flight that are fetched ahead of the url whose
+# page is handed to the callback
+PREFETCH = 4
+
+
+class TokenBucket:
+    """
+    Rate limiter that allows a burst of `capacity` requests, after which
+    one request is allowed every `delay` seconds
+    """
+    def __init__(self, delay, capacity=1):
+        self.delay = delay
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Wait until a request is allowed
+
+        :return: The number of seconds spent waiting
+        """
+        waited = 0.0
+        async with self.lock:
+            while True:
+                now = monotonic()
+                if self.delay > 0:
+                    self.tokens = min(
+                        self.capacity,
+                        self.tokens + (now - self.updated) / self.delay
+                    )
+                else:
+                    self.tokens = self.capacity
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) * self.delay
+                await asyncio.sleep(wait)
+                waited += wait
+
+
+class FetchEngine:
+    """
+    Fetch pages concurrently, reading from and writing to a page store
+
+    :param store:           The PageStore to cache pages in
+    :param delays:          Minimum number of seconds between requests to a
+                            host, keyed by host (netloc)
+    :param default_delay:   Delay for hosts that are not in delays
+    :param concurrency:     Maximum number of requests in flight
+    :param use_cache:       Whether to read pages from the store
+    :param max_age:         Function that maps a url to the number of seconds
+                            after which its stored page is revalidated, or
+                            None to never revalidate
+    :param session:         requests session, defaults to a pooled session
+    :param metrics:         ScrapeMetrics to record cache hits, latencies and
+                            throttling in
+    :param page_type:       Function that maps a url to the type of its page
+                            for the metrics
+    :param timeout:         Number of seconds to wait for a response
+    """
+    def __init__(self, store, delays=None, default_delay=0.0,
+                 concurrency=4, use_cache=True, max_age=None, session=None,
+                 metrics=None, page_type=None, timeout=60):
+        self.store = store
+        self.delays = delays or {}
+        self.default_delay = default_delay
+        self.concurrency = concurrency
+        self.use_cache = use_cache
+        self.max_age = max_age or (lambda url: None)
+        self.session = session or http_session(concurrency)
+        self.metrics = metrics or ScrapeMetrics()
+        self.page_type = page_type or (lambda url: 'page')
+        self.timeout = timeout
+        self.buckets = {}
+
+    def fetch_all(self, urls, callback=None):
+        """
+        Fetch the contents of all urls. Pages that could not be fetched are
+        empty strings.
+
+        :param urls:        The urls to fetch, any iterable
+        :param callback:    Called with (url, content) for every url in the
+                            order of urls as soon as its content is available,
+                            so that the contents do not have to be kept
+
+        :return: A list of the contents of every url if there is no callback,
+        None otherwise
+        """
+        if callback is not None:
+            asyncio.run(self._fetch_all(urls, callback))
+            return None
+        contents = []
+        asyncio.run(self._fetch_all(
+            urls, lambda url, content: contents.append(content)
+        ))
+        return contents
+
+    async def _fetch_all(self, urls, callback):
+        # buckets and locks belong to the event loop of this run
+        self.buckets = {}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # fetches of the urls ahead of the one the callback waits for
+        window = asyncio.Queue(self.concurrency * PREFETCH)
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            async def schedule():
+                for url in urls:
+                    await window.put((url, asyncio.ensure_future(
+                        self.fetch_or_empty(url, semaphore, executor)
+                    )))
+                await window.put(None)
+
+            scheduler = asyncio.ensure_future(schedule())
+            try:
+                while True:
+                    item = await window.get()
+                    if item is None:
+                        break
+                    url, task = item
+                    callback(url, await task)
+            finally:
+                scheduler.cancel()
+                while not window.empty():
+                    item = window.get_nowait()
+                    if item is not None:
+                        item[1].cancel()
+
+    async def fetch_or_empty(self, url, semaphore, executor):
+        """
+        Fetch a single url, an empty string if the request failed
+        """
+        try:
+            return await self.fetch(url, semaphore, executor)
+        except requests.RequestException as e:
+            print('Error fetching {} {}'.format(url, e))
+            return ''
+
+    async def fetch(self, url, semaphore, executor):
+        """
+        Fetch a single url, from the store if possible
+        """
+        loop = asyncio.get_event_loop()
+        kind = self.page_type(url)
+        page = None
+        if self.use_cache:
+            page = await loop.run_in_executor(executor, self.store.page, url)
+            fresh = is_fresh(page, self.max_age(url))
+            self.metrics.cache_lookup(kind, fresh)
+            if fresh:
+                return page.content
+
+        async with semaphore:
+            self.metrics.throttled(
+                await self.bucket(urlparse(url).netloc).acquire()
+            )
+            start = monotonic()
+            try:
+                response = await loop.run_in_executor(
+                    executor, conditional_get, self.session, url, page,
+                    self.timeout
+                )
+            except requests.RequestException as e:
+                self.metrics.fetched(
+                    kind, monotonic() - start, type(e).__name__
+                )
+                raise
+            self.metrics.fetched(
+                kind, monotonic() - start, response.status_code
+            )
+        return await loop.run_in_executor(
+            executor, store_response, self.store, url, response, page
+        )
+
+    def bucket(self, host):
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(
+                self.delays.get(host, self.default_delay)
+            )
+        return self.buckets[host]
+
+
+def http_session(pool_size=4):
+    """
+    Get a requests session that keeps up to pool_size connections per host
+    alive, so that requests do not each pay for a new connection
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def is_fresh(page, max_age):
+    """
+    Check if a stored page can be used without revalidating it
+
+    :param page:    The stored page or None
+    :param max_age: Number of seconds a page stays fresh, None for ever
+    """
+    if page is None or page.content is None:
+        return False
+    return max_age is None or time() - page.fetched <= max_age
+
+
+def conditional_get(session, url, page=None, timeout=None):
+    """
+    Request a url, conditional on the validators of its stored page if any
+
+    :param timeout: Number of seconds to wait for a response, None for ever
+    """
+    headers = {}
+    if page is not None and page.content is not None:
+        if page.etag:
+            headers['If-None-Match'] = page.etag
+        if page.last_modified:
+            headers['If-Modified-Since'] = page.last_modified
+    return session.get(url, headers=headers, timeout=timeout)
+
+
+def store_response(store, url, response, page=None):
+    """
+    Save a response to the page store. A 304 or failed response to a
+    revalidation keeps the stored page
+
+    :return: The contents of the page, an empty string if it could not be
+    fetched
+    """
+    if page is not None and page.content is not None:
+        if response.status_code == 304:
+            store.touch(url)
+            return page.content
+        if response.status_code != 200:
+            return page.content
+    store.put(
+        url,
+        response.text,
+        response.status_code,
+        etag=response.headers.get('ETag'),
+        last_modified=response.headers.get('Last-Modified')
+    )
+    return response.text if response.status_code == 200 else ''
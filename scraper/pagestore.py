@@ -0,0 +1,284 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import zlib
+from collections import namedtuple
+from time import time
+
+# A page store for scraped html. Every fetched url is recorded in a SQLite
+# index with its status code, fetch time and the ETag and Last-Modified
+# validators of the response. The bodies are zlib compressed and stored by the
+# sha1 of their contents, so pages with the same contents are only kept once.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bodies (
+    digest TEXT PRIMARY KEY,
+    body BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    status INTEGER NOT NULL,
+    fetched REAL NOT NULL,
+    digest TEXT REFERENCES bodies (digest),
+    etag TEXT,
+    last_modified TEXT
+);
+"""
+
+# columns added to the pages table since the first version of the store
+ADDED_COLUMNS = [('etag', 'TEXT'), ('last_modified', 'TEXT')]
+
+# a stored page, content is None for pages that were not fetched successfully
+Page = namedtuple(
+    'Page', ['url', 'content', 'status', 'fetched', 'etag', 'last_modified']
+)
+
+COMPRESSION_LEVEL = 6
+
+# Number of pages read from the database at a time when iterating over pages
+ITEMS_BATCH_SIZE = 100
+
+
+class PageStore:
+    """
+    Compressed, content addressed store of fetched pages
+
+    :param path:    Path of the SQLite database, created if it does not exist
+    """
+    def __init__(self, path):
+        self.path = path
+        # the fetch engine reads and writes pages from a thread pool
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        columns = [
+            row[1] for row in self.connection.execute(
+                'PRAGMA table_info(pages)'
+            )
+        ]
+        for column, column_type in ADDED_COLUMNS:
+            if column not in columns:
+                self.connection.execute(
+                    'ALTER TABLE pages ADD COLUMN {} {}'.format(
+                        column, column_type
+                    )
+                )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, url):
+        return self.record(url) is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM pages'
+            ).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get(self, url):
+        """
+        Get the contents of a page
+
+        :return: The contents of the page or None if it has not been fetched
+        successfully
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT body FROM pages JOIN bodies USING (digest) '
+                'WHERE url = ? AND status = 200', (url,)
+            ).fetchone()
+        return decompress(row[0]) if row else None
+
+    def page(self, url):
+        """
+        Get a stored page with its status and validators
+
+        :return: The Page or None if the url is not in the store
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT url, body, status, fetched, etag, last_modified '
+                'FROM pages LEFT JOIN bodies USING (digest) WHERE url = ?',
+                (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        body = decompress(row[1]) if row[1] is not None else None
+        return Page(row[0], body, *row[2:])
+
+    def touch(self, url, fetched=None):
+        """
+        Update the fetch time of a page, e.g. after a 304 Not Modified response
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE pages SET fetched = ? WHERE url = ?',
+                (fetched or time(), url)
+            )
+
+    def record(self, url):
+        """
+        Get the status code and fetch time of a page
+
+        :return: A tuple of (status, fetched) or None if the url is not in the
+        store
+        """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT status, fetched FROM pages WHERE url = ?', (url,)
+            ).fetchone()
+
+    def put(self, url, content, status=200, fetched=None, etag=None,
+            last_modified=None):
+        """
+        Save a fetched page, replacing any earlier version of it
+
+        :param url:             The url of the page
+        :param content:         The contents of the page, only kept for status
+                                200
+        :param status:          The status code of the response
+        :param fetched:         Timestamp of the fetch, defaults to now
+        :param etag:            The ETag header of the response
+        :param last_modified:   The Last-Modified header of the response
+        """
+        self.put_many([(url, content, status, fetched, etag, last_modified)])
+
+    def put_many(self, pages):
+        """
+        Save many pages in a single transaction
+
+        :param pages:   Iterable of (url, content, status, fetched) tuples,
+                        optionally followed by etag and last_modified
+        """
+        rows, bodies = [], {}
+        for url, content, status, fetched, *validators in pages:
+            etag, last_modified = (list(validators) + [None, None])[:2]
+            digest = None
+            if status == 200:
+                body = content.encode('utf-8') \
+                    if isinstance(content, str) else content
+                digest = hashlib.sha1(body).hexdigest()
+                if digest not in bodies:
+                    bodies[digest] = zlib.compress(body, COMPRESSION_LEVEL)
+            rows.append(
+                (url, status, fetched or time(), digest, etag, last_modified)
+            )
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO bodies (digest, body) VALUES (?, ?)',
+                bodies.items()
+            )
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO pages '
+                '(url, status, fetched, digest, etag, last_modified) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+
+    def urls(self):
+        """
+        Get the urls of all the pages that have been fetched successfully
+        """
+        with self.lock:
+            return [url for url, in self.connection.execute(
+                'SELECT url FROM pages WHERE status = 200'
+            )]
+
+    def items(self, prefix=''):
+        """
+        Iterate over all the pages that have been fetched successfully
+
+        :param prefix:  Only iterate over urls starting with this prefix
+
+        :return: Generator of (url, content) tuples
+        """
+        # pages are read in batches by rowid, so that only a batch is held in
+        # memory and other threads can use the store in between batches
+        last = 0
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    'SELECT pages.rowid, url, body FROM pages '
+                    'JOIN bodies USING (digest) '
+                    'WHERE status = 200 AND substr(url, 1, ?) = ? '
+                    'AND pages.rowid > ? ORDER BY pages.rowid LIMIT ?',
+                    (len(prefix), prefix, last, ITEMS_BATCH_SIZE)
+                ).fetchall()
+            if not rows:
+                return
+            for last, url, body in rows:
+                yield url, decompress(body)
+
+
+def decompress(body):
+    return zlib.decompress(body).decode('utf-8')
+
+
+def url_from_file_name(file_name, scheme='https'):
+    """
+    Get the url of a page cached by the old scraper, which saved pages as
+    '{netloc}-{path}-{query}.html' with slashes in the path replaced by dashes.
+    Dashes within the path can not be told apart from slashes, urls of such
+    pages will not match and they will be fetched again.
+
+    :return: The url of the page
+    """
+    name = file_name[:-len('.html')]
+    netloc, _, rest = name.partition('-')
+    path, query = rest, ''
+    if rest.endswith('-'):
+        path = rest[:-1]
+    elif '-' in rest and '=' in rest.rsplit('-', 1)[1]:
+        path, query = rest.rsplit('-', 1)
+    url = '{}://{}/{}'.format(scheme, netloc, path.replace('-', '/'))
+    return '{}?{}'.format(url, query) if query else url
+
+
+def migrate_html_directory(store, directory, batch_size=1000):
+    """
+    Move pages from the old one-file-per-url html cache into a page store,
+    pages that are already in the store are skipped
+
+    :param store:       The page store to migrate to
+    :param directory:   The html cache directory
+
+    :return: The number of pages migrated
+    """
+    batch, migrated = [], 0
+    for entry in os.scandir(directory):
+        if not entry.name.endswith('.html') or not entry.is_file():
+            continue
+        url = url_from_file_name(entry.name)
+        if url in store:
+            continue
+        with open(entry.path, 'r') as fp:
+            content = fp.read()
+        if content:
+            batch.append((url, content, 200, entry.stat().st_mtime))
+        if len(batch) == batch_size:
+            store.put_many(batch)
+            migrated += len(batch)
+            batch = []
+    store.put_many(batch)
+    return migrated + len(batch)
+
+
+if __name__ == "__main__":
+    from scraper import HTML_CACHE_DIR, PAGE_STORE_PATH
+    with PageStore(PAGE_STORE_PATH) as page_store:
+        print('Migrated {} pages from {} to {}'.format(
+            migrate_html_directory(page_store, HTML_CACHE_DIR),
+            HTML_CACHE_DIR,
+            PAGE_STORE_PATH
+        ))
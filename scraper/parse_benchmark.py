@@ -0,0 +1,71 @@
+import os
+import re
+from time import perf_counter
+import scraper
+from pagestore import PageStore
+
+# Compares the time taken and the results of parsing cached pages with and
+# without FAST_EXTRACTION. Event pages in the page store are used, or the test
+# fixtures if the store is empty.
+
+FIXTURES_DIR = './fixtures/'
+EVENT_PREFIX = 'https://www.residentadvisor.net/events/'
+
+
+def load_corpus(limit=None):
+    """
+    Get (listing_id, content) tuples of the event pages to parse
+    """
+    corpus = []
+    if os.path.exists(scraper.PAGE_STORE_PATH):
+        with PageStore(scraper.PAGE_STORE_PATH) as store:
+            for url, content in store.items(EVENT_PREFIX):
+                listing_id = url[len(EVENT_PREFIX):]
+                if listing_id.isdigit():
+                    corpus.append((int(listing_id), content))
+                if limit and len(corpus) == limit:
+                    break
+    if not corpus:
+        for file_name in sorted(os.listdir(FIXTURES_DIR)):
+            match = re.match(r'event-(\d+)\.html', file_name)
+            if match:
+                with open(os.path.join(FIXTURES_DIR, file_name)) as fp:
+                    corpus.append((int(match.group(1)), fp.read()))
+    return corpus
+
+
+def parse_corpus(corpus, fast, repeat=1):
+    """
+    Parse every page in the corpus
+
+    :return: A tuple of the number of seconds taken and the parsed details
+    """
+    scraper.FAST_EXTRACTION = fast
+    start = perf_counter()
+    for _ in range(repeat):
+        details = [
+            scraper.parse_date_details(listing_id, content)
+            for listing_id, content in corpus
+        ]
+    return perf_counter() - start, details
+
+
+if __name__ == "__main__":
+    corpus = load_corpus(limit=1000)
+    repeat = max(1, 100 // len(corpus))
+    pages = len(corpus) * repeat
+
+    slow, expected = parse_corpus(corpus, False, repeat)
+    fast, details = parse_corpus(corpus, True, repeat)
+    mismatches = [
+        d['id'] for d, e in zip(details, expected) if d != e
+    ]
+
+    print('Parsed {} pages with {}'.format(pages, scraper.FAST_PARSER))
+    print('BeautifulSoup searches: {:.2f} ms per page'.format(
+        slow / pages * 1000
+    ))
+    print('Fast extraction: {:.2f} ms per page ({:.1f}x)'.format(
+        fast / pages * 1000, slow / fast
+    ))
+    print('Mismatching listings: {}'.format(mismatches or 'none'))
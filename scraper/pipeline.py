@@ -0,0 +1,219 @@
+import asyncio
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import monotonic
+
+# A staged scraping pipeline. Pages are fetched by the fetch engine, parsed in
+# a process pool and the parsed records are persisted in batches, with every
+# stage running concurrently:
+#
+#   frontier -> fetch -> [pages] -> parse -> [records] -> persist
+#                 ^                   |
+#                 +---- new tasks ----+
+#
+# The queues of pages and records are bounded, so a slow stage holds back the
+# stages before it instead of piling up pages in memory. Tasks found by the
+# parse stage, e.g. the event pages of a club year listing, are fetched before
+# tasks of earlier levels so that details come in as soon as possible.
+
+# A page to fetch, kind tells the parse function what kind of page it is and
+# level orders tasks in the frontier, lower levels are fetched first
+Task = namedtuple('Task', ['level', 'kind', 'key', 'url'])
+
+# Number of seconds between metrics reports, None to disable them
+REPORT_INTERVAL = 60
+
+
+class StageMetrics:
+    """
+    Throughput and queue depth of a pipeline stage
+    """
+    def __init__(self, name, queue=None):
+        self.name = name
+        self.queue = queue
+        self.processed = 0
+        self.busy = 0.0
+        self.max_queue_depth = 0
+        self.started = monotonic()
+
+    def record(self, seconds, items=1):
+        self.processed += items
+        self.busy += seconds
+        self.sample()
+
+    def sample(self):
+        if self.queue is not None:
+            self.max_queue_depth = max(
+                self.max_queue_depth, self.queue.qsize()
+            )
+
+    def to_dict(self):
+        elapsed = monotonic() - self.started
+        return {
+            'processed': self.processed,
+            'per_second': self.processed / elapsed if elapsed else 0.0,
+            'busy_seconds': self.busy,
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'max_queue_depth': self.max_queue_depth
+        }
+
+
+class Pipeline:
+    """
+    Fetch, parse and persist pages with concurrent stages
+
+    :param engine:          The FetchEngine to fetch pages with
+    :param parse:           Function of (kind, key, content) that returns a
+                            tuple of a list of records and a list of new Tasks,
+                            it runs in a process pool so it has to be picklable
+    :param persist:         Function of a list of records that saves them, it
+                            runs in a thread
+    :param parse_workers:   Number of parse processes, defaults to the number
+                            of cores
+    :param queue_size:      Maximum number of pages and of records waiting for
+                            the next stage
+    :param batch_size:      Number of records to persist at a time
+    """
+    def __init__(self, engine, parse, persist, parse_workers=None,
+                 queue_size=100, batch_size=100):
+        self.engine = engine
+        self.parse = parse
+        self.persist = persist
+        self.parse_workers = parse_workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.metrics = {}
+
+    def run(self, tasks, seen=()):
+        """
+        Run the pipeline until all tasks and the tasks they lead to are done
+
+        :param tasks:   The Tasks to start from
+        :param seen:    Urls that should not be fetched, e.g. because their
+                        records were persisted by an earlier run
+
+        :return: A dict of the metrics of every stage
+        """
+        asyncio.run(self._run(list(tasks), set(seen)))
+        return {
+            name: metrics.to_dict() for name, metrics in self.metrics.items()
+        }
+
+    async def _run(self, tasks, seen):
+        loop = asyncio.get_event_loop()
+        frontier = asyncio.PriorityQueue()
+        pages = asyncio.Queue(self.queue_size)
+        records = asyncio.Queue(self.queue_size)
+        self.metrics = {
+            'fetch': StageMetrics('fetch', frontier),
+            'parse': StageMetrics('parse', pages),
+            'persist': StageMetrics('persist', records),
+        }
+        # tie breaker so that tasks of a level are fetched in order
+        order = iter(range(1 << 62))
+
+        def schedule(task):
+            if task.url not in seen:
+                seen.add(task.url)
+                frontier.put_nowait((task.level, next(order), task))
+
+        for task in tasks:
+            schedule(task)
+
+        async def fetch(semaphore, executor):
+            while True:
+                _, _, task = await frontier.get()
+                start = monotonic()
+                try:
+                    content = await self.engine.fetch(
+                        task.url, semaphore, executor
+                    )
+                except Exception as e:
+                    print('Error fetching {} {}'.format(task.url, e))
+                    frontier.task_done()
+                    continue
+                self.metrics['fetch'].record(monotonic() - start)
+                await pages.put((task, content))
+
+        async def parse(processes):
+            while True:
+                task, content = await pages.get()
+                start = monotonic()
+                try:
+                    parsed, found = await loop.run_in_executor(
+                        processes, self.parse, task.kind, task.key, content
+                    )
+                except Exception as e:
+                    print('Error parsing {} {}'.format(task.url, e))
+                    parsed, found = [], []
+                self.metrics['parse'].record(monotonic() - start)
+                self.engine.metrics.parsed(task.kind, monotonic() - start)
+                for new_task in found:
+                    schedule(new_task)
+                for record in parsed:
+                    await records.put(record)
+                pages.task_done()
+                frontier.task_done()
+
+        async def persist(executor):
+            while True:
+                batch = [await records.get()]
+                while len(batch) < self.batch_size and not records.empty():
+                    batch.append(records.get_nowait())
+                start = monotonic()
+                try:
+                    await loop.run_in_executor(executor, self.persist, batch)
+                except Exception as e:
+                    print('Error persisting {} records {}'.format(
+                        len(batch), e
+                    ))
+                self.metrics['persist'].record(monotonic() - start, len(batch))
+                for _ in batch:
+                    records.task_done()
+
+        async def report():
+            while REPORT_INTERVAL:
+                await asyncio.sleep(REPORT_INTERVAL)
+                print_metrics(self.metrics)
+
+        parse_workers = self.parse_workers or os.cpu_count()
+        semaphore = asyncio.Semaphore(self.engine.concurrency)
+        self.engine.buckets = {}
+        with ThreadPoolExecutor(self.engine.concurrency) as fetch_executor, \
+                ProcessPoolExecutor(parse_workers) as processes, \
+                ThreadPoolExecutor(1) as persist_executor:
+            workers = [
+                asyncio.ensure_future(fetch(semaphore, fetch_executor))
+                for _ in range(self.engine.concurrency)
+            ]
+            workers += [
+                asyncio.ensure_future(parse(processes))
+                for _ in range(parse_workers)
+            ]
+            workers += [
+                asyncio.ensure_future(persist(persist_executor)),
+                asyncio.ensure_future(report())
+            ]
+
+            # a task is done once it is parsed and the tasks it led to are
+            # scheduled, so the frontier is only joined when all pages are in
+            await frontier.join()
+            await records.join()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+def print_metrics(metrics):
+    """
+    Print a line of metrics for every stage of a pipeline
+    """
+    for name, stage in metrics.items():
+        stage = stage.to_dict() if isinstance(stage, StageMetrics) else stage
+        print(
+            '{}: {} processed, {:.1f}/second, queue depth {} (max {})'.format(
+                name, stage['processed'], stage['per_second'],
+                stage['queue_depth'], stage['max_queue_depth']
+            )
+        )
@@ -0,0 +1,141 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from time import perf_counter
+import pandas as pd
+from pagestore import PageStore
+from scraper import PAGE_STORE_PATH, load_local_cache, parse_date_details
+
+# Offline reprocessing of the event pages in the page store, e.g. after fixing
+# a bug in parse_date_details or adding a field to it. Pages are only read from
+# the store, listings without a cached page are reported and skipped. Only the
+# rows of the listings that parsed are replaced in the date details file, the
+# rows of listings that are missing from the store or failed to parse are kept.
+
+EVENT_URL = 'https://www.residentadvisor.net/events/{}'
+
+# Number of pages read from the store and handed to the workers at a time
+BATCH_SIZE = 1000
+
+
+def parse_page(page):
+    """
+    Parse the details of a listing in a worker process
+
+    :param page:    Tuple of the listing id and the contents of its page
+
+    :return: Tuple of the listing id, its details and the error if it could
+    not be parsed
+    """
+    listing_id, content = page
+    try:
+        return listing_id, parse_date_details(listing_id, content), None
+    except Exception as e:
+        return listing_id, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def reextract_dates_details(club_dates, year, store, workers=None):
+    """
+    Parse the details of all the listings of a year from the page store with a
+    process pool
+
+    :param club_dates (DataFrame):  The dates to parse details for
+    :param year (int):              The year to parse details for
+    :param store (PageStore):       The page store to read pages from
+    :param workers:                 Number of processes, defaults to the
+                                    number of cores
+
+    :return: A tuple of a DataFrame of the details, a dict of errors per
+    listing id and a list of listing ids that are not in the store
+    """
+    club_dates = club_dates[
+        (club_dates['date'] >= '{}-01-01'.format(year)) &
+        (club_dates['date'] < '{}-01-01'.format(year + 1))
+    ]
+
+    details, errors, missing = [], {}, []
+
+    def cached_pages():
+        for index in club_dates.index:
+            content = store.get(EVENT_URL.format(int(index)))
+            if content is None:
+                missing.append(index)
+            else:
+                yield index, content
+
+    workers = workers or os.cpu_count()
+    start = perf_counter()
+    pages = cached_pages()
+    with ProcessPoolExecutor(workers) as executor:
+        while True:
+            batch = list(islice(pages, BATCH_SIZE))
+            if not batch:
+                break
+            chunksize = max(1, len(batch) // (workers * 4))
+            for listing_id, listing, error in executor.map(
+                parse_page, batch, chunksize=chunksize
+            ):
+                if error:
+                    errors[listing_id] = error
+                else:
+                    details.append(listing)
+    seconds = perf_counter() - start
+
+    parsed = len(details) + len(errors)
+    print('Parsed {} pages in {:.1f} seconds, {:.1f} pages/second'.format(
+        parsed, seconds, parsed / seconds if seconds else 0
+    ))
+    for listing_id, error in errors.items():
+        link = EVENT_URL.format(listing_id)
+        print('Error parsing {} {}'.format(link, error))
+    if missing:
+        print('{} listings are not in the page store'.format(len(missing)))
+
+    data = pd.DataFrame(details)
+    return data.set_index('id') if details else data, errors, missing
+
+
+def update_dates_details(path, details):
+    """
+    Replace the rows of re-parsed listings in a date details csv file and add
+    the new ones, keeping the rows of all other listings
+
+    :param path:    Path of the date details csv file
+    :param details: DataFrame of the re-parsed details indexed by id
+
+    :return: The updated DataFrame, it is only written if any listing was
+    re-parsed
+    """
+    data = pd.read_csv(path, index_col='id') if os.path.exists(path) \
+        else pd.DataFrame(index=pd.Index([], name='id'))
+    if not len(details):
+        return data
+    order = data.index.append(details.index.difference(data.index, sort=False))
+    data = pd.concat(
+        [data.drop(details.index, errors='ignore'), details], sort=False
+    ).reindex(order)
+    data.index.name = 'id'
+    # write to a temporary file so that a crash does not leave a partial file
+    temporary = '{}.tmp'.format(path)
+    data.to_csv(temporary)
+    os.replace(temporary, path)
+    return data
+
+
+if __name__ == "__main__":
+    year = int(sys.argv[1]) if len(sys.argv) > 1 else 2019
+    dates = load_local_cache(
+        '../data/top-clubs-dates.csv', index_col='id', parse_dates=['date']
+    )
+    with PageStore(PAGE_STORE_PATH) as page_store:
+        date_details, errors, missing = reextract_dates_details(
+            dates, year, page_store
+        )
+    update_dates_details(
+        '../data/date-details-{}.csv'.format(year), date_details
+    )
+    if errors or missing:
+        print('Kept the details of {} listings that were not re-parsed'.format(
+            len(errors) + len(missing)
+        ))
@@ -0,0 +1,180 @@
+import json
+import os
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import monotonic, time
+
+# Metrics of a scraping run by page type: how many pages were served from the
+# page store, a histogram of the latency of the requests that went to the
+# network, how long requests were held back by throttling and how long pages
+# took to parse. Pages parsed in a process pool by the pipeline are timed
+# including the hand off to the pool. Metrics are written as a JSON run report
+# at the end of a run.
+
+# Upper bounds in seconds of the buckets of the fetch latency histograms, the
+# last bucket counts the slower requests
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+class Histogram:
+    """
+    Counts of values in buckets with the given upper bounds
+    """
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def to_dict(self):
+        count = sum(self.counts)
+        return {
+            'bounds': self.bounds,
+            'counts': self.counts,
+            'count': count,
+            'mean_seconds': self.total / count if count else 0.0,
+            'max_seconds': self.maximum
+        }
+
+
+class ScrapeMetrics:
+    """
+    Cache hits, fetch latencies, throttling and parse times of a scraping run
+    """
+    def __init__(self):
+        self.started = time()
+        self.cache = {}
+        self.latency = {}
+        self.statuses = {}
+        self.throttled_seconds = 0.0
+        self.throttled_requests = 0
+        self.parse = {}
+        self.phases = {}
+        self.pipeline = None
+
+    def cache_lookup(self, kind, hit):
+        """
+        Count a lookup of a page of a type in the page store
+        """
+        counts = self.cache.setdefault(kind, {'hits': 0, 'misses': 0})
+        counts['hits' if hit else 'misses'] += 1
+
+    def fetched(self, kind, seconds, status=None):
+        """
+        Record a request of a page of a type that went to the network
+        """
+        self.latency.setdefault(kind, Histogram()).add(seconds)
+        if status is not None:
+            statuses = self.statuses.setdefault(kind, {})
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    def throttled(self, seconds):
+        """
+        Record the time a request waited for its turn
+        """
+        if seconds > 0:
+            self.throttled_seconds += seconds
+            self.throttled_requests += 1
+
+    def parsed(self, kind, seconds, pages=1):
+        parse = self.parse.setdefault(kind, {'pages': 0, 'seconds': 0.0})
+        parse['pages'] += pages
+        parse['seconds'] += seconds
+
+    @contextmanager
+    def parsing(self, kind):
+        """
+        Time the parsing of a page of a type in a with block
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.parsed(kind, monotonic() - start)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the run in a with block, e.g. scraping the clubs
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + \
+                monotonic() - start
+
+    def to_dict(self):
+        lookups = {
+            kind: dict(counts, hit_rate=counts['hits'] / (
+                counts['hits'] + counts['misses']
+            ))
+            for kind, counts in self.cache.items()
+        }
+        hits = sum(counts['hits'] for counts in self.cache.values())
+        total = hits + sum(counts['misses'] for counts in self.cache.values())
+        return {
+            'pid': os.getpid(),
+            'started': self.started,
+            'wall_seconds': time() - self.started,
+            'phases': self.phases,
+            'cache': {
+                'hit_rate': hits / total if total else None,
+                'page_types': lookups
+            },
+            'fetch_latency': {
+                kind: histogram.to_dict()
+                for kind, histogram in self.latency.items()
+            },
+            'statuses': self.statuses,
+            'throttled': {
+                'seconds': self.throttled_seconds,
+                'requests': self.throttled_requests
+            },
+            'parse': {
+                kind: dict(
+                    parse, mean_seconds=parse['seconds'] / parse['pages']
+                )
+                for kind, parse in self.parse.items() if parse['pages']
+            },
+            'pipeline': self.pipeline
+        }
+
+    def write(self, path):
+        """
+        Write the metrics as a JSON run report
+
+        :return: The report
+        """
+        report = self.to_dict()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as fp:
+            json.dump(report, fp, indent=2)
+        return report
+
+
+def print_report(report):
+    """
+    Print a summary of a scraping run report
+    """
+    cache = report['cache']
+    print('Cache hit rate: {}'.format(
+        '{:.1%}'.format(cache['hit_rate'])
+        if cache['hit_rate'] is not None else 'no lookups'
+    ))
+    for kind, latency in report['fetch_latency'].items():
+        print('Fetched {} {} pages, {:.2f} seconds on average, {:.2f} at '
+              'most'.format(latency['count'], kind, latency['mean_seconds'],
+                            latency['max_seconds']))
+    print('Throttled {} requests for {:.1f} seconds'.format(
+        report['throttled']['requests'], report['throttled']['seconds']
+    ))
+    for kind, parse in report['parse'].items():
+        print('Parsed {} {} pages, {:.1f} ms on average'.format(
+            parse['pages'], kind, parse['mean_seconds'] * 1000
+        ))
@@ -1,10 +1,15 @@
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse
-from time import sleep, time
+from bs4 import BeautifulSoup, SoupStrainer
+from time import monotonic, sleep, time
 from datetime import datetime
+import json
+import os
 import re
 import pandas as pd
+from fetch import FetchEngine, conditional_get, http_session, is_fresh, \
+    store_response
+from pagestore import PageStore
+from pipeline import Pipeline, Task, print_metrics
+from scrapemetrics import ScrapeMetrics, print_report
 
 
 # If enabled, check ./data to see if a local cache exists before scraping page
@@ -13,9 +18,53 @@ USE_LOCAL_CACHE = True
 # Throttle according to robots.txt - https://www.residentadvisor.net/robots.txt
 CRAWL_DELAY = 10.0
 LAST_REQUEST = time() - CRAWL_DELAY
+RA_HOST = 'www.residentadvisor.net'
+
+# Fetched pages are kept compressed in a SQLite page store, pages cached as
+# html files by earlier versions can be migrated by running pagestore.py
+PAGE_STORE_PATH = '../html/pages.db'
+HTML_CACHE_DIR = '../html/'
+PAGE_STORE = None
+
+# Number of seconds after which stored pages of each type are revalidated with
+# a conditional request, None to never revalidate them, e.g. 7 * 24 * 60 * 60
+# for a week. Types are region listings, club pages, club year listings and
+# event pages.
+MAX_AGE = {
+    'region': None,
+    'club': None,
+    'year': None,
+    'event': None,
+}
+SESSION = None
+
+# If enabled, fetch event pages concurrently with the engine in fetch.py,
+# cached pages are read without waiting and the rest is throttled per host
+ASYNC_FETCH = True
+FETCH_CONCURRENCY = 4
+
+# If enabled, club year listings and the details of their dates are scraped
+# with the staged pipeline in pipeline.py instead of level by level
+USE_PIPELINE = True
+PARSE_WORKERS = None
+
+# Cache hits, fetch latencies, throttling and parse times of the run, written
+# to RUN_REPORT_PATH at the end of a run, see scrapemetrics.py
+METRICS = ScrapeMetrics()
+RUN_REPORT_PATH = '../data/reports/scrape-{}.json'
 
 RA_IMAGE_PATH = '/images/events/flyer/'
 
+# If enabled, parse pages with lxml when it is installed, only parse the parts
+# of pages that are used and look up elements with a single pass over the
+# document instead of a search of the whole document per lookup
+FAST_EXTRACTION = True
+try:
+    import lxml  # noqa: F401
+    FAST_PARSER = 'lxml'
+except ImportError:
+    FAST_PARSER = 'html.parser'
+
 TIME_PATTERN = ''.join([
     # the hour part e.g. '1', '01' or '23'
     '(?:[1-9]|0[0-9]|1[0-9]|2[0-3]|0(?![1-9]))',
@@ -56,39 +105,80 @@ def load_local_cache(file_path,  index_col=None, parse_dates=None):
 
 def get_url(url):
     """
-    Get the contents of a url. Check for local cache in ./html if it exists and
-     caching is enabled. Save the results to the cache if the file did not exist
+    Get the contents of a url. Check the page store in ./html if caching is
+    enabled. Save the results to the page store if the page was not there,
+    pages older than their MAX_AGE are revalidated with RA
 
     :param url:     The url to fetch contents for
 
     :return: String representation of the contents.
     """
-    global LAST_REQUEST
-    content = ''
-    parsed_url = urlparse(url)
-    path = '../html/{}-{}-{}.html'.format(
-        parsed_url.netloc,
-        parsed_url.path[1:].replace('/', '-'),
-        parsed_url.query
-    ).replace('--', '-')
+    global LAST_REQUEST, SESSION
+    page = None
+    store = page_store()
     if USE_LOCAL_CACHE:
-        try:
-            with open(path, 'r') as fp:
-                content = fp.read()
-        except IOError:
-            pass
-    if not content:
-        wait = (time() - LAST_REQUEST)
-        if wait < CRAWL_DELAY:
-            print('Sleeping for {} seconds'.format(CRAWL_DELAY - wait))
-            sleep(CRAWL_DELAY - wait)
-        LAST_REQUEST = time()
-        r = requests.get(url)
-        if r.status_code == 200:
-            with open(path, 'w+') as fp:
-                fp.write(r.text)
-            content = r.content
-    return content
+        page = store.page(url)
+        fresh = is_fresh(page, max_age(url))
+        METRICS.cache_lookup(page_type(url), fresh)
+        if fresh:
+            return page.content
+
+    wait = (time() - LAST_REQUEST)
+    if wait < CRAWL_DELAY:
+        print('Sleeping for {} seconds'.format(CRAWL_DELAY - wait))
+        sleep(CRAWL_DELAY - wait)
+        METRICS.throttled(CRAWL_DELAY - wait)
+    LAST_REQUEST = time()
+    if SESSION is None:
+        SESSION = http_session()
+    start = monotonic()
+    response = conditional_get(SESSION, url, page)
+    METRICS.fetched(page_type(url), monotonic() - start, response.status_code)
+    return store_response(store, url, response, page)
+
+
+def page_type(url):
+    """
+    Get the type of an RA page, one of the keys of MAX_AGE
+    """
+    if 'club.aspx' in url:
+        return 'year' if 'show=events' in url else 'club'
+    if re.search(r'/events/\d+$', url):
+        return 'event'
+    return 'region'
+
+
+def max_age(url):
+    """
+    Get the number of seconds after which a stored page is revalidated
+    """
+    return MAX_AGE.get(page_type(url))
+
+
+def page_store():
+    """
+    Get the page store, opened on first use
+    """
+    global PAGE_STORE
+    if PAGE_STORE is None:
+        PAGE_STORE = PageStore(PAGE_STORE_PATH)
+    return PAGE_STORE
+
+
+def fetch_engine():
+    """
+    Get a fetch engine that uses the page store and throttles requests to
+    RA according to CRAWL_DELAY
+    """
+    return FetchEngine(
+        page_store(),
+        delays={RA_HOST: CRAWL_DELAY},
+        concurrency=FETCH_CONCURRENCY,
+        use_cache=USE_LOCAL_CACHE,
+        max_age=max_age,
+        metrics=METRICS,
+        page_type=page_type
+    )
 
 
 def get_top_regions():
@@ -111,8 +201,21 @@ def get_top_regions():
     if not data.empty:
         return data
 
-    data = []
     content = get_url(url)
+    with METRICS.parsing('region'):
+        data = parse_top_regions(content)
+
+    df = pd.DataFrame(data)
+    df.to_csv('../data/top-regions.csv', index=False)
+    return df
+
+
+def parse_top_regions(content):
+    """
+    Parse the top regions from the contents of the events page, see
+    get_top_regions
+    """
+    data = []
     soup = BeautifulSoup(content, 'html.parser')
     regions_section = soup.find_all('section', class_='top-list')[1]
     regions_list = regions_section.find('ul')
@@ -137,10 +240,7 @@ def get_top_regions():
             'region': link,
             'rank': len(data)
         })
-
-    df = pd.DataFrame(data)
-    df.to_csv('../data/top-regions.csv', index=False)
-    return df
+    return data
 
 
 def get_top_clubs(regions):
@@ -168,21 +268,8 @@ def get_top_clubs(regions):
         if region_index not in data.region.unique():
             url = 'https://www.residentadvisor.net{}'.format(region_index)
             content = get_url(url)
-            soup = BeautifulSoup(content, 'html.parser')
-            popular_clubs = soup.find('div', class_='popularClubs')
-            venues = popular_clubs.find('ul', class_='tileListing')
-
-            top_clubs = []
-            for index, venue in enumerate(venues.find_all('li')):
-                address_text = venue.find('p', class_='copy').get_text()
-                top_clubs.append({
-                    'id': venue.get('data-id'),
-                    'img': venue.find('img').get('src'),
-                    'name': venue.find('h1').get_text().strip(),
-                    'address': address_text.replace('\n', ''),
-                    'rank': index,
-                    'region': region_index
-                })
+            with METRICS.parsing('region'):
+                top_clubs = parse_region_clubs(region_index, content)
             data = data.append(pd.DataFrame.from_records(top_clubs, index='id'))
             data.to_csv(data_path)
 
@@ -198,23 +285,61 @@ def get_top_clubs(regions):
         content = get_url(
             'https://www.residentadvisor.net/club.aspx?id={}'.format(club_id)
         )
-        soup = BeautifulSoup(content, 'html.parser')
-        try:
-            data.at[club_id, 'capacity'] = int(find_and_extract(
-                soup, 'div', 'Capacity /', re.compile('Capacity /(.*)')
-            ).replace(',', ''))
-        except AttributeError:
-            data.at[club_id, 'capacity'] = 0
-
-        followers_elem = soup.find('h1', id='MembersFavouriteCount')
-        data.at[club_id, 'followers'] = int(
-            followers_elem.get_text().replace(',', '')
-        )
+        with METRICS.parsing('club'):
+            capacity, followers = parse_club_details(content)
+        data.at[club_id, 'capacity'] = capacity
+        data.at[club_id, 'followers'] = followers
 
     data.to_csv(data_path)
     return data
 
 
+def parse_region_clubs(region_index, content):
+    """
+    Parse the top clubs of a region from the contents of its events page, see
+    get_top_clubs
+    """
+    soup = make_soup(
+        content, SoupStrainer('div', class_='popularClubs')
+    )
+    popular_clubs = soup.find('div', class_='popularClubs')
+    venues = popular_clubs.find('ul', class_='tileListing')
+
+    top_clubs = []
+    for index, venue in enumerate(venues.find_all('li')):
+        address_text = venue.find('p', class_='copy').get_text()
+        top_clubs.append({
+            'id': venue.get('data-id'),
+            'img': venue.find('img').get('src'),
+            'name': venue.find('h1').get_text().strip(),
+            'address': address_text.replace('\n', ''),
+            'rank': index,
+            'region': region_index
+        })
+    return top_clubs
+
+
+def parse_club_details(content):
+    """
+    Parse the capacity and number of followers of a club from the contents of
+    its page, see get_top_clubs
+
+    :return: A tuple of capacity and followers, capacity is 0 if it is missing
+    """
+    soup = make_soup(content)
+    divs = element_index(soup, 'div')
+    try:
+        capacity = int(extract_label(
+            divs.string('Capacity /'), re.compile('Capacity /(.*)')
+        ).replace(',', ''))
+    except AttributeError:
+        capacity = 0
+
+    followers_elem = soup.find('h1', id='MembersFavouriteCount')
+    followers = int(followers_elem.get_text().replace(',', ''))
+    return capacity, followers
+
+
 def get_top_club_dates(top_clubs):
     """
     Get overview of all club dates for every club in top_clubs from 2010 to
@@ -258,10 +383,19 @@ def get_club_year_dates(club_id, year):
         * img link to a thumbnail for that event
         * attending the number of users that attended the event
     """
-    data = []
     url = 'https://www.residentadvisor.net/club.aspx?id={}&show=events&yr={}'
     content = get_url(url.format(club_id, year))
-    soup = BeautifulSoup(content, 'html.parser')
+    with METRICS.parsing('year'):
+        return parse_club_year_dates(club_id, content)
+
+
+def parse_club_year_dates(club_id, content):
+    """
+    Parse the dates of a club from the contents of its events page for a year,
+    see get_club_year_dates
+    """
+    data = []
+    soup = make_soup(content, SoupStrainer('article'))
     articles = soup.find_all('article')
     for article in articles:
         date_element = article.find('p', class_='date')
@@ -277,7 +411,7 @@ def get_club_year_dates(club_id, year):
         else:
             img = img.replace(RA_IMAGE_PATH, '')
         date = datetime.strptime(date, '%a, %d %b %Y')
-        event_id = int(article.find('a').get('href').replace('/events/', '')),
+        event_id = int(article.find('a').get('href').replace('/events/', ''))
         if date.year > 2009 and date.year < 2020:
             data.append({
                 'date': date,
@@ -292,7 +426,9 @@ def get_club_year_dates(club_id, year):
 
 def get_all_dates_details(club_dates, year):
     """
-    Get details for all the listings of a club
+    Get details for all the listings of a club. Parsed listings are appended
+    to a journal as they come in, so that a run can be resumed after a crash,
+    and the journal is compacted into ./data/date-details-<year>.csv at the end
 
     :param club_dates (DataFrame): A list of dates to fetch details for
     :param year (string): A year to make file sizes more manageable
@@ -300,7 +436,11 @@ def get_all_dates_details(club_dates, year):
     :return: DataFrame for events
     """
     data_path = '../data/date-details-{}.csv'.format(year)
-    data = load_local_cache(data_path, index_col='id')
+    journal_path = '../data/date-details-{}.jsonl'.format(year)
+    # listings journaled by an earlier run that did not finish
+    data = compact_journal(
+        load_local_cache(data_path, index_col='id'), journal_path, data_path
+    )
 
     club_dates = club_dates[
         (club_dates['date'] >= '{}-01-01'.format(year)) &
@@ -309,32 +449,192 @@ def get_all_dates_details(club_dates, year):
 
     # we don't have to fetch details that are already there
     club_dates = club_dates[~club_dates.index.isin(data.index)]
-    additions = []
 
-    for pos, (index, listing) in enumerate(club_dates.iterrows()):
-        if pos % 100 == 0:
-            print("Currently on row: {}; Fetched {}% of {} rows".format(
-                pos, ((pos + 1)/len(club_dates)) * 100, len(club_dates))
-            )
-        try:
-            additions.append(get_date_details(index))
-        except AttributeError as e:
-            link = 'https://www.residentadvisor.net/events/{}'.format(
-                int(index)
+    with open(journal_path, 'a') as journal:
+        def add_date_details(pos, index, content):
+            if pos % 100 == 0:
+                print("Currently on row: {}; Fetched {}% of {} rows".format(
+                    pos, ((pos + 1)/len(club_dates)) * 100, len(club_dates))
+                )
+            try:
+                with METRICS.parsing('event'):
+                    details = parse_date_details(index, content)
+                append_to_journal(journal, details)
+            except AttributeError as e:
+                link = 'https://www.residentadvisor.net/events/{}'.format(
+                    int(index)
+                )
+                print('Error fetching {} {}'.format(link, e))
+
+        links = [
+            'https://www.residentadvisor.net/events/{}'.format(int(index))
+            for index in club_dates.index
+        ]
+        if ASYNC_FETCH:
+            # the callback is called in the order of the links
+            listings = enumerate(club_dates.index)
+            fetch_engine().fetch_all(
+                links,
+                callback=lambda link, content: add_date_details(
+                    *next(listings), content
+                )
             )
-            print('Error fetching {} {}'.format(link, e))
+        else:
+            for pos, (index, link) in enumerate(zip(club_dates.index, links)):
+                add_date_details(pos, index, get_url(link))
 
-        # save csv every 100 events in case of exceptions
-        if len(additions) % 100 == 0:
-            data = data.append(pd.DataFrame(additions).set_index('id'))
-            data.to_csv(data_path)
-            additions = []
+    return compact_journal(data, journal_path, data_path)
 
-    data = data.append(pd.DataFrame(additions).set_index('id'))
-    data.to_csv(data_path)
+
+def append_to_journal(journal, details):
+    """
+    Append the details of a listing to a journal as a line of JSON, the line is
+    flushed so that it survives a crash of the scraper
+    """
+    journal.write(json.dumps(details, default=int) + '\n')
+    journal.flush()
+
+
+def read_journal(journal_path):
+    """
+    Read the listings in a journal, a partially written last line from a crash
+    is skipped
+
+    :return: A list of listing details
+    """
+    details = []
+    try:
+        with open(journal_path, 'r') as journal:
+            for line in journal:
+                try:
+                    details.append(json.loads(line))
+                except ValueError:
+                    print('Skipping partial journal line {}'.format(line))
+    except IOError:
+        pass
+    return details
+
+
+def compact_journal(data, journal_path, data_path):
+    """
+    Add the listings in a journal to the data, write the data to data_path and
+    remove the journal
+
+    :return: DataFrame for events
+    """
+    details = read_journal(journal_path)
+    if details:
+        data = data.append(pd.DataFrame(details).set_index('id'))
+        # a crash after writing the data leaves the journal of listings that
+        # are already in the data
+        data = data[~data.index.duplicated(keep='last')]
+        # write to a temporary file so that a crash does not leave a partial
+        # file
+        temporary = '{}.tmp'.format(data_path)
+        data.to_csv(temporary)
+        os.replace(temporary, data_path)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
     return data
 
 
+def scrape_dates_and_details(clubs, year):
+    """
+    Get the dates of the top clubs for a year and the details of those dates
+    with the scraping pipeline, details are fetched as soon as the year listing
+    of a club is parsed. Save the results to ./data/top-clubs-dates.csv and
+    ./data/date-details-<year>.csv
+
+    :param clubs (DataFrame):   The clubs to fetch dates for
+    :param year (int):          The year to fetch dates for
+
+    :return: A tuple of DataFrames of the dates and of the date details
+    """
+    dates_path = '../data/top-clubs-dates.csv'
+    dates_journal_path = '../data/top-clubs-dates.jsonl'
+    details_path = '../data/date-details-{}.csv'.format(year)
+    details_journal_path = '../data/date-details-{}.jsonl'.format(year)
+    year_url = 'https://www.residentadvisor.net/club.aspx' \
+        '?id={}&show=events&yr={}'
+    event_url = 'https://www.residentadvisor.net/events/{}'
+
+    # records journaled by an earlier run that did not finish
+    dates = compact_journal(
+        load_local_cache(dates_path, index_col='id', parse_dates=['date']),
+        dates_journal_path,
+        dates_path
+    )
+    details = compact_journal(
+        load_local_cache(details_path, index_col='id'),
+        details_journal_path,
+        details_path
+    )
+    known_clubs = dates['club_id'].unique() if not dates.empty else []
+    year_dates = dates[
+        (dates['date'] >= '{}-01-01'.format(year)) &
+        (dates['date'] < '{}-01-01'.format(year + 1))
+    ] if not dates.empty else dates
+
+    tasks = [
+        Task(1, 'year', (club_id, year), year_url.format(club_id, year))
+        for club_id in clubs.index if club_id not in known_clubs
+    ] + [
+        Task(0, 'event', int(index), event_url.format(int(index)))
+        for index in year_dates.index if index not in details.index
+    ]
+    seen = [event_url.format(int(index)) for index in details.index]
+    date_ids = set(dates.index)
+
+    with open(dates_journal_path, 'a') as dates_journal, \
+            open(details_journal_path, 'a') as details_journal:
+        def persist(records):
+            for kind, record in records:
+                if kind == 'details':
+                    append_to_journal(details_journal, record)
+                elif record['id'] not in date_ids:
+                    # year pages of clubs with few events repeat dates
+                    date_ids.add(record['id'])
+                    append_to_journal(dates_journal, dict(
+                        record, date=record['date'].strftime('%Y-%m-%d')
+                    ))
+
+        pipeline = Pipeline(
+            fetch_engine(), parse_pipeline_page, persist, PARSE_WORKERS
+        )
+        METRICS.pipeline = pipeline.run(tasks, seen)
+        print_metrics(METRICS.pipeline)
+
+    dates = compact_journal(dates, dates_journal_path, dates_path)
+    dates['date'] = pd.to_datetime(dates['date'])
+    details = compact_journal(details, details_journal_path, details_path)
+    return dates, details
+
+
+def parse_pipeline_page(kind, key, content):
+    """
+    Parse a page for the scraping pipeline, see scrape_dates_and_details
+
+    :param kind:    'year' for club year listings or 'event' for event pages
+    :param key:     Tuple of club id and year for year listings, the listing id
+                    for event pages
+    :param content: The contents of the page
+
+    :return: A tuple of the parsed records and the event pages to fetch next
+    """
+    if kind == 'year':
+        club_id, year = key
+        dates = parse_club_year_dates(club_id, content)
+        tasks = [
+            Task(
+                0, 'event', date['id'],
+                'https://www.residentadvisor.net/events/{}'.format(date['id'])
+            )
+            for date in dates if date['date'].year == year
+        ]
+        return [('date', date) for date in dates], tasks
+    return [('details', parse_date_details(key, content))], []
+
+
 def get_date_details(listing_id):
     """
     Get the details for a specific listing
@@ -347,24 +647,33 @@ def get_date_details(listing_id):
     """
     link = 'https://www.residentadvisor.net/events/{}'.format(int(listing_id))
     content = get_url(link)
-    soup = BeautifulSoup(content, 'html.parser')
+    with METRICS.parsing('event'):
+        return parse_date_details(listing_id, content)
+
+
+def parse_date_details(listing_id, content):
+    """
+    Parse the details of a listing from the contents of its page, see
+    get_date_details
+    """
+    link = 'https://www.residentadvisor.net/events/{}'.format(int(listing_id))
+    soup = make_soup(content)
+    divs = element_index(soup, 'div')
 
-    date = find_and_extract(soup, 'div', 'Date /', TIME_REGEX, text=False)
+    date = extract_label(divs.string('Date /'), TIME_REGEX, text=False)
     try:
         start_time, end_time = extract_datetimes(date)
     except Exception:
         print('Error parsing {} datestring on {}'.format(date, link))
         start_time, end_time = None, None
-    cost = find_and_extract(soup, 'div', 'Cost /', re.compile('Cost /(.*)'))
-    age = find_and_extract(
-        soup,
-        'div',
-        'Minimum age /',
+    cost = extract_label(divs.string('Cost /'), re.compile('Cost /(.*)'))
+    age = extract_label(
+        divs.string('Minimum age /'),
         re.compile('Minimum age /(.*)')
     )
 
     promoters = []
-    promoter_tag = soup.find('div', text='Promoters /')
+    promoter_tag = divs.string('Promoters /')
     if promoter_tag:
         for promoter in promoter_tag.parent.find_all('a'):
             link = promoter.get('href')
@@ -374,7 +683,7 @@ def get_date_details(listing_id):
                     promoter.get_text()
                 ])
 
-    event_item = soup.find('div', id='event-item')
+    event_item = divs.id('event-item')
 
     artists = []
     lineup = event_item.find('p', class_='lineup')
@@ -411,26 +720,24 @@ def get_date_details(listing_id):
         'promoters': promoters,
         'flyers': flyers,
         'artists': artists,
-        'pick': True if soup.find('div', class_='pick-icon') else False,
+        'pick': True if divs.class_('pick-icon') else False,
         'attending': attending
     }
     return data
 
 
-def find_and_extract(soup, tag, search_string, regex, text=True):
+def extract_label(elem, regex, text=True):
     """
-    Check if a tag containing the string_match exists in soup, if so check for
-    matches of the regex within the parent element and return them if they exist
+    Search for matches of the regex within the parent element of a label
+    element, e.g. of the 'Capacity /' label of a club that parse_club_details
+    finds with element_index, or the labels of parse_date_details
 
-    :param soup:    BeautifulSoup tree
-    :param tag:     Which kind of html tag to search for
-    :param search_string:  The string contents of that tag
+    :param elem:    The label element, None if it was not found
     :param regex:   Regex for the attribute that we are after
     :param text:    Whether to search in all text of the element or not
 
     :return: The first match if any exists.
     """
-    elem = soup.find(tag, string=search_string)
     if elem:
         if text:
             t = elem.parent.get_text()
@@ -443,6 +750,67 @@ def find_and_extract(soup, tag, search_string, regex, text=True):
     return None
 
 
+def make_soup(content, parse_only=None):
+    """
+    Parse the contents of a page, with FAST_EXTRACTION only the parts matching
+    the parse_only strainer are kept
+    """
+    if FAST_EXTRACTION:
+        return BeautifulSoup(content, FAST_PARSER, parse_only=parse_only)
+    return BeautifulSoup(content, 'html.parser')
+
+
+def element_index(soup, tag):
+    """
+    Get an index of the elements in a document with a given tag name, with
+    FAST_EXTRACTION it is built in a single pass over the document
+    """
+    return ElementIndex(soup, tag) if FAST_EXTRACTION else ElementSearch(
+        soup, tag
+    )
+
+
+class ElementIndex:
+    """
+    Look up the first element with a tag name by its string, id or class, the
+    same element soup.find would return
+    """
+    def __init__(self, soup, tag):
+        self.strings, self.ids, self.classes = {}, {}, {}
+        for elem in soup.find_all(tag):
+            self.strings.setdefault(elem.string, elem)
+            self.ids.setdefault(elem.get('id'), elem)
+            for class_ in elem.get('class', []):
+                self.classes.setdefault(class_, elem)
+
+    def string(self, string):
+        return self.strings.get(string)
+
+    def id(self, id_):
+        return self.ids.get(id_)
+
+    def class_(self, class_):
+        return self.classes.get(class_)
+
+
+class ElementSearch:
+    """
+    Look up elements with a search of the whole document, see ElementIndex
+    """
+    def __init__(self, soup, tag):
+        self.soup = soup
+        self.tag = tag
+
+    def string(self, string):
+        return self.soup.find(self.tag, string=string)
+
+    def id(self, id_):
+        return self.soup.find(self.tag, id=id_)
+
+    def class_(self, class_):
+        return self.soup.find(self.tag, class_=class_)
+
+
 def extract_datetimes(date_string):
     if not date_string:
         return [None, None]
@@ -467,8 +835,16 @@ def extract_datetimes(date_string):
     return times
 
 if __name__ == "__main__":
-    regions = get_top_regions()
-    clubs = get_top_clubs(regions)
-    dates = get_top_club_dates(clubs)
-
-    date_details = get_all_dates_details(dates, 2019)
+    with METRICS.phase('regions'):
+        regions = get_top_regions()
+    with METRICS.phase('clubs'):
+        clubs = get_top_clubs(regions)
+    with METRICS.phase('dates'):
+        if USE_PIPELINE:
+            dates, date_details = scrape_dates_and_details(clubs, 2019)
+        else:
+            dates = get_top_club_dates(clubs)
+            date_details = get_all_dates_details(dates, 2019)
+    print_report(METRICS.write(RUN_REPORT_PATH.format(
+        datetime.now().strftime('%Y%m%d-%H%M%S')
+    )))
@@ -1,40 +1,123 @@
-from scraper import get_date_details, extract_datetimes
+from scraper import get_date_details, extract_datetimes, \
+    append_to_journal, compact_journal, read_journal, parse_date_details, \
+    parse_club_year_dates, parse_region_clubs, parse_club_details
+import scraper
+from fetch import FetchEngine
+from reextract import (
+    reextract_dates_details, update_dates_details, EVENT_URL
+)
+from pipeline import Pipeline, Task
+import pipeline
+from scrapemetrics import Histogram, ScrapeMetrics
+from pagestore import PageStore, migrate_html_directory, url_from_file_name
+import pagestore
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import monotonic, time
 from unittest import TestCase
+import json
+import os
+import pandas as pd
+import tempfile
+
+
+LISTING_DETAILS = {
+    'id': 1281396,
+    'start_time': '23:00',
+    'end_time': '06:00',
+    'cost': None,
+    'age': '19+',
+    'promoters': [
+        ['967', 'fabric'],
+        ['28605', 'JR Events'],
+        ['68697', 'FABRICLIVE']
+    ],
+    'flyers': [
+        '2019/11/uk-1129-1281396-1527425-front.jpg',
+        '2019/11/uk-1129-1281396-1527425-back.jpg'
+    ],
+    'attending': 672,
+    'artists': [
+        ['spectrasoul', 'SpectraSoul'], ['breakage', 'Breakage'],
+        ['technimatic-uk', 'Technimatic'], ['icicle', 'Icicle'],
+        ['edit-de', 'Ed:it'], ['glxy', 'GLXY'],
+        ['lowqui', 'LowQui'], ['visionobi', 'Visionobi'],
+        ['phace', 'Phace'], ['misanthrop', 'Misanthrop'],
+        ['halogenix', 'Halogenix'], ['lxone', 'LX one'],
+        ['djpatife', 'DJ Patife']
+    ],
+    'pick': False
+}
+
+
+def parse_stub_page(kind, key, content):
+    """
+    Parse function for the pipeline test, listing pages contain the urls of
+    item pages separated by spaces
+    """
+    if kind == 'listing':
+        return [], [
+            Task(0, 'item', url, url) for url in content.split(' ')
+        ]
+    return [(key, content)], []
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves fixture pages from the pages dict of the server, with an ETag of
+    their contents and keep alive connections
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.connections.add(self.client_address)
+        page = self.server.pages.get(self.path)
+        body = page.encode('utf-8') if page is not None else b''
+        etag = '"{}"'.format(hash(page))
+        if page is not None and self.headers.get('If-None-Match') == etag:
+            self.server.not_modified.append(self.path)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200 if page is not None else 404)
+        self.send_header('Content-Length', str(len(body)))
+        if page is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Local stand in for RA that serves fixture pages
+    """
+    def __init__(self, pages):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.pages = pages
+        self.requests = []
+        self.not_modified = []
+        self.connections = set()
+        self.host = '127.0.0.1:{}'.format(self.server_port)
+
+    def __enter__(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
 
 
 class ScraperTest(TestCase):
 
     def test_get_listing_details(self):
         data = get_date_details(1281396)
-        expected_data = {
-            'id': 1281396,
-            'start_time': '23:00',
-            'end_time': '06:00',
-            'cost': None,
-            'age': '19+',
-            'promoters': [
-                ['967', 'fabric'],
-                ['28605', 'JR Events'],
-                ['68697', 'FABRICLIVE']
-            ],
-            'flyers': [
-                '2019/11/uk-1129-1281396-1527425-front.jpg',
-                '2019/11/uk-1129-1281396-1527425-back.jpg'
-            ],
-            'attending': 672,
-            'artists': [
-                ['spectrasoul', 'SpectraSoul'], ['breakage', 'Breakage'],
-                ['technimatic-uk', 'Technimatic'], ['icicle', 'Icicle'],
-                ['edit-de', 'Ed:it'], ['glxy', 'GLXY'],
-                ['lowqui', 'LowQui'], ['visionobi', 'Visionobi'],
-                ['phace', 'Phace'], ['misanthrop', 'Misanthrop'],
-                ['halogenix', 'Halogenix'], ['lxone', 'LX one'],
-                ['djpatife', 'DJ Patife']
-            ],
-            'pick': False
-        }
-
-        self.assertEqual(expected_data, data)
+        self.assertEqual(LISTING_DETAILS, data)
 
     def test_time_extraction(self):
         self.assertEqual(extract_datetimes('23:00 - 06:00'), ['23:00', '06:00'])
@@ -61,7 +144,376 @@ class ScraperTest(TestCase):
             extract_datetimes('00h00pm - 07h00am'), ['12:00', '07:00']
         )
 
+    def test_fetch_engine(self):
+        pages = {
+            '/events/{}'.format(i): '<html>{}</html>'.format(i)
+            for i in range(3)
+        }
+        with StubServer(pages) as server, \
+                tempfile.TemporaryDirectory() as directory, \
+                PageStore(os.path.join(directory, 'pages.db')) as store:
+            urls = ['http://{}{}'.format(server.host, p) for p in pages]
+            urls.append('http://{}/events/missing'.format(server.host))
+            engine = FetchEngine(store, delays={server.host: 0.2})
+
+            start = monotonic()
+            fetched, contents = [], []
+
+            def collect(url, content):
+                fetched.append(url)
+                contents.append(content)
+
+            engine.fetch_all(urls, callback=collect)
+            msg = 'Requests to the same host should be throttled'
+            self.assertGreaterEqual(monotonic() - start, 0.6, msg=msg)
+            self.assertEqual(list(pages.values()) + [''], contents)
+            self.assertEqual(urls, fetched)
+
+            start = monotonic()
+            self.assertEqual(contents[:3], engine.fetch_all(urls[:3]))
+            msg = 'Cached pages should be served without throttling'
+            self.assertLess(monotonic() - start, 0.2, msg=msg)
+            self.assertEqual(4, len(server.requests), msg=msg)
+            self.assertEqual(404, store.record(urls[-1])[0])
+
+            msg = 'Failed requests should not stop the other urls'
+            unreachable = 'http://127.0.0.1:1/events/unreachable'
+            fetched = []
+            result = engine.fetch_all(
+                (url for url in [unreachable] + urls[:3]),
+                callback=lambda url, content: fetched.append((url, content))
+            )
+            self.assertIsNone(result)
+            self.assertEqual(
+                [(unreachable, '')] + list(zip(urls[:3], contents[:3])),
+                fetched, msg=msg
+            )
+
+    def test_scrape_metrics(self):
+        pages = {
+            '/events/{}'.format(i): '<html>{}</html>'.format(i)
+            for i in range(3)
+        }
+        with StubServer(pages) as server, \
+                tempfile.TemporaryDirectory() as directory, \
+                PageStore(os.path.join(directory, 'pages.db')) as store:
+            urls = ['http://{}{}'.format(server.host, p) for p in pages]
+            urls.append('http://{}/missing'.format(server.host))
+            metrics = ScrapeMetrics()
+            engine = FetchEngine(
+                store, delays={server.host: 0.1}, metrics=metrics,
+                page_type=lambda url: 'event' if 'events' in url else 'other'
+            )
+            engine.fetch_all(urls)
+            engine.fetch_all(urls[:3])
+            for url in urls[:3]:
+                with metrics.parsing('event'):
+                    extract_datetimes('23:00 - 06:00')
+            path = os.path.join(directory, 'reports', 'scrape.json')
+            metrics.write(path)
+            with open(path) as fp:
+                report = json.load(fp)
+
+        self.assertEqual(
+            {'hits': 3, 'misses': 3, 'hit_rate': 0.5},
+            report['cache']['page_types']['event']
+        )
+        self.assertEqual(3 / 7, report['cache']['hit_rate'])
+        self.assertEqual(3, report['fetch_latency']['event']['count'])
+        self.assertEqual({'404': 1}, report['statuses']['other'])
+        msg = 'Requests after the first should wait for their turn'
+        self.assertEqual(3, report['throttled']['requests'], msg=msg)
+        self.assertGreater(report['throttled']['seconds'], 0.2, msg=msg)
+        self.assertEqual(3, report['parse']['event']['pages'])
+
+        histogram = Histogram([1, 2])
+        for value in [0.5, 1, 1.5, 3]:
+            histogram.add(value)
+        self.assertEqual([2, 1, 1], histogram.to_dict()['counts'])
+
+    def test_page_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with PageStore(os.path.join(directory, 'pages.db')) as store:
+                store.put('https://ra.co/events/1', '<html>é</html>')
+                store.put('https://ra.co/events/2', '<html>é</html>')
+                store.put('https://ra.co/events/3', '', status=404)
+                store.put('https://ra.co/clubs/1', '<html>club</html>')
+
+                self.assertEqual(
+                    '<html>é</html>', store.get('https://ra.co/events/1')
+                )
+                self.assertIsNone(store.get('https://ra.co/events/3'))
+                self.assertIn('https://ra.co/events/3', store)
+                self.assertNotIn('https://ra.co/events/4', store)
+                self.assertEqual(4, len(store))
+                self.assertEqual(
+                    ['https://ra.co/events/1', 'https://ra.co/events/2'],
+                    sorted(url for url, _ in store.items(
+                        'https://ra.co/events/'
+                    ))
+                )
+                msg = 'Pages should be read in batches that release the ' \
+                    'store'
+                batch_size = pagestore.ITEMS_BATCH_SIZE
+                pagestore.ITEMS_BATCH_SIZE = 1
+                try:
+                    items = []
+                    for url, content in store.items('https://ra.co/'):
+                        store.touch(url)
+                        items.append((url, content))
+                finally:
+                    pagestore.ITEMS_BATCH_SIZE = batch_size
+                self.assertEqual([
+                    ('https://ra.co/events/1', '<html>é</html>'),
+                    ('https://ra.co/events/2', '<html>é</html>'),
+                    ('https://ra.co/clubs/1', '<html>club</html>')
+                ], items, msg=msg)
+                msg = 'Pages with the same contents should be stored once'
+                self.assertEqual(2, store.connection.execute(
+                    'SELECT COUNT(*) FROM bodies'
+                ).fetchone()[0], msg=msg)
+
+    def test_migrate_html_directory(self):
+        files = {
+            'www.residentadvisor.net-events-1281396.html':
+                'https://www.residentadvisor.net/events/1281396',
+            'www.residentadvisor.net-events-.html':
+                'https://www.residentadvisor.net/events',
+            'www.residentadvisor.net-club.aspx-id=237.html':
+                'https://www.residentadvisor.net/club.aspx?id=237',
+            'www.residentadvisor.net-club.aspx-id=237&show=events&yr=2019.html':
+                'https://www.residentadvisor.net/club.aspx?id=237&'
+                'show=events&yr=2019',
+        }
+        for file_name, url in files.items():
+            self.assertEqual(url, url_from_file_name(file_name))
 
+        with tempfile.TemporaryDirectory() as directory:
+            for file_name in files:
+                with open(os.path.join(directory, file_name), 'w') as fp:
+                    fp.write(file_name)
+            path = os.path.join(directory, 'pages.db')
+            with PageStore(path) as store:
+                self.assertEqual(4, migrate_html_directory(store, directory))
+                self.assertEqual(0, migrate_html_directory(store, directory))
+                for file_name, url in files.items():
+                    self.assertEqual(file_name, store.get(url))
 
+    def test_journal(self):
+        details = [
+            {
+                'id': listing_id, 'artists': [[str(listing_id), 'Artist']],
+                'attending': listing_id, 'pick': False
+            }
+            for listing_id in range(1, 4)
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            data_path = os.path.join(directory, 'date-details.csv')
+            journal_path = os.path.join(directory, 'date-details.jsonl')
+            pd.DataFrame(details[:1]).set_index('id').to_csv(data_path)
+            with open(journal_path, 'a') as journal:
+                for listing in details[1:]:
+                    append_to_journal(journal, listing)
+                journal.write('{"id": 4, "artis')
 
+            msg = 'Partially written lines should be skipped'
+            self.assertEqual(details[1:], read_journal(journal_path), msg=msg)
 
+            data = pd.read_csv(data_path, index_col='id')
+            data = compact_journal(data, journal_path, data_path)
+            self.assertFalse(os.path.exists(journal_path))
+            self.assertEqual([1, 2, 3], list(data.index))
+            self.assertEqual(
+                "[['3', 'Artist']]",
+                pd.read_csv(data_path, index_col='id').loc[3, 'artists']
+            )
+
+            msg = 'Listings of a journal left by a crash should not be ' \
+                'added twice'
+            with open(journal_path, 'a') as journal:
+                for listing in details[1:]:
+                    append_to_journal(journal, listing)
+            data = compact_journal(
+                pd.read_csv(data_path, index_col='id'), journal_path,
+                data_path
+            )
+            self.assertEqual([1, 2, 3], list(data.index), msg=msg)
+            self.assertEqual(
+                [1, 2, 3], list(pd.read_csv(data_path, index_col='id').index),
+                msg=msg
+            )
+            self.assertEqual(['date-details.csv'], os.listdir(directory))
+
+    def test_fast_extraction(self):
+        pages = {}
+        for file_name in os.listdir('./fixtures'):
+            with open(os.path.join('./fixtures', file_name)) as fp:
+                pages[file_name] = fp.read()
+
+        def parse_fixtures():
+            return [
+                parse_date_details(1281396, pages['event-1281396.html']),
+                parse_club_year_dates(237, pages['club-237-2019.html']),
+                parse_region_clubs(
+                    '/events/uk/london', pages['region-uk-london.html']
+                ),
+                parse_club_details(pages['club-237.html'])
+            ]
+
+        parsers = {'html.parser', scraper.FAST_PARSER}
+        fast_parser = scraper.FAST_PARSER
+        try:
+            scraper.FAST_EXTRACTION = False
+            expected = parse_fixtures()
+            self.assertEqual(LISTING_DETAILS, expected[0])
+            scraper.FAST_EXTRACTION = True
+            for parser in parsers:
+                scraper.FAST_PARSER = parser
+                msg = 'Parsing with {} should not change results'.format(
+                    parser
+                )
+                self.assertEqual(expected, parse_fixtures(), msg=msg)
+        finally:
+            scraper.FAST_EXTRACTION = True
+            scraper.FAST_PARSER = fast_parser
+
+    def test_reextract_dates_details(self):
+        with open('./fixtures/event-1281396.html') as fp:
+            content = fp.read()
+        club_dates = pd.DataFrame({
+            'id': [1281396, 1281397, 1281398, 1281399, 1000],
+            'date': pd.to_datetime([
+                '2019-11-29', '2019-11-30', '2019-11-30', '2019-12-01',
+                '2018-11-29'
+            ])
+        }).set_index('id')
+
+        with tempfile.TemporaryDirectory() as directory, \
+                PageStore(os.path.join(directory, 'pages.db')) as store:
+            store.put_many([
+                (EVENT_URL.format(1281396), content, 200, None),
+                (EVENT_URL.format(1281397), '<html></html>', 200, None),
+                (EVENT_URL.format(1281399), content, 200, None),
+                (EVENT_URL.format(1000), content, 200, None),
+            ])
+            data, errors, missing = reextract_dates_details(
+                club_dates, 2019, store, workers=2
+            )
+
+            path = os.path.join(directory, 'date-details-2019.csv')
+            pd.DataFrame({
+                'id': [1281396, 1281397, 1281398],
+                'artists': ['[]', "[('1', 'Kept')]", "[('2', 'Missing')]"]
+            }).set_index('id').to_csv(path)
+            update_dates_details(path, data)
+            updated = pd.read_csv(path, index_col='id')
+            update_dates_details(path, data.iloc[:0])
+            unchanged = pd.read_csv(path, index_col='id')
+
+        self.assertEqual([1281396, 1281399], list(data.index))
+        self.assertEqual(
+            LISTING_DETAILS['artists'], data.loc[1281396, 'artists']
+        )
+        self.assertEqual([1281397], list(errors))
+        self.assertEqual([1281398], missing)
+
+        msg = 'Listings that were not re-parsed should keep their details'
+        self.assertEqual(
+            [1281396, 1281397, 1281398, 1281399], list(updated.index),
+            msg=msg
+        )
+        self.assertEqual(
+            str(LISTING_DETAILS['artists']), updated.loc[1281396, 'artists']
+        )
+        self.assertEqual(
+            "[('1', 'Kept')]", updated.loc[1281397, 'artists'], msg=msg
+        )
+        self.assertEqual(
+            "[('2', 'Missing')]", updated.loc[1281398, 'artists'], msg=msg
+        )
+        pd.testing.assert_frame_equal(updated, unchanged)
+
+    def test_revalidation(self):
+        pages = {'/events/1': '<html>1</html>', '/events/2': '<html>2</html>'}
+        with StubServer(pages) as server, \
+                tempfile.TemporaryDirectory() as directory, \
+                PageStore(os.path.join(directory, 'pages.db')) as store:
+            urls = ['http://{}{}'.format(server.host, p) for p in pages]
+            engine = FetchEngine(
+                store, concurrency=1, max_age=lambda url: 60
+            )
+            self.assertEqual(list(pages.values()), engine.fetch_all(urls))
+            msg = 'Requests should reuse pooled connections'
+            self.assertEqual(1, len(server.connections), msg=msg)
+
+            self.assertEqual(list(pages.values()), engine.fetch_all(urls))
+            msg = 'Fresh pages should not be revalidated'
+            self.assertEqual(2, len(server.requests), msg=msg)
+
+            an_hour_ago = time() - 60 * 60
+            for url in urls:
+                store.touch(url, an_hour_ago)
+            pages['/events/2'] = '<html>changed</html>'
+            self.assertEqual(
+                ['<html>1</html>', '<html>changed</html>'],
+                engine.fetch_all(urls)
+            )
+            msg = 'Stale pages should be revalidated with their ETag'
+            self.assertEqual(['/events/1'], server.not_modified, msg=msg)
+            self.assertGreater(store.page(urls[0]).fetched, an_hour_ago)
+            self.assertEqual('<html>changed</html>', store.get(urls[1]))
+
+            engine.max_age = lambda url: None
+            for url in urls:
+                store.touch(url, an_hour_ago)
+            engine.fetch_all(urls)
+            msg = 'Pages without a maximum age should never be revalidated'
+            self.assertEqual(4, len(server.requests), msg=msg)
+
+    def test_pipeline(self):
+        pages = {'/item/{}'.format(i): str(i) for i in range(20)}
+        with StubServer(pages) as server:
+            url = 'http://{}{{}}'.format(server.host)
+            for listing in range(4):
+                pages['/listing/{}'.format(listing)] = ' '.join(
+                    url.format('/item/{}'.format(i))
+                    for i in range(listing * 5, listing * 5 + 5)
+                ) + ' ' + url.format('/item/0')
+
+            persisted = []
+            with tempfile.TemporaryDirectory() as directory, \
+                    PageStore(os.path.join(directory, 'pages.db')) as store:
+                engine = FetchEngine(store)
+                stages = Pipeline(
+                    engine, parse_stub_page, persisted.extend,
+                    parse_workers=2, queue_size=2, batch_size=3
+                )
+                report_interval = pipeline.REPORT_INTERVAL
+                pipeline.REPORT_INTERVAL = None
+                try:
+                    metrics = stages.run(
+                        [
+                            Task(1, 'listing', listing, url.format(
+                                '/listing/{}'.format(listing)
+                            ))
+                            for listing in range(4)
+                        ],
+                        seen=[url.format('/item/19')]
+                    )
+                finally:
+                    pipeline.REPORT_INTERVAL = report_interval
+
+        self.assertEqual(
+            sorted((url.format('/item/{}'.format(i)), str(i))
+                   for i in range(19)),
+            sorted(persisted)
+        )
+        msg = 'Pages should be fetched once'
+        self.assertEqual(23, len(server.requests), msg=msg)
+        self.assertEqual(23, metrics['fetch']['processed'])
+        self.assertEqual(19, metrics['persist']['processed'])
+        msg = 'Queues between stages should be bounded'
+        self.assertLessEqual(metrics['parse']['max_queue_depth'], 2, msg=msg)
+        self.assertLessEqual(
+            metrics['persist']['max_queue_depth'], 2, msg=msg
+        )
@@ -2,6 +2,7 @@ import React, {Component} from 'react';
 import Container from './Container'
 import {Intro, Outro} from './Sections'
 import Navbar from './navbar'
+import {decodeNetwork} from './networkFormat'
 
 class App extends Component {
 
@@ -14,24 +15,12 @@ class App extends Component {
     }
 
     loadData() {
-        fetch(`${process.env.PUBLIC_URL}/network-2019.json`)
+        fetch(`${process.env.PUBLIC_URL}/network-2019.bin`)
             .then( (response) => {
-                return response.json()
+                return response.arrayBuffer()
             })
-            .then( (data) => {
-            	// change arrays into objects
-	            data.nodes = data.nodes.map(e =>{
-	            	return e.reduce((acc, e, i) => {
-	            		acc[data.node_keys[i]] = e
-	            		return acc
-		            }, {})
-	            })
-	            data.links = data.links.map(e =>{
-	            	return e.reduce((acc, e, i) => {
-	            		acc[data.link_keys[i]] = e
-	            		return acc
-		            }, {})
-	            })
+            .then( (buffer) => {
+            	const data = decodeNetwork(buffer)
             	this.setState({
 		            loading: false,
 		            data: data,
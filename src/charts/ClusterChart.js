@@ -23,6 +23,9 @@ class ClusterChart extends Chart{
 	createGraph(nodes){
 		super.createGraph(nodes)
 		const padding = 1
+		// start from the settled layout computed by processing.py if there is
+		// one, instead of simulating from scratch
+		this.precomputed = nodes.length > 0 && nodes.every(e => e.layouts)
 
 		this.simulation = forceSimulation()
 			.force('center', forceCenter(this.x, this.y))
@@ -44,7 +47,12 @@ class ClusterChart extends Chart{
 			.on("zoom", () => this.zoom(this.g))
 		select(this.svg).call(this.zoomHandler)
 
-		this.decay()
+		if (this.precomputed){
+			this.settle()
+			this.simulation.alpha(0.01)
+		}else{
+			this.decay()
+		}
 		this.createLegend()
 		// resize all nodes if we were coming from a different graph
 		this.node.selectAll("circle")
@@ -68,15 +76,20 @@ class ClusterChart extends Chart{
 			    .strength(Math.pow(dt, 2))
 		    if (dt >= 1.0){
 		        t.stop()
-			    // disable forces for less jitter
-			    this.simulation.force("x", null)
-			    this.simulation.force("y", null)
-			    this.simulation.force("center", null)
-                this.simulation.force('cluster', this.cluster().strength(0.1))
+			    this.settle()
 		    }
 		})
 	}
 
+	settle = () => {
+		this.simulation.force('collide').strength(1)
+		// disable forces for less jitter
+		this.simulation.force("x", null)
+		this.simulation.force("y", null)
+		this.simulation.force("center", null)
+		this.simulation.force('cluster', this.cluster().strength(0.1))
+	}
+
 	zoom = (zoomGroup) => {
 		if (!this.active) return
 		zoomGroup.attr("transform", event.transform)
@@ -161,14 +174,21 @@ class ClusterChart extends Chart{
 
 	calculateInitialPositions = (nodes) => {
 		const radius = Math.min(this.width, this.height) / 2
+		const viewport = this.isMobile? 'mobile' : 'desktop'
+		const scale = this.radiusScale()
 		const groupCount = Math.max(...nodes.map(e => e.group))
 		this.clusters = new Array(groupCount)
 		nodes.forEach((e) => {
 			// position along a circle, clustered by group
 			const g = e.group
 			const angle = g / groupCount * 2 * Math.PI
-	        e.x  = Math.cos(angle) * radius + this.width / 2 + Math.random()
-            e.y = Math.sin(angle) * radius + this.height / 2 + Math.random()
+			if (this.precomputed){
+				e.x = this.x + e.layouts[viewport][0] * scale
+				e.y = this.y + e.layouts[viewport][1] * scale
+			}else{
+	            e.x  = Math.cos(angle) * radius + this.width / 2 + Math.random()
+	            e.y = Math.sin(angle) * radius + this.height / 2 + Math.random()
+			}
 
 			// set the radius of each node
 			const r = this.calculateRadius(e)
@@ -313,10 +333,14 @@ class ClusterChart extends Chart{
 	}
 
 	calculateRadius(e){
-		// scale node radius according to svg size
+		return 12 * Math.log(Math.sqrt(e.followers)) * this.radiusScale()
+	}
+
+	radiusScale(){
+		// scale node radius according to svg size, the factors are also used
+		// for the precomputed layouts in layout.py
 		const factor = this.isMobile? 500 : 800
-		const m = Math.min(this.width, this.height) / factor
-		return 12 * Math.log(Math.sqrt(e.followers)) * m
+		return Math.min(this.width, this.height) / factor
 	}
 
 }
@@ -1,9 +1,10 @@
-import React from "react";
+import React, {Component} from "react";
 
 import {FontAwesomeIcon} from "@fortawesome/react-fontawesome";
 import {faTimesCircle} from "@fortawesome/free-solid-svg-icons";
 import BarChart from "./BarChart";
 import {fillColor, artistLink} from "./lib";
+import {loadClubDetails} from "./networkFormat";
 
 const Club = (props) => {
 	const {club} = props;
@@ -241,20 +242,68 @@ const Similarities = (props) => {
 	);
 };
 
-const Panel = (props) => {
-	const {clubs} = props;
-	return (
-		<div className={`clubDetail  ${clubs.length > 0 ? 'visible' : ''}`}>
-			<div className={"clubInfo"}>
-				{clubs.map((club) => (
-					<Club key={club.id} {...props} club={club}/>
-				))}
-				<ClubTable {...props} />
+const clubIds = (clubs) => clubs.map((e) => e.id).join("\n");
+
+// The artists of the clubs are loaded from the shard of their cluster when
+// the panel opens, until then the clubs are shown without them
+class Panel extends Component {
+	constructor(props) {
+		super(props);
+		this.state = {
+			clubs: [],
+			artist_names_to_ids: {},
+		};
+	}
+
+	componentDidMount() {
+		this.loadDetails();
+	}
+
+	componentDidUpdate(prevProps) {
+		if (clubIds(prevProps.clubs) !== clubIds(this.props.clubs)) {
+			this.loadDetails();
+		}
+	}
+
+	loadDetails() {
+		const {clubs, data} = this.props;
+		loadClubDetails(data, clubs, process.env.PUBLIC_URL).then((details) => {
+			// skip the details of clubs that were closed while loading
+			if (clubIds(clubs) === clubIds(this.props.clubs)) {
+				this.setState(details);
+			}
+		});
+	}
+
+	render() {
+		const {clubs} = this.props;
+		const loaded = clubIds(this.state.clubs) === clubIds(clubs);
+		const props = {
+			...this.props,
+			clubs: loaded ? this.state.clubs : clubs.map((club) => {
+				return {artists: {}, ...club};
+			}),
+			data: {
+				...this.props.data,
+				artist_names_to_ids: {
+					...this.props.data.artist_names_to_ids,
+					...this.state.artist_names_to_ids,
+				},
+			},
+		};
+		return (
+			<div className={`clubDetail  ${clubs.length > 0 ? 'visible' : ''}`}>
+				<div className={"clubInfo"}>
+					{clubs.map((club) => (
+						<Club key={club.id} {...props} club={club}/>
+					))}
+					<ClubTable {...props} />
+				</div>
+				{clubs.length === 1 && <ClubGroup {...props} />}
+				{clubs.length === 2 && loaded && <Similarities {...props} />}
 			</div>
-			{clubs.length === 1 && <ClubGroup {...props} />}
-			{clubs.length === 2 && <Similarities {...props} />}
-		</div>
-	);
-};
+		);
+	}
+}
 
 export default Panel;
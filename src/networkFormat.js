@@ -0,0 +1,132 @@
+// Decoder for the binary network format written by network_format.py
+// 'CLUB' | uint32 version | uint32 header length | JSON header | arrays
+
+const VERSION = 1
+const ALIGNMENT = 8
+const ARRAY_TYPES = {
+	uint8: Uint8Array,
+	uint16: Uint16Array,
+	uint32: Uint32Array,
+	float32: Float32Array
+}
+
+function align(offset){
+	return Math.ceil(offset / ALIGNMENT) * ALIGNMENT
+}
+
+// Decode a network into the same shape as the optimised json after its
+// nodes and links have been changed back into objects
+function decodeNetwork(buffer){
+	const view = new DataView(buffer)
+	const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4))
+	if (magic !== 'CLUB') {
+		throw new Error('Not a network file')
+	}
+	const version = view.getUint32(4, true)
+	if (version !== VERSION) {
+		throw new Error('Unsupported network file version ' + version)
+	}
+	const headerLength = view.getUint32(8, true)
+	const decoder = new TextDecoder()
+	const header = JSON.parse(
+		decoder.decode(new Uint8Array(buffer, 12, headerLength))
+	)
+	const start = align(12 + headerLength)
+	const arrays = Object.entries(header.arrays).reduce((acc, e) => {
+		const [name, [offset, length, type]] = e
+		acc[name] = new ARRAY_TYPES[type](buffer, start + offset, length)
+		return acc
+	}, {})
+
+	const strings = decoder.decode(arrays.strings).split('\n')
+	const offsets = arrays.artist_offsets
+	// precomputed positions of the nodes by viewport class, if any
+	const layouts = header.layouts || []
+	const nodes = []
+	for (let i = 0; i < offsets.length - 1; i++) {
+		const node = {}
+		header.node_keys.forEach((key) => {
+			node[key] = header.nodes[key][i]
+		})
+		node.artists = {}
+		for (let j = offsets[i]; j < offsets[i + 1]; j++) {
+			node.artists[strings[arrays.artist_strings[j]]] =
+				arrays.artist_counts[j]
+		}
+		if (layouts.length) {
+			node.layouts = {}
+			layouts.forEach((name) => {
+				const positions = arrays['layout_' + name]
+				node.layouts[name] = [positions[2 * i], positions[2 * i + 1]]
+			})
+		}
+		nodes.push(node)
+	}
+
+	const names = header.nodes.id || []
+	const links = []
+	for (let i = 0; i < arrays.link_weights.length; i++) {
+		links.push({
+			weight: arrays.link_weights[i],
+			source: names[arrays.link_sources[i]],
+			target: names[arrays.link_targets[i]]
+		})
+	}
+
+	const artistNamesToIds = Object.entries(header.artist_ids).reduce(
+		(acc, [position, artistId]) => {
+			acc[strings[position]] = artistId
+			return acc
+		}, {}
+	)
+
+	return {
+		directed: header.directed,
+		multigraph: header.multigraph,
+		graph: header.graph,
+		nodes: nodes,
+		links: links,
+		artist_names_to_ids: artistNamesToIds,
+		metadata: header.metadata || {}
+	}
+}
+
+// Shards are named by the hash of their contents, so a fetched shard never
+// goes stale and is kept for as long as the page is open
+const shards = new Map()
+
+function loadShard(url){
+	if (!shards.has(url)) {
+		const shard = fetch(url)
+			.then((response) => response.arrayBuffer())
+			.then(decodeNetwork)
+		// let a failed fetch be retried the next time the shard is needed
+		shard.catch(() => shards.delete(url))
+		shards.set(url, shard)
+	}
+	return shards.get(url)
+}
+
+// Load the artists of clubs from the shards of a core network, resolves to
+// the clubs with their artists and the artist ids of their shards. Networks
+// without shards already have the artists of their clubs.
+function loadClubDetails(data, clubs, baseUrl){
+	const paths = (data.metadata && data.metadata.shards) || {}
+	return Promise.all(clubs.map((club) => {
+		const path = paths[club.group]
+		return path ? loadShard(`${baseUrl}/${path}`) : null
+	})).then((loaded) => {
+		const artistNamesToIds = {}
+		const details = clubs.map((club, i) => {
+			if (loaded[i] === null) {
+				return club
+			}
+			Object.assign(artistNamesToIds, loaded[i].artist_names_to_ids)
+			const node = loaded[i].nodes.find((e) => e.id === club.id)
+			return {...club, artists: node ? node.artists : {}}
+		})
+		return {clubs: details, artist_names_to_ids: artistNamesToIds}
+	})
+}
+
+export {decodeNetwork, loadClubDetails}
@@ -0,0 +1,326 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sqlite3
+import sys
+from contextlib import nullcontext
+from time import time
+
+# A cache of the outputs of the stages of the processing pipeline. Every
+# output is stored under a key that hashes the name and source of its stage,
+# the source of the functions and modules it calls, the keys of the stages it
+# was computed from and the parameters that change it, so the key of a stage is
+# known before any stage runs and a stage is only run when its output for
+# those inputs is not in the cache:
+#
+#   csv files -> load_csv_files -> normalize_artist_data
+#                      |                    |
+#                      +--------------------+-> club_artist_ids
+#                      |                    |
+#                      +--------------------+-> aggregate_club_data
+#                                                  -> club_pair_scores
+#                                                  -> build_graph
+#
+# The export of the networks is cheap and always runs. Every stage lists the
+# code it calls, e.g. build_graph lists the community detection, so that a
+# change to it only invalidates the outputs of the stages that call it.
+# Settings are passed as parameters and are not part of the code.
+#
+# Outputs are pickled to files named by their key, with an SQLite index of
+# their sizes, last use and the hits and misses of every stage. The least
+# recently used outputs are evicted when the cache grows beyond its size.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    stage TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+INDEX_FILE = 'index.db'
+# maximum size of the cached outputs in bytes
+MAX_BYTES = 2 << 30
+
+
+class StageCache:
+    """
+    Content addressed cache of stage outputs
+
+    :param directory:   Directory of the cache, created if it does not exist
+    :param max_bytes:   Size of the outputs above which the least recently
+                        used outputs are evicted
+    """
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # builds of different years can share the cache from other processes
+        self.connection = sqlite3.connect(
+            os.path.join(directory, INDEX_FILE), timeout=60
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def key(self, stage, function, inputs=(), params=None, code=()):
+        """
+        Get the key of the output of a stage
+
+        :param stage:       Name of the stage
+        :param function:    The function that computes the output, its source
+                            is part of the key so that changing it invalidates
+                            its outputs
+        :param inputs:      Keys of the stages or hashes of the files the
+                            output is computed from
+        :param params:      Dict of JSON serializable parameters that change
+                            the output
+        :param code:        Functions, classes or modules the function calls,
+                            their source is part of the key as well
+        """
+        return hashlib.sha1(json.dumps(
+            [stage, [source(item) for item in [function] + list(code)],
+             [str(i) for i in inputs], params or {}],
+            sort_keys=True, default=repr
+        ).encode('utf-8')).hexdigest()
+
+    def get(self, stage, key):
+        """
+        Get the cached output of a stage and count the hit or miss
+
+        :return: A tuple of whether the output was found and the output
+        """
+        found, value = False, None
+        if self.connection.execute(
+            'SELECT 1 FROM entries WHERE key = ?', (key,)
+        ).fetchone():
+            try:
+                with open(self.path(key), 'rb') as fp:
+                    value = pickle.load(fp)
+                found = True
+            except (OSError, pickle.UnpicklingError, EOFError):
+                self.remove(key)
+
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO stats (stage) VALUES (?)', (stage,)
+            )
+            self.connection.execute(
+                'UPDATE stats SET {0} = {0} + 1 WHERE stage = ?'.format(
+                    'hits' if found else 'misses'
+                ),
+                (stage,)
+            )
+            if found:
+                self.connection.execute(
+                    'UPDATE entries SET used = ? WHERE key = ?', (time(), key)
+                )
+        return found, value
+
+    def put(self, stage, key, value):
+        """
+        Store the output of a stage and evict outputs if the cache is full
+        """
+        path = self.path(key)
+        # write to a temporary file so that no other process reads a partial
+        # output
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as fp:
+            pickle.dump(value, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+        now = time()
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO entries '
+                '(key, stage, size, created, used) VALUES (?, ?, ?, ?, ?)',
+                (key, stage, os.path.getsize(path), now, now)
+            )
+        self.evict()
+
+    def remove(self, key):
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM entries WHERE key = ?', (key,)
+            )
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def evict(self):
+        """
+        Remove the least recently used outputs until the cache fits in
+        max_bytes
+
+        :return: The number of outputs removed
+        """
+        rows = self.connection.execute(
+            'SELECT key, size FROM entries ORDER BY used DESC'
+        ).fetchall()
+        total, evicted = 0, 0
+        for key, size in rows:
+            total += size
+            if total > self.max_bytes:
+                self.remove(key)
+                evicted += 1
+        return evicted
+
+    def stats(self):
+        """
+        Get the hits and misses, number of outputs and their size of every
+        stage
+
+        :return: A list of dicts, one for every stage
+        """
+        return [
+            {'stage': stage, 'hits': hits, 'misses': misses,
+             'entries': entries, 'bytes': size}
+            for stage, hits, misses, entries, size in self.connection.execute(
+                'SELECT stage, hits, misses, COUNT(key), '
+                'COALESCE(SUM(size), 0) FROM stats '
+                'LEFT JOIN entries USING (stage) GROUP BY stage ORDER BY stage'
+            )
+        ]
+
+    def clear(self):
+        """
+        Remove all outputs and reset the stats
+        """
+        for key, in self.connection.execute(
+            'SELECT key FROM entries'
+        ).fetchall():
+            self.remove(key)
+        with self.connection:
+            self.connection.execute('DELETE FROM stats')
+
+
+def source(code):
+    """
+    Get the source of a function, class or module, or its name if the source
+    is not available, e.g. of a builtin
+    """
+    try:
+        return inspect.getsource(code)
+    except (OSError, TypeError):
+        return getattr(code, '__qualname__', repr(code))
+
+
+class Stage:
+    """
+    A stage of a pipeline whose output is computed on first use, or loaded
+    from the cache if it was computed from the same inputs before
+
+    :param cache:       The StageCache, None to always compute the output
+    :param name:        Name of the stage
+    :param function:    The function that computes the output
+    :param args:        Arguments of the function, Stages are replaced by
+                        their outputs. Other arguments are not part of the key,
+                        they have to be described by inputs.
+    :param inputs:      Hashes of anything else the output depends on, e.g.
+                        of the files it is read from
+    :param params:      Keyword arguments of the function that are part of the
+                        key
+    :param kwargs:      Keyword arguments of the function that do not change
+                        the output, e.g. an executor
+    :param code:        Functions, classes or modules the function calls whose
+                        changes change the output
+    :param report:      RunReport to time the stage with, if any, outputs
+                        loaded from the cache are recorded as cached
+    :param rows:        Function that counts the rows of the output for the
+                        report
+    """
+    def __init__(self, cache, name, function, args=(), inputs=(), params=None,
+                 kwargs=None, report=None, rows=None, code=()):
+        self.cache = cache
+        self.name = name
+        self.function = function
+        self.args = list(args)
+        self.params = params or {}
+        self.kwargs = kwargs or {}
+        self.report = report
+        self.rows = rows
+        self.code = list(code)
+        self.key = None
+        if cache is not None:
+            self.key = cache.key(name, function, [
+                arg.key for arg in self.args if isinstance(arg, Stage)
+            ] + list(inputs), self.params, self.code)
+        self.computed = False
+        self.value = None
+
+    def result(self):
+        """
+        Get the output of the stage
+        """
+        if not self.computed:
+            found = False
+            if self.cache is not None:
+                # only the computation of the output is profiled
+                with self.timer(profile=False) as record:
+                    found, self.value = self.cache.get(self.name, self.key)
+                    record.update(cached=True, discard=not found)
+                    if found and self.rows is not None:
+                        record['rows'] = self.rows(self.value)
+            if not found:
+                # the stages it depends on are timed on their own
+                args = [
+                    arg.result() if isinstance(arg, Stage) else arg
+                    for arg in self.args
+                ]
+                with self.timer() as record:
+                    self.value = self.function(
+                        *args, **self.params, **self.kwargs
+                    )
+                    if self.rows is not None:
+                        record['rows'] = self.rows(self.value)
+                if self.cache is not None:
+                    self.cache.put(self.name, self.key, self.value)
+            self.computed = True
+        return self.value
+
+    def timer(self, profile=True):
+        if self.report is None:
+            return nullcontext({})
+        return self.report.stage(self.name, profile=profile)
+
+
+def print_stats(stats):
+    print('{:<24}{:>8}{:>8}{:>9}{:>12}'.format(
+        'stage', 'hits', 'misses', 'entries', 'megabytes'
+    ))
+    for stage in stats:
+        print('{:<24}{:>8}{:>8}{:>9}{:>12.1f}'.format(
+            stage['stage'], stage['hits'], stage['misses'],
+            stage['entries'], stage['bytes'] / (1 << 20)
+        ))
+
+
+if __name__ == "__main__":
+    from processing import STAGE_CACHE_PATH, STAGE_CACHE_BYTES
+    command = sys.argv[1] if len(sys.argv) > 1 else 'stats'
+    with StageCache(STAGE_CACHE_PATH, STAGE_CACHE_BYTES) as stage_cache:
+        if command == 'stats':
+            print_stats(stage_cache.stats())
+        elif command == 'clear':
+            stage_cache.clear()
+            print('Cleared {}'.format(STAGE_CACHE_PATH))
+        else:
+            print('Usage: python stagecache.py [stats|clear]')
@@ -1,7 +1,30 @@
 import unittest
-from processing import jaccard_index, NaNCounter
+from processing import (
+    jaccard_index, NaNCounter, calculate_club_likeness, sparsify_edges,
+    normalize_artist_data, normalize_artist_files, encode_categories,
+    decode_categories, join_data_frames, group_by_year_and_club,
+    aggregate_club_data, count_artists, artist_count_matrix,
+    compare_underlying_distribution, club_pair_scores, network_state,
+    save_network_state, load_network_state
+)
+import os
+import processing
+import pstats
+import sys
+import benchmark
+import columnar
+import communities
+import layout
+import stagecache
+import network_format
+import runreport
+import community as community_louvain
+import networkx as nx
 import numpy as np
 import pandas as pd
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from scipy import stats
 
 
 class ProcessingTest(unittest.TestCase):
@@ -43,6 +66,853 @@ class ProcessingTest(unittest.TestCase):
         msg = "nans should be excluded from the counter"
         self.assertEqual(len(data) - 2, len(counter.keys()), msg=msg)
 
+    def test_calculate_club_likeness(self):
+        """
+        The bulk similarity calculation should exactly match jaccard_index for
+        every pair of clubs
+        """
+        rng = np.random.RandomState(0)
+        artists = [
+            NaNCounter(rng.choice(40, size=rng.randint(0, 60)).tolist())
+            for _ in range(30)
+        ]
+        names = ['club {}'.format(i) for i in range(len(artists))]
+        club_data = pd.DataFrame(
+            {'artists': artists},
+            index=pd.MultiIndex.from_product([[2019], names])
+        )
+
+        expected = []
+        for i in range(len(artists)):
+            for j in range(i + 1, len(artists)):
+                similarity = jaccard_index(artists[i], artists[j])
+                if similarity > 0:
+                    expected.append((names[i], names[j], similarity))
+
+        self.assertEqual(expected, calculate_club_likeness(club_data))
+        self.assertEqual(
+            expected, calculate_club_likeness(club_data, shards=4),
+            msg='Sharding the pairs should not change the results'
+        )
+        for n in (0, 1):
+            self.assertEqual(
+                [], calculate_club_likeness(club_data[:n], shards=4),
+                msg='Fewer than two clubs should have no pairs'
+            )
+
+        msg = 'Approximate pairs should be a subset of the exact pairs'
+        approximate = calculate_club_likeness(
+            club_data, approximate=True, bands=8, rows=2
+        )
+        self.assertTrue(approximate)
+        self.assertEqual(
+            [pair for pair in expected if pair in approximate],
+            approximate,
+            msg=msg
+        )
+        for bands, rows in [(0, 1), (8, 0)]:
+            with self.assertRaises(ValueError):
+                calculate_club_likeness(
+                    club_data, approximate=True, bands=bands, rows=rows
+                )
+
+    def test_sparsify_edges(self):
+        """
+        Edges should be kept if they are above the minimum score and within
+        the top k edges of either of their nodes
+        """
+        sources = np.array([0, 0, 0, 1, 1, 2])
+        targets = np.array([1, 2, 3, 2, 3, 3])
+        scores = np.array([0.5, 0.1, 0.2, 0.4, 0.05, 0.3])
+
+        msg = 'Every node should keep its best edge'
+        kept = sparsify_edges(sources, targets, scores, top_k=1)
+        self.assertEqual([0, 1, 2], kept[0].tolist(), msg=msg)
+        self.assertEqual([1, 2, 3], kept[1].tolist(), msg=msg)
+
+        msg = 'Edges at or below the minimum score should be dropped'
+        kept = sparsify_edges(sources, targets, scores, min_score=0.2)
+        self.assertEqual([0.5, 0.4, 0.3], kept[2].tolist(), msg=msg)
+
+    def test_columnar_store(self):
+        """
+        Data frames should be read back from the columnar store unchanged
+        unless the source has changed
+        """
+        df = pd.DataFrame({
+            'id': [1.0, 2.0, 3.0],
+            'cost': ['10€', np.nan, ''],
+            'artists': [[['a', 'A']], [], [['b', 'B'], ['c', 'Ç']]],
+            'flyers': [['front.jpg', 'back.jpg'], [], []],
+            'pick': [True, False, True],
+            'attending': [1, 20, 300]
+        }).set_index('id')
+
+        with tempfile.TemporaryDirectory() as directory:
+            columnar.write_frame(df, directory, 'a', ['artists', 'flyers'])
+            pd.testing.assert_frame_equal(
+                df, columnar.read_frame(directory, 'a')
+            )
+            msg = 'Stores written from a different source should be stale'
+            self.assertIsNone(columnar.read_frame(directory, 'b'), msg=msg)
+
+    def test_normalize_artist_data(self):
+        """
+        Every artist of every event should get its own row, in order, whether
+        the events are in memory or streamed from csv files in chunks
+        """
+        date_details = pd.DataFrame({
+            'id': [1.0, 2.0, 3.0],
+            'artists': [[['a', 'A'], ['b', 'B']], [], [['a', 'A']]]
+        }).set_index('id')
+        expected = pd.DataFrame(
+            [['a', 'A'], ['b', 'B'], ['a', 'A']],
+            index=pd.Index([1.0, 1.0, 3.0], name='event_id'),
+            columns=['artist_id', 'artist_name']
+        )
+        pd.testing.assert_frame_equal(
+            expected, normalize_artist_data(date_details)
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for year, rows in [(2018, slice(0, 2)), (2019, slice(2, 3))]:
+                paths.append(
+                    os.path.join(directory, 'date-details-{}.csv'.format(year))
+                )
+                date_details[rows].to_csv(paths[-1])
+            pd.testing.assert_frame_equal(
+                expected, normalize_artist_files(paths, chunksize=1)
+            )
+
+    def test_categories(self):
+        """
+        String columns should be encoded as categoricals and decoded back to
+        the same values
+        """
+        df = pd.DataFrame({
+            'region': ['/guide/uk/london', '/guide/de/berlin'],
+            'name': ['fabric', np.nan],
+            'rank': [0, 1]
+        })
+        encoded = encode_categories(df, exclude=['region'])
+        self.assertEqual(object, encoded['region'].dtype)
+        self.assertEqual('category', encoded['name'].dtype)
+        pd.testing.assert_frame_equal(df, decode_categories(encoded))
+
+    def test_aggregate_club_data(self):
+        """
+        Aggregating the normalized tables should give the same result as
+        grouping the fully joined table
+        """
+        regions = pd.DataFrame({
+            'name': ['London', 'Manchester', 'North'],
+            'country': ['United Kingdom'] * 3,
+            'region': ['/guide/uk/london', '/guide/uk/manchester',
+                       '/guide/uk/north'],
+            'rank': [0, 1, 2]
+        })
+        # the white hotel is in two regions and hidden has no dates
+        clubs = pd.DataFrame({
+            'id': [237, 112509, 112509, 14042, 81697],
+            'img': ['fabric.jpg', 'twh.jpg', 'twh.jpg', '', ''],
+            'name': ['fabric', 'The White Hotel', 'The White Hotel',
+                     'Soup Kitchen', 'Hidden'],
+            'rank': [0, 0, 0, 1, 2],
+            'region': ['/guide/uk/london', '/guide/uk/north',
+                       '/guide/uk/manchester', '/guide/uk/manchester',
+                       '/guide/uk/north'],
+            'followers': [17902, 784, 784, 668, 612],
+            'capacity': [1600, 0, 0, 0, 0]
+        }).set_index('id')
+        dates = pd.DataFrame({
+            'id': [4.0, 3.0, 2.0, 1.0, 5.0],
+            'date': pd.to_datetime([
+                '2019-01-04', '2019-01-03', '2019-01-02', '2018-12-29',
+                '2019-01-05'
+            ]),
+            'attending': [10, 20, 30, 40, 50],
+            'club_id': [237.0, 112509.0, 237.0, 237.0, 14042.0]
+        }).set_index('id')
+        date_details = pd.DataFrame({
+            'id': [1.0, 2.0, 3.0, 4.0],
+            'age': ['19+', '18+', np.nan, '19+']
+        }).set_index('id')
+        # event 2 lists artist b twice and event 4 has no artists
+        artists_to_dates = pd.DataFrame(
+            [['a', 'A'], ['b', 'B'], ['b', 'B'], ['a', 'A'], ['a', 'A'],
+             ['c', 'C']],
+            index=pd.Index([1.0, 2.0, 2.0, 2.0, 3.0, 3.0], name='event_id'),
+            columns=['artist_id', 'artist_name']
+        )
+
+        tables = (regions, clubs, dates, date_details, artists_to_dates)
+        expected = group_by_year_and_club(
+            join_data_frames(*tables).reset_index()
+        )
+        club_data = aggregate_club_data(*tables)
+        pd.testing.assert_frame_equal(expected, club_data)
+        msg = 'Attending should be an integer whether or not clubs have dates'
+        self.assertEqual(np.int64, club_data.attending.dtype, msg=msg)
+        self.assertEqual([40, 20, 40], club_data.attending.tolist(), msg=msg)
+
+    def test_count_artists(self):
+        """
+        Artists should be counted per key in the order they first appear and
+        the counts should encode to the same matrix as plain counters
+        """
+        keys = pd.DataFrame({
+            'year': [2019, 2019, 2018, 2019, 2019],
+            'name_club': ['fabric', 'XOYO', 'fabric', 'fabric', 'fabric']
+        })
+        artist_names = pd.Series(['B', 'A', 'A', 'A', 'B'])
+        counts = count_artists(keys, artist_names)
+
+        self.assertEqual(
+            [(2019, 'fabric'), (2019, 'XOYO'), (2018, 'fabric')],
+            counts.index.tolist()
+        )
+        self.assertEqual([2, 1, 1], counts.number_of_unique_artists.tolist())
+        self.assertEqual([3, 1, 1], counts.total_number_of_artists.tolist())
+        self.assertEqual(
+            [('B', 2), ('A', 1)], list(counts.artists.iloc[0].items())
+        )
+
+        matrix, names = artist_count_matrix(counts.artists)
+        expected, expected_names = artist_count_matrix(
+            [dict(counter) for counter in counts.artists]
+        )
+        self.assertEqual(
+            pd.DataFrame(expected.toarray(), columns=expected_names).to_dict(),
+            pd.DataFrame(matrix.toarray(), columns=names).to_dict()
+        )
+
+    def test_communities(self):
+        """
+        Verify that the Louvain method finds planted communities, is
+        reproducible with a seed and agrees with community_louvain on the
+        modularity
+        """
+        G = nx.planted_partition_graph(4, 10, 0.9, 0.05, seed=1)
+        edges = [(u, v, 1.0 + (u + v) % 3) for u, v in G.edges]
+        G = nx.Graph()
+        G.add_weighted_edges_from(edges)
+        sources, targets, weights = zip(*edges)
+        adjacency = communities.csr_adjacency(
+            sources, targets, weights, G.number_of_nodes()
+        )
+
+        labels = communities.louvain(adjacency, seed=3)
+        msg = 'Should find the planted communities'
+        self.assertEqual(
+            [i // 10 for i in range(40)], labels.tolist(), msg=msg
+        )
+        msg = 'Should give the same communities with the same seed'
+        self.assertEqual(
+            labels.tolist(),
+            communities.louvain(adjacency, seed=3).tolist(),
+            msg=msg
+        )
+        self.assertAlmostEqual(
+            community_louvain.modularity(
+                dict(enumerate(labels.tolist())), G
+            ),
+            communities.modularity(adjacency, labels)
+        )
+
+        partition, score = communities.best_partition(
+            adjacency, seeds=range(4), resolution=4.0
+        )
+        self.assertEqual(
+            max(
+                communities.modularity(
+                    adjacency, communities.louvain(adjacency, 4.0, seed), 4.0
+                )
+                for seed in range(4)
+            ),
+            score
+        )
+        msg = 'Higher resolutions should give more communities'
+        self.assertGreater(partition.max(), labels.max(), msg=msg)
+
+        msg = 'Warm starting from the communities should keep them'
+        self.assertEqual(
+            labels.tolist(),
+            communities.louvain(
+                adjacency, seed=5, initial=labels * 7 + 3
+            ).tolist(),
+            msg=msg
+        )
+
+        # a clique, a triangle and a node linked to the clique that starts in
+        # the community of the triangle
+        edges = [(u, v, 1.0) for u in range(8) for v in range(u + 1, 8)] + \
+            [(8, 9, 1.0), (8, 10, 1.0), (9, 10, 1.0), (0, 11, 1.0)]
+        adjacency = communities.csr_adjacency(*zip(*edges), 12)
+        msg = 'Warm starting from wrong communities should correct them'
+        self.assertEqual(
+            communities.louvain(adjacency, 2.0, seed=0).tolist(),
+            communities.louvain(
+                adjacency, 2.0, seed=0, initial=[0] * 8 + [1] * 4
+            ).tolist(),
+            msg=msg
+        )
+
+    def test_incremental_build(self):
+        """
+        Incrementally scored pairs should be the same as scoring all pairs
+        after clubs are changed, removed, added and reordered
+        """
+        rng = np.random.RandomState(0)
+        artists = [
+            NaNCounter(rng.choice(40, size=rng.randint(0, 60)).tolist())
+            for _ in range(30)
+        ]
+        names = ['club {}'.format(i) for i in range(len(artists))]
+        before = pd.DataFrame(
+            {'artists': artists},
+            index=pd.MultiIndex.from_product([[2019], names])
+        )
+        pairs = club_pair_scores(before)
+        partition = {name: i % 3 for i, name in enumerate(names)}
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache', 'network.npz')
+            save_network_state(
+                path, network_state(before, pairs, partition)
+            )
+            previous = load_network_state(path)
+            self.assertEqual(
+                [i % 3 for i in range(30)], previous['groups'].tolist()
+            )
+
+            msg = 'States of another version should be ignored'
+            save_network_state(path, dict(previous, version=np.array('0')))
+            self.assertIsNone(load_network_state(path), msg=msg)
+            del previous['version']
+            save_network_state(path, previous)
+            self.assertIsNone(load_network_state(path), msg=msg)
+
+        changed = list(artists)
+        changed[3], changed[4] = NaNCounter([1, 1, 2]), NaNCounter()
+        after = pd.concat([
+            before.assign(artists=changed).drop(before.index[7]),
+            pd.DataFrame(
+                {'artists': [NaNCounter([1, 2, 3])]},
+                index=pd.MultiIndex.from_tuples([(2019, 'new club')])
+            )
+        ])
+        for club_data in [after, after.sort_index()]:
+            expected = club_pair_scores(club_data)
+            incremental = club_pair_scores(club_data, previous=previous)
+            for a, b in zip(expected, incremental):
+                np.testing.assert_array_equal(a, b)
+            with ThreadPoolExecutor(2) as executor:
+                sharded = club_pair_scores(
+                    club_data, shards=3, executor=executor, previous=previous
+                )
+            for a, b in zip(expected, sharded):
+                np.testing.assert_array_equal(a, b)
+            rebuilt = club_pair_scores(
+                club_data, previous=previous, max_changed=0.0
+            )
+            for a, b in zip(expected, rebuilt):
+                np.testing.assert_array_equal(a, b)
+
+        msg = 'Unchanged clubs should keep their scores'
+        unchanged = club_pair_scores(before, previous=previous)
+        for a, b in zip(pairs, unchanged):
+            np.testing.assert_array_equal(a, b, err_msg=msg)
+
+    def test_stage_cache(self):
+        """
+        Stages should only run when their inputs or parameters change, and
+        stages before a cached stage should not run at all
+        """
+        calls = []
+
+        def load(name):
+            calls.append('load')
+            return list(range(10))
+
+        def total(values, scale=1):
+            calls.append('total')
+            return sum(values) * scale
+
+        with tempfile.TemporaryDirectory() as directory:
+            def run(inputs, scale, max_bytes=stagecache.MAX_BYTES):
+                with stagecache.StageCache(directory, max_bytes) as cache:
+                    loaded = stagecache.Stage(
+                        cache, 'load', load, args=['numbers'], inputs=inputs
+                    )
+                    result = stagecache.Stage(
+                        cache, 'total', total, args=[loaded],
+                        params={'scale': scale}
+                    ).result()
+                    return result, cache.stats()
+
+            self.assertEqual(45, run(['a'], 1)[0])
+            self.assertEqual(['load', 'total'], calls)
+
+            result, stats = run(['a'], 1)
+            msg = 'Stages before a cached stage should not run'
+            self.assertEqual((45, ['load', 'total']), (result, calls), msg=msg)
+            self.assertEqual(
+                [('load', 0, 1), ('total', 1, 1)],
+                [(e['stage'], e['hits'], e['misses']) for e in stats]
+            )
+
+            msg = 'Changed parameters should only run the stages after them'
+            self.assertEqual(90, run(['a'], 2)[0])
+            self.assertEqual(['load', 'total', 'total'], calls, msg=msg)
+
+            msg = 'Changed inputs should run all the stages after them'
+            self.assertEqual(90, run(['b'], 2)[0])
+            self.assertEqual(
+                ['load', 'total', 'total', 'load', 'total'], calls, msg=msg
+            )
+
+            msg = 'The least recently used outputs should be evicted'
+            run(['c'], 1, max_bytes=100)
+            with stagecache.StageCache(directory) as cache:
+                stats = cache.stats()
+                self.assertLessEqual(
+                    sum(e['bytes'] for e in stats), 100, msg=msg
+                )
+                self.assertLess(sum(e['entries'] for e in stats), 6, msg=msg)
+            del calls[:]
+            self.assertEqual(45, run(['c'], 1)[0])
+            self.assertEqual([], calls, msg=msg)
+
+            with stagecache.StageCache(directory) as cache:
+                cache.clear()
+                self.assertEqual([], cache.stats())
+
+        msg = 'Changing a function that a stage calls should run it again'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'stagehelpers.py')
+            sys.path.insert(0, directory)
+            try:
+                def scaled(values):
+                    calls.append('scaled')
+                    return stagehelpers.scale(values)
+
+                def run_scaled():
+                    with stagecache.StageCache(
+                        os.path.join(directory, 'cache')
+                    ) as cache:
+                        return stagecache.Stage(
+                            cache, 'scaled', scaled, args=[[1, 2]],
+                            code=[stagehelpers.scale]
+                        ).result()
+
+                for factor, expected in [(2, 6), (2, 6), (10, 30)]:
+                    with open(path, 'w') as fp:
+                        fp.write('def scale(values):\n    return sum(values)'
+                                 ' * {}\n'.format(factor))
+                    sys.modules.pop('stagehelpers', None)
+                    import stagehelpers
+                    self.assertEqual(expected, run_scaled())
+            finally:
+                sys.path.remove(directory)
+                sys.modules.pop('stagehelpers', None)
+            self.assertEqual(2, calls.count('scaled'), msg=msg)
+
+    def test_stage_keys(self):
+        """
+        Changing the community detection or its settings should only change
+        the key of the graph, the stages before it should still be cached
+        """
+        source = stagecache.source
+
+        def keys():
+            with tempfile.TemporaryDirectory() as directory:
+                with stagecache.StageCache(directory) as cache:
+                    club_data, artist_ids = processing.club_data_stages(cache)
+                    raw, artists_to_dates = club_data.args
+                    pairs, graph = processing.year_stages(
+                        club_data, 2019, cache, club_data.key
+                    )
+            return {stage.name: stage.key for stage in [
+                raw, artists_to_dates, club_data, artist_ids, pairs, graph
+            ]}
+
+        def changed_source(code):
+            # as if communities.py was edited
+            return source(code) + ('#' if code is communities else '')
+
+        before = keys()
+        resolution = processing.RESOLUTION
+        try:
+            processing.RESOLUTION = resolution + 0.2
+            changed_setting = keys()
+        finally:
+            processing.RESOLUTION = resolution
+        stagecache.source = changed_source
+        try:
+            changed_code = keys()
+        finally:
+            stagecache.source = source
+
+        for after in [changed_setting, changed_code]:
+            self.assertNotEqual(before['build_graph'], after['build_graph'])
+            for stage in ['load_csv_files', 'normalize_artist_data',
+                          'aggregate_club_data', 'club_artist_ids',
+                          'club_pair_scores']:
+                self.assertEqual(before[stage], after[stage])
+
+    def test_run_report(self):
+        """
+        Stages should be timed with their rows and throughput, cached stages
+        marked as cached and named stages profiled
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            report = runreport.RunReport(
+                {'year': 2019}, profile=['total'],
+                profile_path=os.path.join(directory, '{}.prof')
+            )
+            with report.stage('sort') as record:
+                record['rows'] = len(sorted(range(10000), key=lambda i: -i))
+
+            cache = stagecache.StageCache(os.path.join(directory, 'cache'))
+            for _ in range(2):
+                stagecache.Stage(
+                    cache, 'total', sum, args=[range(10)], report=report,
+                    rows=lambda value: 1
+                ).result()
+            cache.close()
+
+            written = report.write(os.path.join(directory, 'report.json'))
+            profile = pstats.Stats(written['stages'][1]['profile'])
+            msg = 'Only the computation of a stage should be profiled'
+            self.assertTrue(
+                any('sum' in function for _, _, function in profile.stats),
+                msg=msg
+            )
+            self.assertNotIn('profile', written['stages'][2], msg=msg)
+
+        self.assertEqual(
+            ['sort', 'total', 'total'],
+            [stage['stage'] for stage in written['stages']]
+        )
+        self.assertEqual(
+            [None, None, True],
+            [stage.get('cached') for stage in written['stages']],
+            msg='Cache lookups that miss should not be recorded'
+        )
+        sort = written['stages'][0]
+        self.assertEqual(2019, sort['year'])
+        self.assertEqual(10000, sort['rows'])
+        self.assertAlmostEqual(
+            10000 / sort['wall_seconds'], sort['rows_per_second']
+        )
+        self.assertGreater(sort['cpu_seconds'], 0)
+        self.assertGreater(written['peak_rss_bytes'], 0)
+        for field in ['rss_before_bytes', 'rss_after_bytes',
+                      'peak_rss_delta_bytes']:
+            self.assertIn(field, sort)
+
+        msg = 'Stages should report their own peak memory'
+        report = runreport.RunReport()
+        with report.stage('outer'):
+            with report.stage('allocate'):
+                allocated = np.ones(64 << 17)
+                del allocated
+        with report.stage('small'):
+            pass
+        outer, allocate, small = sorted(
+            report.stages, key=lambda stage: stage['stage']
+        )
+        self.assertGreaterEqual(
+            allocate['peak_rss_bytes'], allocate['rss_before_bytes'] +
+            (48 << 20), msg=msg
+        )
+        self.assertGreaterEqual(
+            outer['peak_rss_bytes'], allocate['peak_rss_bytes'], msg=msg
+        )
+        if runreport.reset_high_water_mark():
+            self.assertLess(
+                small['peak_rss_bytes'], allocate['peak_rss_bytes'], msg=msg
+            )
+
+    def test_network_format(self):
+        """
+        A network should decode to the same nodes, links and artist ids that
+        it was encoded from
+        """
+        d = {
+            'directed': False,
+            'multigraph': False,
+            'graph': {},
+            'nodes': [
+                {'id': 'Tresor', 'group': 0, 'attending': np.float64(1.5),
+                 'artists': {'Ø': 2, 'DJ Stingray': 1}},
+                {'id': 'fabric', 'group': np.int64(1), 'attending': None,
+                 'artists': {}},
+                {'id': 'Berghain', 'group': 0, 'attending': 3.0,
+                 'artists': {'DJ Stingray': 300, 'Ben Klock': 12}},
+            ],
+            'links': [
+                {'weight': 0.25, 'source': 'Tresor', 'target': 'Berghain'},
+                {'weight': 0.1, 'source': 'fabric', 'target': 'Tresor'},
+            ]
+        }
+        artist_name_to_ids = {'DJ Stingray': 'djstingray313', 'Unused': 'x'}
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'network.bin')
+            data = network_format.write_network(path, d, artist_name_to_ids)
+            self.assertTrue(os.path.exists(path + '.gz'))
+        decoded = network_format.decode_network(data)
+
+        self.assertEqual(d['nodes'], decoded['nodes'])
+        self.assertEqual(
+            [(link['source'], link['target']) for link in d['links']],
+            [(link['source'], link['target']) for link in decoded['links']]
+        )
+        np.testing.assert_allclose(
+            [0.25, 0.1], [link['weight'] for link in decoded['links']],
+            rtol=1e-7
+        )
+        msg = 'Only ids of artists in the network should be kept'
+        self.assertEqual(
+            {'DJ Stingray': 'djstingray313'},
+            decoded['artist_names_to_ids'],
+            msg=msg
+        )
+
+    def test_sharded_network(self):
+        """
+        A sharded network should have a core without artists and a shard with
+        the artists of every group, named by their contents
+        """
+        d = {
+            'nodes': [
+                {'id': 'Tresor', 'group': 0, 'artists': {'Ø': 2}},
+                {'id': 'fabric', 'group': 1, 'artists': {'Craig Richards': 9}},
+                {'id': 'Berghain', 'group': 0,
+                 'artists': {'DJ Stingray': 300, 'Ø': 1}},
+            ],
+            'links': [
+                {'weight': 0.25, 'source': 'Tresor', 'target': 'Berghain'},
+            ]
+        }
+        artist_name_to_ids = {'DJ Stingray': 'djstingray313'}
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'network.bin')
+            shard_directory = os.path.join(directory, 'network')
+            os.makedirs(shard_directory)
+            stale = os.path.join(shard_directory, 'stale.bin')
+            open(stale, 'wb').close()
+
+            shards = network_format.write_sharded_network(
+                path, shard_directory, d, artist_name_to_ids
+            )
+            with open(path, 'rb') as fp:
+                core = network_format.decode_network(fp.read())
+            details = {}
+            for group, shard_path in shards.items():
+                with open(os.path.join(directory, shard_path), 'rb') as fp:
+                    details[group] = network_format.decode_network(fp.read())
+
+            msg = 'Shards of earlier builds should be removed'
+            self.assertFalse(os.path.exists(stale), msg=msg)
+            msg = 'Shard names should only depend on their contents'
+            self.assertEqual(
+                shards,
+                network_format.write_sharded_network(
+                    path, shard_directory, d, artist_name_to_ids
+                ),
+                msg=msg
+            )
+
+        self.assertEqual({'shards': shards}, core['metadata'])
+        self.assertEqual(['0', '1'], sorted(shards))
+        msg = 'The core should keep the links and nodes without artists'
+        self.assertEqual(1, len(core['links']), msg=msg)
+        self.assertEqual(
+            [{'id': node['id'], 'group': node['group'], 'artists': {}}
+             for node in d['nodes']],
+            core['nodes'],
+            msg=msg
+        )
+        self.assertEqual(
+            [{'id': 'Tresor', 'artists': {'Ø': 2}},
+             {'id': 'Berghain', 'artists': {'DJ Stingray': 300, 'Ø': 1}}],
+            details['0']['nodes']
+        )
+        self.assertEqual(
+            {'DJ Stingray': 'djstingray313'},
+            details['0']['artist_names_to_ids']
+        )
+        self.assertEqual({}, details['1']['artist_names_to_ids'])
+
+    def test_cluster_layout(self):
+        """
+        Precomputed layouts should separate communities without overlapping
+        clubs and survive the binary network format
+        """
+        nodes = [
+            {'id': str(i), 'group': i % 3, 'followers': 10 ** (1 + i % 4)}
+            for i in range(30)
+        ]
+        layouts = layout.cluster_layouts(nodes)
+        self.assertEqual(set(layout.VIEWPORT_FACTORS), set(layouts))
+
+        radius = layout.node_radius([node['followers'] for node in nodes])
+        groups = np.array([node['group'] for node in nodes])
+        for name, positions in layouts.items():
+            self.assertEqual((30, 2), positions.shape)
+            msg = 'Clubs should not overlap in the {} layout'.format(name)
+            self.assertLess(
+                layout.overlap(positions.astype(float), radius), 1, msg=msg
+            )
+            centres = np.array(
+                [positions[groups == g].mean(axis=0) for g in range(3)]
+            )
+            spread = np.hypot(*(positions - centres[groups]).T).mean()
+            msg = 'Clubs should be closer to the centre of their community ' \
+                  'than communities are to each other'
+            self.assertLess(
+                spread, np.hypot(*(centres[0] - centres[1:]).T).min(),
+                msg=msg
+            )
+
+        msg = 'Layouts should be the same for the same seed'
+        np.testing.assert_array_equal(
+            layouts['desktop'], layout.cluster_layouts(nodes)['desktop'],
+            err_msg=msg
+        )
+
+        d = {'nodes': nodes, 'links': []}
+        decoded = network_format.decode_network(
+            network_format.encode_network(d, {}, layouts=layouts)
+        )
+        self.assertEqual(
+            layouts['mobile'][7].tolist(),
+            decoded['nodes'][7]['layouts']['mobile']
+        )
+
+    def test_compare_underlying_distribution(self):
+        """
+        The one-vs-rest tests of every group should give the same results as
+        scipy's two sample test, and permutation tests should not depend on
+        the executor
+        """
+        rng = np.random.default_rng(0)
+        clubs = pd.DataFrame({
+            'region': np.repeat(['Berlin', 'London', 'Tokyo'], [20, 30, 40]),
+            'total_number_of_artists': np.concatenate([
+                rng.integers(100, 200, 20), rng.integers(0, 100, 70)
+            ]),
+            'number_of_unique_artists': np.append(rng.integers(1, 50, 89), 0),
+            'number_of_dates': rng.integers(1, 10, 90),
+            'attending': np.append(rng.random(80), [np.nan] * 10)
+        })
+        metrics = ['residency_factor', 'attendance_per_date']
+        report = compare_underlying_distribution(clubs, metrics)
+
+        self.assertEqual(6, len(report))
+        residency = clubs.total_number_of_artists / \
+            clubs.number_of_unique_artists.replace(0, np.inf)
+        for row in report[report.metric == 'residency_factor'].itertuples():
+            in_group = clubs.region == row.group
+            expected = stats.ks_2samp(
+                residency[in_group], residency[~in_group], method='asymp'
+            )
+            self.assertAlmostEqual(expected.statistic, row.statistic)
+            self.assertAlmostEqual(expected.pvalue, row.pvalue)
+        msg = 'Clubs without a metric should be left out of its tests'
+        self.assertEqual(
+            [20, 30, 30],
+            report[report.metric == 'attendance_per_date'].clubs.tolist(),
+            msg=msg
+        )
+        msg = 'Metrics no club has should be left out of the tests'
+        unknown = compare_underlying_distribution(
+            clubs.assign(attending=np.nan), metrics
+        )
+        self.assertEqual(
+            ['residency_factor'], unknown.metric.unique().tolist(), msg=msg
+        )
+        self.assertEqual(
+            0, len(compare_underlying_distribution(
+                clubs.assign(attending=np.nan), ['attendance_per_date'],
+                permutations=10
+            )),
+            msg=msg
+        )
+        msg = 'Berlin clubs should have a different residency factor'
+        different = report[report.different]
+        self.assertIn(
+            'Berlin',
+            different[different.metric == 'residency_factor'].group.tolist(),
+            msg=msg
+        )
+
+        permutations = compare_underlying_distribution(
+            clubs, metrics, permutations=250, chunk_size=100
+        )
+        with ThreadPoolExecutor(2) as executor:
+            parallel = compare_underlying_distribution(
+                clubs, metrics, permutations=250, executor=executor,
+                chunk_size=100
+            )
+        pd.testing.assert_frame_equal(permutations, parallel)
+        self.assertEqual(1 / 251, permutations.permutation_pvalue.min())
+
+    def test_benchmark(self):
+        """
+        Synthetic tables should look like the csv files, every stage should be
+        measured and slower stages should be flagged as regressions
+        """
+        regions, clubs, dates, date_details = benchmark.synthetic_tables(
+            clubs=30, events=10, seed=1
+        )
+        self.assertEqual(
+            ['name', 'country', 'region', 'rank'], list(regions.columns)
+        )
+        self.assertTrue(clubs.region.isin(regions.region).all())
+        self.assertTrue(dates.club_id.isin(clubs.index).all())
+        self.assertTrue(date_details.index.isin(dates.index).all())
+        counts = normalize_artist_data(date_details).artist_id.value_counts()
+        msg = 'Artist popularity should be skewed'
+        self.assertGreater(counts.iloc[0], 5 * counts.median(), msg=msg)
+
+        results = {
+            'sizes': {'tiny': {'clubs': 30, 'events': 10, 'seed': 1}},
+            'results': benchmark.benchmark(
+                'tiny', {'clubs': 30, 'events': 10, 'seed': 1}, repeat=1
+            )
+        }
+        self.assertEqual(
+            ['normalize_artist_data', 'join_data_frames',
+             'group_by_year_and_club', 'aggregate_club_data',
+             'calculate_club_likeness', 'create_graph', 'optimise_json',
+             'encode_network'],
+            [row['stage'] for row in results['results']]
+        )
+        self.assertTrue(all(
+            row['peak_bytes'] > 0 and row['rows'] > 0
+            for row in results['results']
+        ))
+
+        slower = dict(results, results=[
+            dict(row, seconds=row['seconds'] * 2 + 1)
+            if row['stage'] == 'create_graph' else row
+            for row in results['results']
+        ])
+        comparison = benchmark.compare_results(results, slower)
+        self.assertEqual(
+            ['create_graph'],
+            comparison[comparison.regression].stage.tolist()
+        )
+        msg = 'Sizes generated with other parameters should not be compared'
+        other = dict(slower, sizes={'tiny': {'clubs': 31}})
+        self.assertTrue(benchmark.compare_results(results, other).empty,
+                        msg=msg)
+
 
 if __name__ == '__main__':
     unittest.main()